@@ -0,0 +1,17 @@
+from datasette import hookimpl
+
+import spevktator.fts as fts
+
+
+@hookimpl
+def canned_queries(datasette, database):
+    "search through the full-text indexes of the database that exist"
+    config = datasette.plugin_config("indexed_queries", database=database)
+    if not config:
+        return None
+
+    async def inner():
+        tables = await datasette.get_database(database).table_names()
+        return fts.indexed_queries(config, set(tables))
+
+    return inner
@@ -0,0 +1,11 @@
+from datasette import hookimpl
+
+import spevktator.lemmas as lemmas
+
+
+@hookimpl
+def prepare_connection(conn, database):
+    "lemma_query(text), for searching posts_lemmas_fts by any form of the words"
+    if database != "vk":
+        return
+    conn.create_function("lemma_query", 1, lemmas.match, deterministic=True)
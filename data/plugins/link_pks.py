@@ -1,22 +1,32 @@
 from datasette import hookimpl
+import functools
 import markupsafe
 import re
 
+import spevktator.keys as keys
+
 POST_ID_RE = re.compile(r"^-\d+_\d+$")
 
 
+@functools.lru_cache(maxsize=4096)
+def post_link(value):
+    "the link for a post id, or None when value doesn't look like one"
+    if not POST_ID_RE.match(value):
+        return None
+    href = f"/vk/posts/{keys.post_key(value)}"
+    return markupsafe.Markup(
+        '<a href="{href}">{value}</a>'.format(
+            href=markupsafe.escape(href),
+            value=markupsafe.escape(value or "") or "&nbsp;",
+        )
+    )
+
+
 @hookimpl
 def render_cell(value, column, table, database):
     "make any id value that looks like a post id a link to /posts/id"
-    if not isinstance(value, str):
+    if column != "id" or database != "vk":
         return None
-    if database != "vk":
+    if not isinstance(value, str):
         return None
-    if column == "id" and POST_ID_RE.match(value):
-        href = "/vk/posts/" + value
-        return markupsafe.Markup(
-            '<a href="{href}">{value}</a>'.format(
-                href=markupsafe.escape(href),
-                value=markupsafe.escape(value or "") or "&nbsp;",
-            )
-        )
+    return post_link(value)
@@ -0,0 +1,11 @@
+from datasette import hookimpl
+
+import spevktator.partitions as partitions
+
+
+@hookimpl
+def prepare_connection(conn, database):
+    "make the sealed monthly partitions part of the tables and views of vk"
+    if database != "vk":
+        return
+    partitions.attach(conn)
@@ -0,0 +1,78 @@
+from datasette import hookimpl
+from datasette.utils.asgi import Response
+import markupsafe
+
+import spevktator.keys as keys
+import spevktator.post_detail as post_detail
+
+DATABASE = "vk"
+
+fragments = post_detail.VersionedLRU()
+documents = post_detail.VersionedLRU()
+
+
+async def load(datasette, key):
+    "(data version, post) read in one go on the same connection"
+
+    def read(conn):
+        return post_detail.data_version(conn), post_detail.fetch(conn, key)
+
+    return await datasette.get_database(DATABASE).execute_fn(read)
+
+
+async def current_version(datasette):
+    return await datasette.get_database(DATABASE).execute_fn(post_detail.data_version)
+
+
+async def render_post(datasette, key):
+    "the translation, metrics, sentiment and entities of a post as HTML"
+    version = await current_version(datasette)
+    html = fragments.get(version, key)
+    if html is None:
+        version, post = await load(datasette, key)
+        html = markupsafe.Markup(
+            await datasette.render_template("_post_detail.html", {"post": post})
+        )
+        fragments.put(version, key, html)
+    return html
+
+
+async def post_json(datasette, request):
+    post = request.url_vars["post"]
+    # by packed key, or by string id for links from before the packed keys
+    key = keys.post_key(post) if "_" in post else int(post)
+    version = await current_version(datasette)
+    body = documents.get(version, key)
+    if body is None:
+        version, post = await load(datasette, key)
+        if post is None:
+            return Response.json({"ok": False, "error": "Post not found"}, status=404)
+        body = Response.json(post).body
+        documents.put(version, key, body)
+    return Response(body, content_type="application/json; charset=utf-8")
+
+
+async def post_page(datasette, request):
+    "posts are keyed by their packed key, keep links by string id working"
+    key = keys.post_key(request.url_vars["post_id"])
+    format = "json" if request.url_vars["suffix"] else None
+    return Response.redirect(datasette.urls.row(DATABASE, "posts", key, format=format))
+
+
+@hookimpl
+def extra_template_vars(datasette, database, table):
+    if database != DATABASE or table != "posts":
+        return {}
+
+    async def render(key):
+        return await render_post(datasette, int(key))
+
+    return {"post_detail": render}
+
+
+@hookimpl
+def register_routes():
+    return [
+        (rf"^/{DATABASE}/posts/(?P<post>-?\d+(_\d+)?)/detail\.json$", post_json),
+        (rf"^/{DATABASE}/posts/(?P<post_id>-?\d+_\d+)(?P<suffix>\.json)?$", post_page),
+    ]
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+from datasette import hookimpl
+from datasette.utils.asgi import AsgiStream, Response
+
+import spevktator.events as events
+
+
+async def stream_events(datasette, request):
+    "new and enriched posts as server-sent events, resuming after Last-Event-ID"
+    db = datasette.get_database("vk")
+    since = request.headers.get("last-event-id") or request.args.get("since")
+    domains = request.args.getlist("domain")
+    try:
+        timeout = min(
+            float(request.args.get("timeout", events.STREAM_TIMEOUT)),
+            events.STREAM_TIMEOUT,
+        )
+        cursor = int(since) if since is not None else None
+    except ValueError:
+        return Response.json(
+            {"ok": False, "error": "Invalid since or timeout"}, status=400
+        )
+    if cursor is None:
+        # only what happens from now on
+        cursor = await db.execute_fn(events.latest)
+
+    async def stream(response):
+        nonlocal cursor
+        deadline = time.monotonic() + timeout
+        sent = time.monotonic()
+        await response.write(f"retry: {int(events.POLL_INTERVAL * 1000)}\n\n")
+        while True:
+            previous = cursor
+            cursor, batch = await db.execute_fn(
+                lambda conn: events.read(conn, previous, domains)
+            )
+            for event in batch:
+                await response.write(events.server_sent(event))
+                sent = time.monotonic()
+            if cursor != previous:
+                continue
+            if time.monotonic() >= deadline:
+                break
+            if time.monotonic() - sent >= events.KEEPALIVE:
+                await response.write(": keep-alive\n\n")
+                sent = time.monotonic()
+            await asyncio.sleep(events.POLL_INTERVAL)
+
+    return AsgiStream(
+        stream,
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+        content_type="text/event-stream; charset=utf-8",
+    )
+
+
+@hookimpl
+def register_routes():
+    return [(r"^/-/post-events$", stream_events)]
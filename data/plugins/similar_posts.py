@@ -0,0 +1,31 @@
+from datasette import hookimpl
+from datasette.utils.asgi import Response
+
+import spevktator.embeddings as embeddings
+import spevktator.keys as keys
+
+MAX_K = 100
+
+
+async def similar_json(datasette, request):
+    "the posts most similar in meaning to a post, by their vectors"
+    post = request.url_vars["post"]
+    key = keys.post_key(post) if "_" in post else int(post)
+    try:
+        k = min(int(request.args.get("k", 10)), MAX_K)
+        probes = int(request.args.get("probes", embeddings.PROBES))
+    except ValueError:
+        return Response.json({"ok": False, "error": "Invalid k or probes"}, status=400)
+    posts = await datasette.get_database("vk").execute_fn(
+        lambda conn: embeddings.similar_posts(conn, key, k, probes)
+    )
+    if posts is None:
+        return Response.json(
+            {"ok": False, "error": "Post not found or not embedded"}, status=404
+        )
+    return Response.json({"ok": True, "key": key, "similar": posts})
+
+
+@hookimpl
+def register_routes():
+    return [(r"^/vk/posts/(?P<post>-?\d+(_\d+)?)/similar\.json$", similar_json)]
@@ -0,0 +1,307 @@
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import sqlite_utils
+import yaml
+
+from datasette.utils import escape_fts
+
+import spevktator.fts as fts
+import spevktator.keys as keys
+import spevktator.lemmas as lemmas
+import spevktator.models as models
+import spevktator.scraper as scraper
+import spevktator.storage as storage
+
+
+# parameter values used for canned queries, matching the examples in metadata.yml
+DEFAULT_PARAMS = {
+    "text_ru": "Запорожье",
+    "text_en": "Ukraine",
+    "search": "Moskva cruiser",
+    "entity_name": "ЗАЭС",
+    "words": "Запорожье",
+}
+QUERY_PARAMS = {
+    "related_entities_en": {"entity_name": "ZNPP"},
+    "term_mentions_per_week": {"term": "Ukraine"},
+    "entity_mentions_per_week": {"entity_name": "ZNPP"},
+    "entity_search": {"entity_name": "Zaporozh"},
+}
+
+POLL_INTERVAL = 0.02  # seconds between looking for new posts during a load test
+
+_RE_PARAM = re.compile(r"(?<!:):(\w+)")
+_RE_HREF = re.compile(r'href="([^"]*\?sql=[^"]*)"')
+
+
+def query_params(sql, overrides=None):
+    params = dict(DEFAULT_PARAMS, **(overrides or {}))
+    return {name: params.get(name, "") for name in _RE_PARAM.findall(sql)}
+
+
+def canned_queries(metadata, tables=()):
+    """
+    yield (name, sql, params) for every canned query and homepage example in
+    metadata, through the full-text indexes among tables
+    """
+    hrefs = _RE_HREF.findall(metadata.get("description_html", ""))
+    for i, href in enumerate(hrefs):
+        query = urllib.parse.urlparse(href.replace("&amp;", "&")).query
+        args = {k: v[0] for k, v in urllib.parse.parse_qs(query).items()}
+        sql = args.pop("sql")
+        yield f"example_{i + 1}", sql, query_params(sql, args)
+    for database in (metadata.get("databases") or {}).values():
+        queries = dict(database.get("queries") or {})
+        plugins = database.get("plugins") or {}
+        queries.update(fts.indexed_queries(plugins.get("indexed_queries"), tables))
+        for name, query in queries.items():
+            sql = query["sql"] if isinstance(query, dict) else query
+            yield name, sql, query_params(sql, QUERY_PARAMS.get(name))
+
+
+def load_metadata(path):
+    with open(path) as fp:
+        return yaml.safe_load(fp)
+
+
+def time_query(db: sqlite_utils.Database, sql, params=None, repeat=1, limit=None):
+    "best wall clock time in seconds over `repeat` runs, and the number of rows"
+    if limit is not None:
+        sql = f"select * from ({sql.rstrip().rstrip(';')}) limit {limit}"
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = db.execute(sql, params or {}).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(rows)
+
+
+def run(db: sqlite_utils.Database, metadata=None, repeat=1, page_size=101):
+    "time all views (first page and full scan) and canned queries"
+    db.register_function(escape_fts)
+    db.conn.create_function("lemma_query", 1, lemmas.match, deterministic=True)
+    results = []
+    for view in sorted(db.view_names()):
+        for label, limit in (("page", page_size), ("full", None)):
+            seconds, count = time_query(
+                db, f"select * from [{view}]", repeat=repeat, limit=limit
+            )
+            results.append(
+                {"name": view, "kind": f"view {label}", "rows": count, "ms": seconds}
+            )
+    for name, sql, params in canned_queries(metadata or {}, set(db.table_names())):
+        seconds, count = time_query(db, sql, params, repeat=repeat, limit=page_size)
+        results.append({"name": name, "kind": "query", "rows": count, "ms": seconds})
+    for result in results:
+        result["ms"] = round(result["ms"] * 1000, 1)
+    return results
+
+
+# joins of the post tables, {k} is the key column
+KEY_JOINS = {
+    "posts_metrics": """
+        select count(*), sum(pm.views) from posts p
+        join posts_metrics pm on p.{k} = pm.{k}
+    """,
+    "sentiment_translation": """
+        select count(*), avg(ps.positive) from posts p
+        join posts_sentiment ps on p.{k} = ps.{k}
+        join posts_translation pt on p.{k} = pt.{k}
+    """,
+    "entity_mentions": """
+        select e.name, count(distinct p.{k}) as posts from posts_entities pe
+        join posts p on p.{k} = pe.{k} join entities e on e.id = pe.entity
+        group by e.id order by posts desc limit 20
+    """,
+}
+
+
+def copy_post_tables(source_path, path, text_keys):
+    "copy the post tables of source into a fresh database, keyed as asked"
+    db = sqlite_utils.Database(path)
+    db.execute("attach database ? as source", [source_path])
+    db.execute("create table entities as select * from source.entities")
+    for table, (columns, unique) in keys.POST_TABLES.items():
+        if text_keys:
+            key = "[id] TEXT PRIMARY KEY" if unique else "[id] TEXT"
+            db.execute(
+                "CREATE TABLE [{}] ({})".format(table, ", ".join([key] + columns))
+            )
+        else:
+            db.execute(keys.create_table_sql(table))
+        k = "id" if text_keys else "key"
+        names = ", ".join([k] + [column.split()[0] for column in columns])
+        db.execute(
+            f"insert into main.[{table}] ({names})"
+            f" select {names} from source.[{table}] order by {k}"
+        )
+    db.conn.commit()
+    db.execute("detach database source")
+    if text_keys:
+        db["posts_entities"].create_index(["id"])
+    else:
+        db["posts"].create_index(["id"], unique=True)
+        db["posts_entities"].create_index(["key"])
+    db.vacuum()
+    return db
+
+
+def compare_keys(db: sqlite_utils.Database, repeat=1):
+    "size and join times of the post tables with string keys and with packed keys"
+    source_path = storage.database_path(db)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, text_keys in (("text", True), ("packed", False)):
+            path = os.path.join(tmp, f"{label}.db")
+            copy = copy_post_tables(source_path, path, text_keys)
+            result = {"keys": label, "MB": round(os.path.getsize(path) / 2**20, 1)}
+            for name, sql in KEY_JOINS.items():
+                seconds, _ = time_query(
+                    copy, sql.format(k="id" if text_keys else "key"), repeat=repeat
+                )
+                result[f"{name} ms"] = round(seconds * 1000, 1)
+            copy.close()
+            results.append(result)
+    return results
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Arrivals(threading.Thread):
+    "notes when each post becomes visible to a reader of the database at path"
+
+    def __init__(self, path, interval=POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.interval = interval
+        self.version = None
+        self.seen = {}
+        self.stopped = threading.Event()
+        self.poll()
+        self.existing = set(self.seen)
+
+    def poll(self):
+        # data_version changes when another connection commits
+        version = self.conn.execute("pragma data_version").fetchone()[0]
+        if version != self.version:
+            self.version = version
+            now = time.time()
+            for (key,) in self.conn.execute("select key from posts"):
+                self.seen.setdefault(key, now)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.poll()
+        self.conn.close()
+
+
+def load_test(db: sqlite_utils.Database, server, run):
+    """
+    Call run(), scraping from the mock VK server, and report the pages/s it
+    fetched and the latency from a post being served (or published on a growing
+    wall) until it is committed to db.
+    """
+    base_url = scraper.VK_BASE_URL
+    scraper.VK_BASE_URL = server.url
+    server.run_in_thread()
+    arrivals = Arrivals(storage.database_path(db))
+    arrivals.start()
+    start = time.perf_counter()
+    try:
+        run()
+    finally:
+        seconds = time.perf_counter() - start
+        arrivals.stop()
+        server.shutdown()
+        scraper.VK_BASE_URL = base_url
+    added = {
+        key: seen for key, seen in arrivals.seen.items() if key not in arrivals.existing
+    }
+    served = [seen - server.served[key] for key, seen in added.items()]
+    published = [
+        seen - server.published(key)
+        for key, seen in added.items()
+        if server.published(key) > server.start
+    ]
+    result = {
+        "seconds": round(seconds, 1),
+        "pages": server.stats.pages,
+        "pages/s": round(server.stats.pages / seconds, 1),
+        "errors": server.stats.errors,
+        "limited": server.stats.limited,
+        "posts": len(added),
+        "posts/s": round(len(added) / seconds, 1),
+    }
+    for p in (50, 95):
+        latency = percentile(served, p)
+        result[f"p{p} ms"] = None if latency is None else round(latency * 1000)
+    if published:
+        for p in (50, 95):
+            result[f"published p{p} s"] = round(percentile(published, p), 1)
+    return result
+
+
+def ner_levels(texts, batch_size=scraper.NER_BATCH_SIZE):
+    """
+    Posts/s of each named-entity pipeline level on the texts, and the share
+    of the spans and normal forms of the full pipeline it finds
+    """
+    import spevktator.natasha_entities as natasha_entities
+
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = []
+    reference = None
+    for level in reversed(models.NER_LEVELS):
+        # the first batch loads the models and warms up
+        natasha_entities.named_entities(batches[0], level)
+        start = time.perf_counter()
+        found = [
+            entities
+            for batch in batches
+            for entities in natasha_entities.named_entities(batch, level)
+        ]
+        seconds = time.perf_counter() - start
+        spans = {
+            (i, e["start"], e["stop"], e["type"])
+            for i, entities in enumerate(found)
+            for e in entities
+        }
+        names = {
+            (i, e["start"], e["stop"], e["type"], e["normal"])
+            for i, entities in enumerate(found)
+            for e in entities
+        }
+        if reference is None:
+            reference = spans, names
+        results.append(
+            {
+                "level": level,
+                "seconds": round(seconds, 2),
+                "posts/s": round(len(texts) / seconds, 1),
+                "spans": len(spans),
+                "same spans %": round(
+                    100 * len(spans & reference[0]) / max(len(reference[0]), 1), 1
+                ),
+                "same names %": round(
+                    100 * len(names & reference[1]) / max(len(reference[1]), 1), 1
+                ),
+            }
+        )
+    return results
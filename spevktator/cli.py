@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
+import contextlib
+import io
+import json
+import multiprocessing
 import os
 import random
 import re
+import signal
+import sys
+import textwrap
 import time
 
 import click
@@ -11,8 +18,31 @@ import sqlite_utils
 from sqlite_utils.utils import chunks
 from tabulate import tabulate
 
+import spevktator.benchmark as benchmark
+import spevktator.diagnostics as diagnostics
 import spevktator.dostoevsky_sentiment as dostoevsky_sentiment
+import spevktator.embeddings as embeddings
+import spevktator.enrich as enrich
+import spevktator.events as events
+import spevktator.export as export_
+import spevktator.fts as fts
+import spevktator.keys as keys
+import spevktator.leases as leases
+import spevktator.lemmas as lemmas
+import spevktator.maintenance as maintenance
+import spevktator.merge as merge_
+import spevktator.mock_vk as mock_vk
+import spevktator.model_server as model_server
+import spevktator.models as models
+import spevktator.near_duplicates as near_duplicates
+import spevktator.partitions as partitions
+import spevktator.publish as publish_
+import spevktator.refresh as refresh
+import spevktator.rollups as rollups
 import spevktator.scraper as scraper
+import spevktator.storage as storage
+import spevktator.synth as synth
+import spevktator.text_cache as text_cache
 import spevktator.utils as utils
 
 
@@ -32,6 +62,18 @@ class VKDomainParamType(click.ParamType):
 VK_DOMAIN = VKDomainParamType()
 
 
+def ner_level_option(fn):
+    "how much of the named-entity pipeline runs, for commands that extract entities"
+    return click.option(
+        "--ner-level",
+        type=click.Choice(models.NER_LEVELS),
+        help=(
+            "spans: names as written, fastest; normal: normal forms; full: also lemmas"
+            f" and syntax of every sentence [default: {models.DEFAULT_NER_LEVEL}]"
+        ),
+    )(fn)
+
+
 @click.group()
 @click.version_option()
 def cli():
@@ -52,7 +94,7 @@ def install(db_path):
     click.echo("DONE")
 
     click.echo("Creating database...", nl=False)
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     ensure_tables(db)
     ensure_views(db)
     click.echo("DONE")
@@ -82,6 +124,11 @@ def install(db_path):
     show_default=True,
     help="Date to go back to",
 )
+@click.option(
+    "--bulk",
+    is_flag=True,
+    help="Rebuild the full-text index once afterwards, instead of per post",
+)
 @click.option("--spevktator-proxy", envvar="SPEVKTATOR_PROXY")
 @click.argument(
     "db_path",
@@ -89,13 +136,13 @@ def install(db_path):
     required=True,
 )
 @click.argument("domain", type=VK_DOMAIN, required=True)
-def backfill(db_path, domain, force, limit, until, spevktator_proxy):
+def backfill(db_path, domain, force, limit, until, bulk, spevktator_proxy):
     "Retrieve the backlog of wall posts from the VK communities specified by their domain"
 
     if spevktator_proxy is not None:
         click.echo(f"Using proxy {spevktator_proxy}")
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     ensure_tables(db)
     ensure_views(db)
 
@@ -121,18 +168,22 @@ def backfill(db_path, domain, force, limit, until, spevktator_proxy):
     )
 
     scrape_delay = "PYTEST_CURRENT_TEST" not in os.environ
-    scraper.fetch_domains(
-        db,
-        [domain],
-        force,
-        limit,
-        offset,
-        scrape_delay,
-        until,
-        proxies=spevktator_proxy,
-    )
+    with fts.bulk_load(db) if bulk else contextlib.nullcontext():
+        scraper.fetch_domains(
+            db,
+            [domain],
+            force,
+            limit,
+            offset,
+            scrape_delay,
+            until,
+            proxies=spevktator_proxy,
+        )
     ensure_fts(db)
-    db["posts"].optimize()
+    if not bulk:
+        fts.merge(db, "posts")
+    rollups.refresh(db)
+    storage.checkpoint(db)
 
 
 @cli.command()
@@ -173,7 +224,7 @@ def fetch(db_path, domains, force, limit, offset, spevktator_proxy):
     if spevktator_proxy is not None:
         click.echo(f"Using proxy {spevktator_proxy}")
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     ensure_tables(db)
     ensure_views(db)
 
@@ -183,7 +234,9 @@ def fetch(db_path, domains, force, limit, offset, spevktator_proxy):
     )
 
     ensure_fts(db)
-    db["posts"].optimize()
+    fts.merge(db, "posts")
+    rollups.refresh(db)
+    storage.checkpoint(db)
 
 
 @cli.command()
@@ -195,6 +248,18 @@ def fetch(db_path, domains, force, limit, offset, spevktator_proxy):
     default=scraper.DEFAULT_PAGE_LIMIT,
     help="Number of pages to be requested",
 )
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(1),
+    help="Fetch in this many processes, sharing out the domains by leases",
+)
+@click.option(
+    "--memory-limit",
+    type=click.IntRange(1),
+    envvar="SPEVKTATOR_MEMORY_LIMIT",
+    help="Restart after a round once the resident memory exceeds this many MB",
+)
 @click.option("--deepl-auth-key", envvar="DEEPL_AUTH_KEY")
 @click.option("--spevktator-proxy", envvar="SPEVKTATOR_PROXY")
 @click.argument(
@@ -203,42 +268,317 @@ def fetch(db_path, domains, force, limit, offset, spevktator_proxy):
     required=True,
 )
 @click.argument("domains", type=VK_DOMAIN, nargs=-1, required=True)
-def listen(db_path, domains, limit, deepl_auth_key, spevktator_proxy):
-    "Continuously retrieve all wall posts from the VK communities specified by their domains"
+def listen(
+    db_path, domains, limit, workers, memory_limit, deepl_auth_key, spevktator_proxy
+):
+    """
+    Continuously retrieve all wall posts from the VK communities specified by their domains
+
+    Memory use is recorded in listen_diagnostics after every round, send
+    SIGUSR1 to also record the top allocation sites.
+
+    With --workers, each worker process fetches one domain at a time under a
+    lease in domain_leases, so listen processes on several machines sharing the
+    database never fetch the same domain at once.
+    """
 
     if spevktator_proxy is not None:
         click.echo(f"Using proxy {spevktator_proxy}")
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     ensure_tables(db)
     ensure_views(db)
 
     # build text indexes upfront when running in a loop, otherwise we'll do it afterwards
     ensure_fts(db)
 
+    if workers:
+        supervise_workers(
+            db,
+            workers,
+            (db_path, domains, limit, memory_limit, deepl_auth_key, spevktator_proxy),
+        )
+        return
+
     domains = list(domains)  # so we can shuffle them
     running = True
     scrape_delay = "PYTEST_CURRENT_TEST" not in os.environ
+    monitor = diagnostics.Monitor(db, memory_limit)
+    monitor.install()
     while running:
         if "PYTEST_CURRENT_TEST" not in os.environ:
             random.shuffle(domains)
 
-        scraper.fetch_domains(
+        posts = listen_round(
             db,
             domains,
-            force=False,
-            limit=limit,
-            offset=0,
+            limit,
             scrape_delay=scrape_delay,
             deepl_auth_key=deepl_auth_key,
             proxies=spevktator_proxy,
         )
-
+        row = monitor.record(posts)
+        click.echo(
+            f"Round {row['cycle']}: {posts} posts added, {row['rss_mb']} MB resident"
+        )
+        if row["restart"]:
+            click.echo(f"Over the memory limit of {memory_limit} MB, restarting...")
+            diagnostics.restart(db)
         click.echo(f"Done with all domains, sleeping {scraper.DEFAULT_LOOP_DELAY}s...")
         if scrape_delay:
             time.sleep(scraper.DEFAULT_LOOP_DELAY)
 
 
+def listen_round(
+    db,
+    domains,
+    limit,
+    scrape_delay,
+    deepl_auth_key=None,
+    proxies=None,
+    error_delay=scraper.ERROR_DELAY,
+):
+    "fetch the new posts of all domains once, then tidy up while idle"
+    posts = scraper.fetch_domains(
+        db,
+        domains,
+        force=False,
+        limit=limit,
+        offset=0,
+        scrape_delay=scrape_delay,
+        deepl_auth_key=deepl_auth_key,
+        proxies=proxies,
+        error_delay=error_delay,
+    )
+    tidy_up(db)
+    return posts
+
+
+def tidy_up(db):
+    """
+    merge the text indexes, refresh the rollups and give some free pages
+    back, between rounds of listening
+    """
+    for table in fts.FTS_TABLES:
+        fts.merge(db, table)
+    rollups.refresh(db)
+    reclaimed = maintenance.vacuum(db)
+    if reclaimed:
+        click.echo(f"Reclaimed {reclaimed / 2**20:.1f} MB of free pages")
+    # idle, so we can afford to wait for readers and keep the WAL small
+    storage.checkpoint(db, "truncate")
+
+
+def fetch_leased(
+    db,
+    domains,
+    owner,
+    limit,
+    scrape_delay,
+    interval=scraper.DEFAULT_LOOP_DELAY,
+    deepl_auth_key=None,
+    proxies=None,
+    error_delay=scraper.ERROR_DELAY,
+):
+    """
+    Lease the domain that is due the longest and fetch its new posts, renewing
+    the lease meanwhile. Returns the number of posts added, None when no
+    domain is due.
+    """
+    domain = leases.claim(db, domains, owner, interval)
+    if domain is None:
+        return None
+    heartbeat = leases.Heartbeat(storage.database_path(db), domain, owner)
+    heartbeat.start()
+    fetched = False
+    try:
+        posts = scraper.fetch_domains(
+            db,
+            [domain],
+            force=False,
+            limit=limit,
+            offset=0,
+            scrape_delay=scrape_delay,
+            deepl_auth_key=deepl_auth_key,
+            proxies=proxies,
+            error_delay=error_delay,
+        )
+        fetched = True
+    finally:
+        heartbeat.stop()
+        leases.release(db, domain, owner, fetched)
+    if heartbeat.lost:
+        click.secho(f"Lease on {domain} expired while fetching it", fg="red")
+    return posts
+
+
+def listen_worker(db_path, domains, limit, memory_limit, deepl_auth_key, proxies):
+    "a listen --workers process, fetching whichever domain is due until interrupted"
+    # stopped by the supervisor only, also on a Ctrl-C in the terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, interrupt)
+    db = storage.open_database(db_path)
+    owner = leases.worker_id()
+    monitor = diagnostics.Monitor(db, memory_limit)
+    monitor.install()
+    click.echo(f"Worker {owner} started")
+    try:
+        while True:
+            posts = fetch_leased(
+                db,
+                domains,
+                owner,
+                limit,
+                scrape_delay=True,
+                deepl_auth_key=deepl_auth_key,
+                proxies=proxies,
+            )
+            if posts is None:
+                time.sleep(leases.next_due(db, domains, scraper.DEFAULT_LOOP_DELAY))
+                continue
+            if monitor.record(posts)["restart"]:
+                click.echo(f"Worker {owner} over the memory limit, restarting...")
+                storage.checkpoint(db)
+                sys.exit(diagnostics.RESTART_EXIT_STATUS)
+    except KeyboardInterrupt:
+        pass
+
+
+def interrupt(signum, frame):
+    "stop at the next Python instruction, once, leaving the cleanup undisturbed"
+    signal.signal(signum, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+
+def supervise_workers(db, count, args):
+    """
+    Run count listen_worker processes, replacing those that exit, and tidy
+    up the database between rounds
+    """
+    context = multiprocessing.get_context("spawn")
+
+    def start():
+        process = context.Process(target=listen_worker, args=args)
+        process.start()
+        return process
+
+    workers = [start() for _ in range(count)]
+
+    def forward(signum, frame):
+        for process in workers:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    if diagnostics.SNAPSHOT_SIGNAL is not None:
+        signal.signal(diagnostics.SNAPSHOT_SIGNAL, forward)
+    signal.signal(signal.SIGTERM, interrupt)
+    click.echo(
+        f"Started {count} workers, tidying up every {scraper.DEFAULT_LOOP_DELAY}s"
+    )
+    tidied = time.monotonic()
+    try:
+        while True:
+            time.sleep(1)
+            replace_exited(workers, start)
+            if time.monotonic() - tidied >= scraper.DEFAULT_LOOP_DELAY:
+                tidy_up(db)
+                tidied = time.monotonic()
+    except KeyboardInterrupt:
+        stop_workers(workers)
+
+
+def stop_workers(workers, timeout=leases.STOP_TIMEOUT):
+    "let the workers release their leases and exit, kill those that take too long"
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + timeout
+    for process in workers:
+        process.join(max(deadline - time.monotonic(), 0))
+    for process in workers:
+        if process.is_alive():
+            click.secho(f"Worker {process.pid} did not stop, killing it", fg="red")
+            process.kill()
+            process.join()
+
+
+def replace_exited(workers, start):
+    "start a new worker for each that exited, a crashed one after a delay"
+    for i, process in enumerate(workers):
+        if process.is_alive():
+            continue
+        if process.exitcode != diagnostics.RESTART_EXIT_STATUS:
+            # its lease expires by itself, another worker takes over its domain
+            click.secho(
+                f"Worker {process.pid} exited with {process.exitcode},"
+                f" restarting in {scraper.ERROR_DELAY}s",
+                fg="red",
+            )
+            time.sleep(scraper.ERROR_DELAY)
+        workers[i] = start()
+
+
+@cli.command(name="refresh")
+@click.option(
+    "-r",
+    "--requests",
+    type=click.IntRange(1),
+    show_default=True,
+    default=refresh.DEFAULT_REQUESTS,
+    help="Number of pages to be requested per round",
+)
+@click.option(
+    "--loop",
+    is_flag=True,
+    default=False,
+    help="Keep refreshing, sleeping between rounds",
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    show_default=True,
+    default=False,
+    help="Verbose output",
+)
+@click.option("--spevktator-proxy", envvar="SPEVKTATOR_PROXY")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("domains", type=VK_DOMAIN, nargs=-1)
+def refresh_metrics(db_path, domains, requests, loop, verbose, spevktator_proxy):
+    "Refresh the metrics of already scraped posts, often while they are young"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_fts(db)
+
+    scrape_delay = "PYTEST_CURRENT_TEST" not in os.environ
+    while True:
+        click.echo(f"{refresh.due(db)} posts due for a refresh")
+        result = refresh.run(
+            db,
+            requests,
+            domains,
+            scrape_delay=scrape_delay,
+            proxies=spevktator_proxy,
+            verbose=verbose,
+        )
+        click.secho(
+            f"{result.refreshed} posts refreshed with {result.pages} requests,"
+            f" {result.missed} not found at their estimated offset",
+            fg="green",
+        )
+        rollups.refresh(db)
+        storage.checkpoint(db)
+        if not loop:
+            break
+        click.echo(f"Sleeping {scraper.DEFAULT_LOOP_DELAY}s...")
+        time.sleep(scraper.DEFAULT_LOOP_DELAY)
+
+
 @cli.command()
 @click.option(
     "-l",
@@ -267,13 +607,14 @@ def listen(db_path, domains, limit, deepl_auth_key, spevktator_proxy):
 def rescrape(db_path, limit, verbose, reset):
     "Rescrape HTML pages from the scrape_log"
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
 
     if reset:
-        db["posts"].disable_fts()
-        db["posts"].drop(True)
-        db["posts_metrics"].drop(True)
-        db["posts_sentiment"].drop(True)
+        with storage.writer(db):
+            fts.disable(db, "posts")
+            db["posts"].drop(True)
+            db["posts_metrics"].drop(True)
+            db["posts_sentiment"].drop(True)
 
     ensure_tables(db)
     ensure_views(db)
@@ -287,28 +628,44 @@ def rescrape(db_path, limit, verbose, reset):
     # Run a count, for the progress bar
     count = utils.get_count(db, sql, params)
     rescrape_count = 0
-    with click.progressbar(rows, length=count) as bar:
-        for row in bar:
-            timestamp = dateparser.parse(
-                row["timestamp"],
-                settings={"TIMEZONE": "UTC"},
-            )
-            result = scraper.process_page(
-                db,
-                row["domain"],
-                row["html"],
-                force=True,
-                relative_timestamp=timestamp,
-                verbose=verbose,
-            )
-            rescrape_count += result.posts_added
+    # rescraping replaces posts, don't update the full-text index for each of them
+    with fts.bulk_load(db, ["posts"]):
+        with click.progressbar(rows, length=count) as bar:
+            for row in bar:
+                timestamp = dateparser.parse(
+                    row["timestamp"],
+                    settings={"TIMEZONE": "UTC"},
+                )
+                result = scraper.process_page(
+                    db,
+                    row["domain"],
+                    row["html"],
+                    force=True,
+                    relative_timestamp=timestamp,
+                    verbose=verbose,
+                )
+                rescrape_count += result.posts_added
 
     ensure_fts(db)
-    db["posts"].optimize()
+    storage.checkpoint(db)
 
     click.echo(f"rescraped {count} pages, {rescrape_count} posts inserted/updated")
 
 
+def text_table_pk(db, table, text_column):
+    "the primary key of a table with a text column to analyse"
+    if not db[table].exists():
+        raise click.ClickException(f"Table {table} does not exist")
+
+    if text_column not in db[table].columns_dict:
+        raise click.ClickException(f"Column {text_column} does not exist")
+
+    if len(db[table].pks) != 1:
+        raise click.ClickException(f"Table {table} with multiple PKs not supported")
+
+    return db[table].pks[0]
+
+
 @cli.command()
 @click.argument(
     "db_path",
@@ -324,13 +681,13 @@ def rescrape(db_path, limit, verbose, reset):
 def sentiment(db_path, table, text_column, output, reset):
     "Perform dostoevsky (RU) sentiment analysis on table with column"
 
-    if dostoevsky_sentiment.model is None:
+    if not models.sentiment_available():
         click.secho(
             "Dostoevsky sentiment model not installed, run `install` first.", fg="red"
         )
         return
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     output_table = output or f"{table}_sentiment"
 
     if reset:
@@ -339,23 +696,20 @@ def sentiment(db_path, table, text_column, output, reset):
     ensure_tables(db)
     ensure_views(db)
 
-    if not db[table].exists():
-        raise click.ClickException(f"Table {table} does not exist")
-
-    if text_column not in db[table].columns_dict:
-        raise click.ClickException(f"Column {text_column} does not exist")
-
-    if len(db[table].pks) != 1:
-        raise click.ClickException(f"Table {table} with multiple PKs not supported")
-
-    pk = db[table].pks[0]
+    pk = text_table_pk(db, table, text_column)
     sql = f"select {pk}, {text_column} from {table} where {text_column} != ''"
     params = dict()
 
     if reset:
         db[output_table].drop(True)
     else:
-        sql += f" and {pk} not in (select id from {output_table})"
+        sql += f" and {pk} not in (select {pk} from {output_table})"
+
+    # the sentiment of post texts seen before is copied rather than predicted
+    cached = (table, text_column, output_table) == ("posts", "text", "posts_sentiment")
+    if cached:
+        copied = text_cache.copy_sentiment(db, "select key from posts")
+        click.echo(f"Sentiment of {copied} posts copied from the cache")
 
     rows = db.query(sql, params=dict(params))
     count = utils.get_count(db, sql, params)
@@ -365,28 +719,74 @@ def sentiment(db_path, table, text_column, output, reset):
         for chunk in chunks(bar, 100):
             chunk = list(chunk)
             to_insert = []
+            # equal texts within the chunk are predicted once
+            texts = list(dict.fromkeys(row[text_column] for row in chunk))
+            predictions = dict(zip(texts, models.predict_sentiment(texts)))
             for row in chunk:
                 item = {pk: row[pk]}
-                item.update(dostoevsky_sentiment.predict([row[text_column]])[0])
+                item.update(predictions[row[text_column]])
                 to_insert.append(item)
                 sentiment_count += 1
 
-            db[output_table].insert_all(
-                to_insert,
-                pk=pk,
-                column_order=(
-                    "id",
-                    "positive",
-                    "negative",
-                    "neutral",
-                    "skip",
-                    "speech",
-                ),
-                foreign_keys=[("id", "posts", pk)],
-            )
+            with storage.writer(db):
+                db[output_table].insert_all(
+                    to_insert,
+                    pk=pk,
+                    column_order=(
+                        pk,
+                        "positive",
+                        "negative",
+                        "neutral",
+                        "skip",
+                        "speech",
+                    ),
+                    foreign_keys=[(pk, table, pk)],
+                )
+                if cached:
+                    text_cache.store_sentiment(db, [row[pk] for row in chunk])
+                    text_cache.record(
+                        db,
+                        "sentiment",
+                        hits=len(chunk) - len(texts),
+                        misses=len(texts),
+                    )
+    rollups.refresh(db)
     click.echo(f"Sentiment for {sentiment_count} rows predicted")
 
 
+@cli.command(name="model-server")
+@click.option(
+    "-s",
+    "--socket",
+    "socket_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    envvar=model_server.SOCKET_ENV,
+    help="Unix socket to listen on, other commands find it through $SPEVKTATOR_MODEL_SOCKET",
+)
+def serve_models(socket_path):
+    "Keep the sentiment and named-entity models loaded for all other commands"
+
+    socket_path = socket_path or model_server.default_socket_path()
+    started = time.perf_counter()
+    hosted = model_server.load_models()
+    try:
+        server = model_server.ModelServer(socket_path, hosted)
+    except OSError as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        f"Models {', '.join(sorted(hosted))} loaded in {time.perf_counter() - started:.1f}s,"
+        f" listening on {socket_path}"
+    )
+    # clean up the socket when stopped by a service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 @cli.command()
 @click.argument(
     "db_path",
@@ -396,7 +796,7 @@ def sentiment(db_path, table, text_column, output, reset):
 def stats(db_path):
     "Show statistics for the given database"
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     rows = db.query(
         """
     select domain, count(*) as nr_posts, min(date_utc) as first, max(date_utc) as last
@@ -404,6 +804,93 @@ def stats(db_path):
     """
     )
     click.echo(tabulate(list(rows), headers="keys"))
+    if db[text_cache.STATS_TABLE].exists():
+        click.echo()
+        click.echo(tabulate(text_cache.stats(db), headers="keys"))
+
+
+@cli.command(name="tail")
+@click.option(
+    "-n",
+    "--lines",
+    type=click.IntRange(0),
+    show_default=True,
+    default=10,
+    help="Number of recent events to start with",
+)
+@click.option(
+    "-s",
+    "--since",
+    type=click.IntRange(0),
+    help="Start after this event seq, to resume where a previous tail stopped",
+)
+@click.option(
+    "-d",
+    "--domain",
+    "domains",
+    type=VK_DOMAIN,
+    multiple=True,
+    help="Only posts of these domains",
+)
+@click.option(
+    "-f", "--follow", is_flag=True, help="Keep printing new events as they arrive"
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def tail_events(db_path, lines, since, domains, follow):
+    "Print new and enriched posts as JSON lines, from the post_events change log"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    cursor = since
+    if cursor is None:
+        cursor = max(events.latest(db.conn) - lines, 0)
+    try:
+        while True:
+            previous = cursor
+            cursor, batch = events.read(db.conn, cursor, domains)
+            for event in batch:
+                click.echo(json.dumps(event, ensure_ascii=False))
+            if cursor != previous:
+                continue
+            if not follow:
+                break
+            time.sleep(events.POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command(name="search-entities")
+@click.option(
+    "-l",
+    "--limit",
+    type=int,
+    show_default=True,
+    default=20,
+    help="Number of entities to show",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("query", type=str, required=True)
+def search_entities(db_path, query, limit):
+    "Find entities by (part of) their Russian or English name"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_fts(db)
+    rows = fts.search_entities(db, query, limit)
+    click.echo(
+        tabulate(
+            [{k: v for k, v in row.items() if k != "rank"} for row in rows],
+            headers="keys",
+        )
+    )
 
 
 @cli.command()
@@ -432,7 +919,7 @@ def stats(db_path):
 def translate_posts(db_path, limit, verbose, deepl_auth_key):
     "Translate posts from RU to EN-US"
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     ensure_tables(db)
 
     if not deepl_auth_key:
@@ -441,7 +928,9 @@ def translate_posts(db_path, limit, verbose, deepl_auth_key):
     scraper.translate_posts(db, deepl_auth_key, limit, verbose)
 
     ensure_fts(db)
-    db["posts_translation"].optimize()
+    fts.merge(db, "posts_translation")
+    rollups.refresh(db)
+    storage.checkpoint(db)
 
 
 @cli.command()
@@ -470,7 +959,7 @@ def translate_posts(db_path, limit, verbose, deepl_auth_key):
 def translate_entities(db_path, limit, verbose, deepl_auth_key):
     "Translate entities from RU to EN-US"
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     ensure_tables(db)
 
     if not deepl_auth_key:
@@ -501,136 +990,1013 @@ def translate_entities(db_path, limit, verbose, deepl_auth_key):
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
     required=True,
 )
-def extract_named_entities(db_path, limit, verbose):
+@ner_level_option
+def extract_named_entities(db_path, limit, verbose, ner_level):
     "Extract named-entities from text"
 
-    db = sqlite_utils.Database(db_path)
+    db = storage.open_database(db_path)
     ensure_tables(db)
 
-    scraper.extract_named_entities(db, limit, verbose)
+    scraper.extract_named_entities(db, limit, verbose, ner_level)
+    rollups.refresh(db)
 
 
-def ensure_tables(db):
-    # Create tables manually, because if we create them automatically
-    # we may create items without 'title' first, which breaks
-    # when we later call ensure_fts()
-    if "posts" not in db.table_names():
-        db["posts"].create(
-            {
-                "id": str,
-                "domain": str,
-                "date_utc": str,
-                "text": str,
-            },
-            pk="id",
-            column_order=("id", "domain", "date_utc", "text"),
-        )
-    if "posts_metrics" not in db.table_names():
-        db["posts_metrics"].create(
-            {
-                "id": str,
-                "likes": int,
-                "shares": int,
-                "views": int,
-                "timestamp": str,
-            },
-            pk="id",
-            column_order=("id", "likes", "shares", "views", "timestamp"),
-            foreign_keys=[("id", "posts")],
-        )
+@cli.command(name="enrich")
+@click.option(
+    "-l",
+    "--limit",
+    type=int,
+    show_default=True,
+    default=0,
+    help="Number of posts to be enriched, 0 for all pending posts",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    "batch_sizes",
+    type=(click.Choice(enrich.STAGES), click.IntRange(1)),
+    multiple=True,
+    help="Batch size of a stage, e.g. -b translate-posts 20",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=(click.Choice(enrich.STAGES), click.IntRange(1)),
+    multiple=True,
+    help="Number of threads of a stage, e.g. -w translate-posts 4",
+)
+@click.option(
+    "-s",
+    "--skip",
+    type=click.Choice(enrich.STAGES),
+    multiple=True,
+    help="Stage to leave out",
+)
+@click.option("--deepl-auth-key", type=str, default=None, envvar="DEEPL_AUTH_KEY")
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@ner_level_option
+def enrich_posts(db_path, limit, batch_sizes, workers, skip, deepl_auth_key, ner_level):
+    "Run sentiment, named-entities and translations on all pending posts in one pass"
 
-    if "entity_types" not in db.table_names():
-        db["entity_types"].create(
-            {
-                "id": int,
-                "value": str,
-            },
-            pk="id",
-        )
-    if "entities" not in db.table_names():
-        db["entities"].create(
-            {"id": int, "name": str, "name_en": str, "type": int},
-            pk="id",
-            column_order=("id", "name", "name_en", "type"),
-            foreign_keys=[("type", "entity_types", "id")],
-        )
+    db = storage.open_database(db_path)
+    ensure_tables(db)
 
-    if "posts_entities" not in db.table_names():
-        db["posts_entities"].create(
-            {"id": str, "entity": int, "begin_offset": int, "end_offset": int},
-            column_order=("id", "entity", "begin_offset", "end_offset"),
-            foreign_keys=[
-                ("entity", "entities", "id"),
-                ("id", "posts", "id"),
-            ],
-        )
-    if "posts_entities_done" not in db.table_names():
-        db["posts_entities_done"].create(
-            {"id": str},
-            pk="id",
-            foreign_keys=[
-                ("id", "posts", "id"),
-            ],
-        )
-    if "posts_sentiment" not in db.table_names():
-        db["posts_sentiment"].create(
-            {
-                "id": str,
-                "positive": float,
-                "negative": float,
-                "neutral": float,
-                "skip": float,
-                "speech": float,
-            },
-            pk="id",
-            column_order=(
-                "id",
-                "positive",
-                "negative",
-                "neutral",
-                "skip",
-                "speech",
-            ),
-            foreign_keys=[("id", "posts")],
-        )
-    if "posts_translation" not in db.table_names():
-        db["posts_translation"].create(
-            {
-                "id": str,
-                "text_en": str,
-            },
-            pk="id",
-            column_order=("id", "text_en"),
-            foreign_keys=[("id", "posts")],
-        )
-    if "scrape_log" not in db.table_names():
-        db["scrape_log"].create(
-            {
-                "domain": str,
-                "timestamp": str,
-                "url": str,
-                "status_code": int,
-                "html": str,
-            },
-        )
+    stages = enrich.build_stages(
+        db_path, deepl_auth_key, skip, dict(batch_sizes), dict(workers), ner_level
+    )
+    if not stages:
+        raise click.ClickException("No enrichment stages to run")
+    if not deepl_auth_key:
+        click.echo("DEEPL_AUTH_KEY not set, skipping translations")
 
+    pipeline = enrich.Pipeline(db, stages, limit=limit)
+    click.echo(f"{pipeline.copy_cached()} posts enriched from the text cache")
+    started = time.perf_counter()
+    with click.progressbar(length=pipeline.count(), label="Enriching posts") as bar:
+        pipeline.run(progress=bar.update)
+    elapsed = time.perf_counter() - started
 
-def ensure_views(db):
-    if "posts_metrics_view" not in db.view_names():
-        db.create_view(
-            "posts_metrics_view",
-            """
-        select posts.id, domain, date_utc, text, likes, shares, views
-        from posts join posts_metrics on posts.id = posts_metrics.id
-        order by likes desc
-        """,
-        )
-    if "posts_sentiment_view" not in db.view_names():
-        db.create_view(
+    click.echo(tabulate(pipeline.report(elapsed), headers="keys"))
+    click.echo(f"{pipeline.written} posts enriched in {elapsed:.1f}s")
+
+    ensure_fts(db)
+    fts.merge(db, "posts_translation")
+    rollups.refresh(db)
+    storage.checkpoint(db)
+
+
+@cli.command(name="near-duplicates")
+@click.option(
+    "-l",
+    "--limit",
+    type=int,
+    show_default=True,
+    default=0,
+    help="Number of posts to be indexed",
+)
+@click.option(
+    "-r", "--reset", is_flag=True, help="Start from scratch, deleting previous results"
+)
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def index_near_duplicates(db_path, limit, reset):
+    "Index posts for near-duplicate detection across communities"
+
+    db = storage.open_database(db_path)
+    if reset:
+        with storage.writer(db):
+            for table in (
+                "near_duplicates",
+                "near_duplicate_clusters",
+                "minhash_buckets",
+                "minhash_signatures",
+            ):
+                db[table].drop(True)
+    ensure_tables(db)
+
+    # oldest first, so clusters record where a text was seen first
+    sql = (
+        "select id, domain, date_utc, text from posts where text != ''"
+        " and id not in (select id from minhash_signatures) order by date_utc"
+    )
+    if limit:
+        sql += f" limit {limit}"
+    params = dict()
+    rows = db.query(sql, params)
+    count = utils.get_count(db, sql, params)
+
+    clustered = 0
+    with click.progressbar(rows, length=count) as bar:
+        for chunk in chunks(bar, 500):
+            with storage.writer(db):
+                for row in chunk:
+                    if near_duplicates.index_post(db, row) is not None:
+                        clustered += 1
+    click.echo(f"{count} posts indexed, {clustered} near-duplicates found")
+
+
+@cli.command()
+@click.option(
+    "-l",
+    "--limit",
+    type=int,
+    show_default=True,
+    default=0,
+    help="Number of posts to be embedded",
+)
+@click.option(
+    "--index",
+    is_flag=True,
+    help="(Re)build the coarse index, done automatically once the vectors outgrow RAM",
+)
+@click.option("--cells", type=click.IntRange(1), help="Cells of the coarse index")
+@click.option(
+    "-r", "--reset", is_flag=True, help="Start from scratch, deleting previous vectors"
+)
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def embed(db_path, limit, index, cells, reset):
+    "Compute the vectors of new posts, for finding similar posts"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    if reset:
+        embeddings.reset(db)
+        embeddings.ensure_tables(db)
+    sql = embeddings.PENDING_SQL + (f" limit {limit}" if limit else "")
+    count = utils.get_count(db, sql, {})
+    with click.progressbar(length=count) as bar:
+        embedded = embeddings.embed_posts(db, limit, progress=bar.update)
+    click.echo(f"{embedded} of {count} posts embedded")
+    if index or cells or embeddings.needs_index(db):
+        cells = embeddings.build_index(db, cells)
+        click.echo(f"{embeddings.row_count(db)} vectors indexed in {cells} cells")
+
+
+@cli.command()
+@click.option(
+    "-n",
+    "--number",
+    type=click.IntRange(1),
+    show_default=True,
+    default=10,
+    help="Number of similar posts to show",
+)
+@click.option(
+    "--probes",
+    type=click.IntRange(1),
+    show_default=True,
+    default=embeddings.PROBES,
+    help="Cells of the coarse index to search, more is slower but finds more",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("post_id", type=str, required=True)
+def similar(db_path, post_id, number, probes):
+    "Find the posts most similar in meaning to a post, by their vectors"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    key = keys.post_key(post_id) if "_" in post_id else int(post_id)
+    posts = embeddings.similar_posts(db.conn, key, number, probes)
+    if posts is None:
+        raise click.ClickException(
+            f"Post {post_id} has no vector, run `spevktator embed` first"
+        )
+    click.echo(
+        tabulate(
+            [
+                {
+                    "id": post["id"],
+                    "similarity": post["similarity"],
+                    "domain": post["domain"],
+                    "date_utc": post["date_utc"],
+                    "text": textwrap.shorten(post["text"], 80),
+                }
+                for post in posts
+            ],
+            headers="keys",
+        )
+    )
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def lemmatize(db_path):
+    "Store the lemmas of posts from before lemma search, or merged or published"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_fts(db)
+    count = db.execute(
+        "select count(*) from posts"
+        f" where key not in (select key from {lemmas.LEMMAS_TABLE})"
+    ).fetchone()[0]
+    with click.progressbar(length=count) as bar:
+        lemmatized = lemmas.fill(db, progress=bar.update)
+    fts.merge(db, lemmas.LEMMAS_TABLE)
+    click.echo(f"{lemmatized} posts lemmatized")
+
+
+@cli.command(name="search-posts")
+@click.option(
+    "-n",
+    "--number",
+    type=click.IntRange(1),
+    show_default=True,
+    default=20,
+    help="Number of posts to show",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("query", type=str, required=True)
+def search_posts(db_path, query, number):
+    "Find posts containing all words of the query, in any of their forms"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_fts(db)
+    click.echo(
+        tabulate(
+            [
+                {
+                    "id": post["id"],
+                    "domain": post["domain"],
+                    "date_utc": post["date_utc"],
+                    "text": textwrap.shorten(post["text"], 80),
+                }
+                for post in lemmas.search(db, query, number)
+            ],
+            headers="keys",
+        )
+    )
+
+
+@cli.command()
+@click.option(
+    "-f",
+    "--format",
+    "export_format",
+    type=click.Choice(export_.FORMATS),
+    help="Output format, guessed from the output file name by default",
+)
+@click.option(
+    "-c",
+    "--chunk-size",
+    type=click.IntRange(1),
+    show_default=True,
+    default=export_.DEFAULT_CHUNK_SIZE,
+    help="Number of posts read and written at a time",
+)
+@click.option(
+    "-i",
+    "--incremental",
+    metavar="NAME",
+    help="Only export posts changed since the previous export with this name",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "output",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def export(db_path, output, export_format, chunk_size, incremental):
+    "Export posts with metrics, sentiment, translation and entities to Parquet, Arrow or NDJSON"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+
+    try:
+        with click.progressbar(length=db["posts"].count, label="Exporting") as bar:
+            count = export_.export(
+                db,
+                output,
+                export_format,
+                chunk_size=chunk_size,
+                incremental=incremental,
+                progress=bar.update,
+            )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{count} posts exported to {output}")
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "shards",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    nargs=-1,
+    required=True,
+)
+def merge(db_path, shards):
+    "Merge the posts of shard databases, scraped by other nodes, into the given database"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_fts(db)
+    for shard in shards:
+        if os.path.abspath(shard) == os.path.abspath(db_path):
+            raise click.ClickException(f"Cannot merge {db_path} into itself")
+        started = time.perf_counter()
+        try:
+            result = merge_.merge(db, shard)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(
+            f"{shard}: {result.posts} new posts, {result.metrics} metrics updated,"
+            f" {result.enrichments} enrichments and {result.entities} new entities"
+            f" merged in {time.perf_counter() - started:.1f}s"
+        )
+    for table in fts.FTS_TABLES:
+        fts.merge(db, table)
+    storage.checkpoint(db)
+
+
+@cli.command(name="rollups")
+@click.option(
+    "-r",
+    "--rebuild",
+    is_flag=True,
+    help="Recompute the rollups of all days in the database, not only changed days",
+)
+@click.option(
+    "-t",
+    "--term",
+    "terms",
+    multiple=True,
+    help="Also count posts mentioning this term in English, implies --rebuild",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def refresh_rollups(db_path, rebuild, terms):
+    "Update the hourly, daily and weekly rollups used by the dashboards"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+
+    if terms:
+        rollups.add_terms(db, terms)
+    if rebuild or terms:
+        rollups.mark_all(db)
+    count = db[rollups.DIRTY_TABLE].count
+    with click.progressbar(length=count, label="Refreshing rollups") as bar:
+        count = rollups.refresh(db, progress=bar.update)
+    storage.checkpoint(db)
+    click.echo(f"Rollups of {count} days refreshed")
+
+
+@cli.group()
+def partition():
+    "Archive old posts into per-month partition databases"
+
+
+@partition.command(name="archive")
+@click.option(
+    "-k",
+    "--keep-months",
+    type=click.IntRange(0),
+    show_default=True,
+    default=2,
+    help="Number of recent months to keep in the main database",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def partition_archive(db_path, keep_months):
+    "Move old posts and their enrichments into sealed monthly partitions"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_fts(db)
+    # archived days keep their rollups, so bring them up-to-date first
+    rollups.refresh(db)
+
+    for month, moved in partitions.archive(db, db_path, keep_months):
+        click.echo(f"Partition {month}: {moved} posts archived")
+    storage.checkpoint(db, "truncate")
+
+
+@partition.command(name="list")
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def partition_list(db_path):
+    "Show the sealed partitions of the given database"
+
+    db = storage.open_database(db_path)
+    partitions.ensure_catalog(db)
+    rows = db.query(f"select * from {partitions.CATALOG_TABLE} order by month")
+    click.echo(tabulate(list(rows), headers="keys"))
+
+
+@cli.command(name="migrate-keys")
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def migrate_keys(db_path):
+    "Rebuild a database and its partitions with packed integer post keys"
+
+    db = storage.open_database(db_path)
+    if not keys.legacy(db):
+        click.echo("Database already uses packed post keys")
+        return
+    started = time.perf_counter()
+    click.echo("Migrating post tables...")
+    keys.migrate_tables(db)
+    # keyed by the old ids, ensure_tables starts them over (a full export follows)
+    with storage.writer(db):
+        for table in (
+            refresh.QUEUE_TABLE,
+            export_.WATERMARK_TABLE,
+            export_.CHANGES_TABLE,
+            export_.METRICS_CHANGES_TABLE,
+        ):
+            if db[table].exists():
+                db[table].drop()
+    partitions.ensure_catalog(db)
+    for month, path in sorted(partitions.catalog(db).items()):
+        click.echo(f"Migrating partition {month}...")
+        path = partitions.resolve(db_path, path)
+        partitions.set_writable(path, True)
+        partition = sqlite_utils.Database(path)
+        keys.migrate_tables(partition)
+        keys.ensure_tables(partition)
+        partition.close()
+        partitions.seal(path)
+    ensure_tables(db)
+    ensure_views(db)
+    ensure_fts(db)
+    click.echo("Compacting...")
+    storage.checkpoint(db, "truncate")
+    db.vacuum()
+    click.echo(f"Migrated in {time.perf_counter() - started:.1f}s")
+
+
+@cli.command()
+@click.option(
+    "-k",
+    "--keep",
+    type=(click.Choice(list(maintenance.RETENTION)), click.IntRange(0)),
+    multiple=True,
+    help="Days to keep the rows of a table, e.g. -k scrape_log 14",
+)
+@click.option(
+    "--budget",
+    type=click.FloatRange(0),
+    default=60,
+    show_default=True,
+    help="Seconds to spend at most on giving free pages back",
+)
+@click.option(
+    "--convert",
+    is_flag=True,
+    help="Switch a database created by an older version to incremental vacuum,"
+    " with one full VACUUM that blocks writers meanwhile",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def maintain(db_path, keep, budget, convert):
+    """
+    Delete expired rows, old raw pages move to cold storage, and give the
+    free pages back to the file system
+    """
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    days = {table: default for table, (_, default, _) in maintenance.RETENTION.items()}
+    days.update(keep)
+    for table, table_days in days.items():
+        count = maintenance.expire(db, table, table_days)
+        cold = " to cold storage" if maintenance.RETENTION[table][2] else ""
+        click.echo(f"{table}: {count} rows older than {table_days} days moved{cold}")
+    if convert and not maintenance.incremental(db):
+        click.echo("Converting to incremental vacuum...")
+        before = os.path.getsize(db_path)
+        maintenance.convert(db)
+        reclaimed = before - os.path.getsize(db_path)
+    elif not maintenance.incremental(db):
+        raise click.ClickException(
+            "The database does not use incremental vacuum, run once with --convert"
+        )
+    else:
+        reclaimed = maintenance.vacuum(db, budget)
+        storage.checkpoint(db, "truncate")
+    click.echo(
+        f"Reclaimed {reclaimed / 2**20:.1f} MB,"
+        f" {maintenance.free_bytes(db) / 2**20:.1f} MB still free"
+    )
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "directory",
+    type=click.Path(file_okay=False, dir_okay=True, allow_dash=False),
+    required=True,
+)
+def publish(db_path, directory):
+    "Write the changes since the previous publish to a directory, for `apply`"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    # replicas get the rollups as they are here
+    rollups.refresh(db)
+    result = publish_.publish(db, db_path, directory)
+    if not result.number:
+        click.echo("Nothing changed since the previous publish")
+        return
+    click.echo(
+        f"Changeset {result.number}: {result.posts} posts, {result.metrics} metrics,"
+        f" {result.entities} entities and {len(result.partitions)} partitions,"
+        f" {result.size / 2**20:.1f} MB"
+    )
+
+
+@cli.command(name="apply")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "directory",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, allow_dash=False),
+    required=True,
+)
+def apply_changesets(db_path, directory):
+    "Update a replica in place with the changesets published to a directory"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_views(db)
+    ensure_fts(db)
+
+    def applied(entry):
+        click.echo(
+            f"Changeset {entry['number']} applied: {entry['posts']} posts,"
+            f" {entry['metrics']} metrics"
+        )
+
+    entries = publish_.apply(db, db_path, directory, progress=applied)
+    if not entries:
+        click.echo("Replica is up-to-date")
+    storage.checkpoint(db)
+
+
+def mock_vk_options(fn):
+    "the options shaping the walls served by the mock VK server"
+    options = [
+        click.option(
+            "--posts",
+            type=click.IntRange(1),
+            show_default=True,
+            default=200,
+            help="Posts on each wall at the start",
+        ),
+        click.option(
+            "--new-posts",
+            type=click.FloatRange(0),
+            show_default=True,
+            default=0,
+            help="New posts per minute on each wall",
+        ),
+        click.option(
+            "--latency",
+            type=click.FloatRange(0),
+            show_default=True,
+            default=0.05,
+            help="Mean response time in seconds",
+        ),
+        click.option(
+            "--error-rate",
+            type=click.FloatRange(0, 1),
+            show_default=True,
+            default=0,
+            help="Fraction of requests answered by a server error",
+        ),
+        click.option(
+            "--rate-limit",
+            type=click.FloatRange(0),
+            show_default=True,
+            default=0,
+            help="Requests per second before answering 429, 0 for no limit",
+        ),
+        click.option(
+            "--fixture",
+            type=click.Path(exists=True, dir_okay=False),
+            show_default=True,
+            default=str(mock_vk.DEFAULT_FIXTURE),
+            help="Saved wall page the posts are generated from",
+        ),
+    ]
+    for option in reversed(options):
+        fn = option(fn)
+    return fn
+
+
+@cli.command(name="mock-vk")
+@click.option(
+    "-p",
+    "--port",
+    type=click.IntRange(0, 65535),
+    show_default=True,
+    default=mock_vk.DEFAULT_PORT,
+)
+@mock_vk_options
+@click.argument("domains", type=VK_DOMAIN, nargs=-1, required=True)
+def serve_mock_vk(domains, port, **options):
+    "Serve generated walls for the domains, a local stand-in for m.vk.com"
+
+    server = mock_vk.MockVK(port, domains, **options)
+    click.echo(
+        f"Serving {len(domains)} walls, scrape them with SPEVKTATOR_VK_URL={server.url}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stats = server.stats
+        click.echo(
+            f"{stats.requests} requests, {stats.pages} pages,"
+            f" {stats.errors} errors, {stats.limited} rate limited"
+        )
+
+
+@cli.command(name="synth")
+@click.option(
+    "-n",
+    "--posts",
+    type=click.IntRange(1, synth.MAX_POSTS),
+    show_default=True,
+    default=10_000,
+    help="Number of posts to generate",
+)
+@click.option(
+    "-d",
+    "--domain",
+    "domains",
+    type=VK_DOMAIN,
+    multiple=True,
+    help="Domain to generate posts for, defaults to the demo domains",
+)
+@click.option("--start", type=str, show_default=True, default=synth.DEFAULT_START)
+@click.option("--end", type=str, show_default=True, default=synth.DEFAULT_END)
+@click.option(
+    "--translated",
+    type=click.FloatRange(0, 1),
+    show_default=True,
+    default=0.8,
+    help="Fraction of posts with a translation",
+)
+@click.option("--seed", type=int, show_default=True, default=0)
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def synthesize(db_path, posts, domains, start, end, translated, seed):
+    "Generate a synthetic database of posts for scale testing"
+
+    db = storage.open_database(db_path)
+    if "posts" in db.table_names():
+        raise click.ClickException(f"Database {db_path} already contains posts")
+
+    synth.bulk_pragmas(db)
+    ensure_tables(db)
+    ensure_views(db)
+
+    domains = {domain: 1 for domain in domains} or None
+    started = time.perf_counter()
+    with click.progressbar(length=posts, label="Generating posts") as bar:
+        synth.synthesize(
+            db,
+            posts,
+            domains=domains,
+            start=start,
+            end=end,
+            translated=translated,
+            seed=seed,
+            progress=bar.update,
+        )
+    click.echo("Building full-text indexes...")
+    ensure_fts(db)
+    rollups.refresh(db)
+    db.execute("analyze")
+    synth.restore_pragmas(db)
+    db.close()
+    click.echo(f"{posts} posts generated in {time.perf_counter() - started:.1f}s")
+
+
+@cli.group()
+def bench():
+    "Benchmark the database and processing steps"
+
+
+@bench.command(name="queries")
+@click.option(
+    "-m",
+    "--metadata",
+    type=click.Path(exists=True, dir_okay=False),
+    show_default=True,
+    default="data/metadata.yml",
+    help="Datasette metadata with canned queries",
+)
+@click.option(
+    "-r",
+    "--repeat",
+    type=click.IntRange(1, 100),
+    show_default=True,
+    default=3,
+    help="Number of runs per query, the best time is reported",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def bench_queries(db_path, metadata, repeat):
+    "Time every view and canned query against the given database"
+
+    db = sqlite_utils.Database(db_path)
+    results = benchmark.run(db, benchmark.load_metadata(metadata), repeat=repeat)
+    click.echo(tabulate(results, headers="keys"))
+
+
+@bench.command(name="keys")
+@click.option(
+    "-r",
+    "--repeat",
+    type=click.IntRange(1, 100),
+    show_default=True,
+    default=3,
+    help="Number of runs per query, the best time is reported",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def bench_keys(db_path, repeat):
+    "Compare size and join speed of the post tables with string and packed keys"
+
+    db = storage.open_database(db_path)
+    click.echo(tabulate(benchmark.compare_keys(db, repeat=repeat), headers="keys"))
+
+
+@bench.command(name="ner")
+@click.option(
+    "-l",
+    "--limit",
+    type=click.IntRange(1),
+    show_default=True,
+    default=500,
+    help="Number of posts in the corpus, the first ones by key",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    type=click.IntRange(1),
+    show_default=True,
+    default=scraper.NER_BATCH_SIZE,
+    help="Posts per batch, as extract-named-entities sends them",
+)
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def bench_ner(db_path, limit, batch_size):
+    "Compare throughput and accuracy of the named-entity pipeline levels"
+
+    db = storage.open_database(db_path)
+    texts = [
+        row[0]
+        for row in db.execute(
+            "select text from posts where text != '' order by key limit ?", [limit]
+        )
+    ]
+    if not texts:
+        raise click.ClickException("No posts with text to benchmark on")
+    click.echo(f"Extracting named-entities of {len(texts)} posts at each level...")
+    click.echo(
+        tabulate(benchmark.ner_levels(texts, batch_size=batch_size), headers="keys")
+    )
+
+
+@bench.command(name="fetch")
+@click.option(
+    "-m",
+    "--mode",
+    type=click.Choice(["fetch", "listen", "backfill"]),
+    show_default=True,
+    default="fetch",
+    help="Command to load test",
+)
+@click.option(
+    "-d",
+    "--domains",
+    type=click.IntRange(1),
+    show_default=True,
+    default=4,
+    help="Number of walls",
+)
+@click.option(
+    "-l",
+    "--limit",
+    type=click.IntRange(1, 5000, clamp=True),
+    show_default=True,
+    default=scraper.DEFAULT_PAGE_LIMIT,
+    help="Number of pages to be requested per wall",
+)
+@click.option(
+    "--duration",
+    type=click.FloatRange(0),
+    show_default=True,
+    default=60,
+    help="Seconds to keep listening",
+)
+@mock_vk_options
+@click.option("-v", "--verbose", is_flag=True, help="Show the scraper output")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+def bench_fetch(db_path, mode, domains, limit, duration, verbose, **options):
+    "Load test fetch, listen or backfill against a local mock VK server"
+
+    db = storage.open_database(db_path)
+    ensure_tables(db)
+    ensure_views(db)
+    ensure_fts(db)
+    domains = [f"wall{i}" for i in range(domains)]
+    if mode != "listen":
+        options["new_posts"] = 0
+    server = mock_vk.MockVK(domains=domains, **options)
+
+    def run():
+        if mode == "listen":
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                listen_round(db, domains, limit, False, error_delay=mock_vk.RETRY_AFTER)
+            return
+        for domain in domains:
+            # as backfill does, continue after the posts we already have
+            offset = 0
+            if mode == "backfill":
+                offset = db["posts"].count_where("domain = ?", [domain])
+            scraper.fetch_domains(
+                db, [domain], False, limit, offset, error_delay=mock_vk.RETRY_AFTER
+            )
+        fts.merge(db, "posts")
+        rollups.refresh(db)
+        storage.checkpoint(db)
+
+    click.echo(f"Load testing {mode} of {len(domains)} walls at {server.url}...")
+    with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        result = benchmark.load_test(db, server, run)
+    click.echo(tabulate([result], headers="keys"))
+
+
+def ensure_tables(db):
+    if keys.legacy(db):
+        raise click.ClickException(
+            "This database uses string post keys, run `spevktator migrate-keys` first"
+        )
+    if "entity_types" not in db.table_names():
+        db["entity_types"].create(
+            {
+                "id": int,
+                "value": str,
+            },
+            pk="id",
+        )
+    if "entities" not in db.table_names():
+        db["entities"].create(
+            {"id": int, "name": str, "name_en": str, "type": int},
+            pk="id",
+            column_order=("id", "name", "name_en", "type"),
+            foreign_keys=[("type", "entity_types", "id")],
+        )
+    # for looking up entities by name, regardless of type
+    db["entities"].create_index(["name"], if_not_exists=True)
+    # for prefix searches, ignoring the case of Latin letters
+    for column in ("name", "name_en"):
+        db.execute(
+            f"create index if not exists idx_entities_{column}_nocase"
+            f" on entities ({column} collate nocase)"
+        )
+    # posts and their enrichments, keyed by packed integer keys
+    keys.ensure_tables(db)
+    text_cache.ensure_tables(db)
+    near_duplicates.ensure_tables(db)
+    embeddings.ensure_tables(db)
+    diagnostics.ensure_tables(db)
+    leases.ensure_tables(db)
+    if "scrape_log" not in db.table_names():
+        db["scrape_log"].create(
+            {
+                "domain": str,
+                "timestamp": str,
+                "url": str,
+                "status_code": int,
+                "html": str,
+            },
+        )
+    rollups.ensure_tables(db)
+    refresh.ensure_tables(db)
+    export_.ensure_tables(db)
+    events.ensure_tables(db)
+    merge_.ensure_tables(db)
+    publish_.ensure_tables(db)
+    storage.ensure_version_table(db)
+
+
+def ensure_views(db):
+    if "posts_metrics_view" not in db.view_names():
+        db.create_view(
+            "posts_metrics_view",
+            """
+        select posts.id, domain, date_utc, text, likes, shares, views
+        from posts join posts_metrics on posts.key = posts_metrics.key
+        order by likes desc
+        """,
+        )
+    if "posts_sentiment_view" not in db.view_names():
+        db.create_view(
             "posts_sentiment_view",
             """
         select posts.id, domain, date_utc, text, (positive - negative) as sentiment
-        from posts join posts_sentiment on posts.id = posts_sentiment.id
+        from posts join posts_sentiment on posts.key = posts_sentiment.key
         order by sentiment
         """,
         )
@@ -639,7 +2005,7 @@ def ensure_views(db):
             "posts_translation_view",
             """
         select posts.id, domain, date_utc, text, text_en
-        from posts left join posts_translation on posts.id = posts_translation.id
+        from posts left join posts_translation on posts.key = posts_translation.key
         order by date_utc desc
         """,
         )
@@ -652,9 +2018,9 @@ def ensure_views(db):
             (ps.positive - ps.negative) as sentiment
         from
             posts p
-            left join posts_metrics pm on p.id = pm.id
-            left join posts_sentiment ps on p.id = ps.id
-            left join posts_translation pt on p.id = pt.id
+            left join posts_metrics pm on p.key = pm.key
+            left join posts_sentiment ps on p.key = ps.key
+            left join posts_translation pt on p.key = pt.key
         where text != ''
         order by date_utc desc
         """,
@@ -669,14 +2035,45 @@ def ensure_views(db):
 
 
 def ensure_fts(db):
-    table_names = set(db.table_names())
-    if "posts" in table_names and "posts_fts" not in table_names:
-        db["posts"].enable_fts(["text"], create_triggers=True)
-
-    if (
-        "posts_translation" in table_names
-        and "posts_translation_fts" not in table_names
-    ):
-        db["posts_translation"].enable_fts(
-            ["text_en"], tokenize="porter", create_triggers=True
-        )
+    # finish a bulk load that was interrupted
+    fts.resume_triggers(db)
+
+    with storage.writer(db):
+        table_names = set(db.table_names())
+        if "posts" in table_names and "posts_fts" not in table_names:
+            db["posts"].enable_fts(["text"], create_triggers=True)
+            fts.set_automerge(db, "posts")
+
+        if (
+            "posts_translation" in table_names
+            and "posts_translation_fts" not in table_names
+        ):
+            db["posts_translation"].enable_fts(
+                ["text_en"], tokenize="porter", create_triggers=True
+            )
+            fts.set_automerge(db, "posts_translation")
+
+        # the lemmas of the posts, for search by any form of a word
+        if "posts_lemmas" in table_names and "posts_lemmas_fts" not in table_names:
+            db["posts_lemmas"].enable_fts(["lemmas"], create_triggers=True)
+            fts.set_automerge(db, "posts_lemmas")
+
+        # substring and fuzzy matching of entity names, in Russian and English
+        if (
+            "entities" in table_names
+            and "entities_fts" not in table_names
+            and fts.trigram_available()
+        ):
+            db["entities"].enable_fts(
+                ["name", "name_en"], tokenize="trigram", create_triggers=True
+            )
+            fts.set_automerge(db, "entities")
+
+        # substring search of posts and their translations
+        for table in fts.TRIGRAM_COLUMNS:
+            if (
+                db[f"{table}_fts"].exists()
+                and fts.trigram_table(table) not in table_names
+                and fts.trigram_available()
+            ):
+                fts.enable_trigram(db, table)
@@ -0,0 +1,181 @@
+import datetime
+import gc
+import json
+import os
+import signal
+import sys
+import time
+import tracemalloc
+
+import click
+import sqlite_utils
+
+import spevktator.storage as storage
+
+try:
+    import resource
+except ImportError:  # Windows, only the current resident set size is known
+    resource = None
+
+
+DIAGNOSTICS_TABLE = "listen_diagnostics"
+TOP_ALLOCATIONS = 10  # allocation sites recorded per snapshot
+# None on Windows, where allocations are not traced
+SNAPSHOT_SIGNAL = getattr(signal, "SIGUSR1", None)
+TRACE_FRAMES = 1  # enough to find the line, more makes tracing slower
+# the exit status of a listen worker over the memory limit, replaced right away
+RESTART_EXIT_STATUS = 75
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    if DIAGNOSTICS_TABLE not in db.table_names():
+        db[DIAGNOSTICS_TABLE].create(
+            {
+                "id": int,
+                "timestamp": str,
+                "pid": int,
+                "cycle": int,
+                "seconds": float,
+                "posts": int,
+                "rss_mb": float,
+                "peak_rss_mb": float,
+                "traced_mb": float,
+                "gc_objects": int,
+                "restart": int,
+                "allocations": str,
+            },
+            pk="id",
+        )
+
+
+def rss_mb():
+    "the resident set size of this process, the peak where there is no /proc"
+    try:
+        with open("/proc/self/statm") as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    "None where it is not known, which also disables the memory limit"
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def allocation_sites(snapshot, previous=None, top=TOP_ALLOCATIONS):
+    "the lines that allocated the most, or that grew the most since previous"
+    snapshot = snapshot.filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        )
+    )
+    if previous is None:
+        stats = snapshot.statistics("lineno")
+    else:
+        stats = snapshot.compare_to(previous, "lineno")
+    return snapshot, [
+        {
+            "where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "size_diff_kb": round(getattr(stat, "size_diff", stat.size) / 1024, 1),
+            "count": stat.count,
+        }
+        for stat in stats[:top]
+    ]
+
+
+def rounded(mb):
+    return None if mb is None else round(mb, 1)
+
+
+class Monitor:
+    """
+    Memory accounting of a long running command, one row per cycle.
+    SIGUSR1 starts tracing allocations, the next cycle records its top
+    allocation sites, and the cycle after the next SIGUSR1 the growth since,
+    which stops tracing again.
+    """
+
+    def __init__(self, db: sqlite_utils.Database, ceiling_mb=None):
+        self.db = db
+        self.ceiling_mb = ceiling_mb
+        self.cycle = 0
+        self.started = time.monotonic()
+        self.snapshot_requested = False
+        self.snapshot = None
+
+    def install(self):
+        "handle SNAPSHOT_SIGNAL, only sets a flag so it is safe at any point"
+        if SNAPSHOT_SIGNAL is not None:
+            signal.signal(SNAPSHOT_SIGNAL, self.request_snapshot)
+
+    def request_snapshot(self, signum=None, frame=None):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            # the first snapshot is taken at the end of this cycle
+            self.snapshot = None
+        self.snapshot_requested = True
+
+    def allocations(self):
+        if not self.snapshot_requested:
+            return None
+        self.snapshot_requested = False
+        previous = self.snapshot
+        self.snapshot, sites = allocation_sites(tracemalloc.take_snapshot(), previous)
+        if previous is not None:
+            # tracing slows every allocation down, keep it to the requested window
+            tracemalloc.stop()
+            self.snapshot = None
+        for site in sites:
+            click.echo(
+                f"{site['size_kb']:>10} KB {site['size_diff_kb']:>+10} KB"
+                f" {site['count']:>8} {site['where']}"
+            )
+        return json.dumps(sites)
+
+    def record(self, posts=0):
+        "account for the cycle just done, returns its row"
+        # parse trees and responses are cyclic garbage, collect before measuring
+        gc.collect()
+        self.cycle += 1
+        now = time.monotonic()
+        rss = rss_mb()
+        row = {
+            "timestamp": datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+            "pid": os.getpid(),
+            "cycle": self.cycle,
+            "seconds": round(now - self.started, 3),
+            "posts": posts,
+            "rss_mb": rounded(rss),
+            "peak_rss_mb": rounded(peak_rss_mb()),
+            "traced_mb": (
+                round(tracemalloc.get_traced_memory()[0] / 2**20, 1)
+                if tracemalloc.is_tracing()
+                else None
+            ),
+            "gc_objects": len(gc.get_objects()),
+            "restart": int(self.over_ceiling(rss)),
+            "allocations": self.allocations(),
+        }
+        self.started = now
+        with storage.writer(self.db):
+            self.db[DIAGNOSTICS_TABLE].insert(row)
+        return row
+
+    def over_ceiling(self, rss):
+        return None not in (self.ceiling_mb, rss) and rss > self.ceiling_mb
+
+
+def restart(db: sqlite_utils.Database):
+    "replace this process by a fresh one with the same arguments, releasing all memory"
+    storage.checkpoint(db)
+    db.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable, "-m", "spevktator"] + sys.argv[1:])
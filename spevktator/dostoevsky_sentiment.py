@@ -11,10 +11,20 @@ import fasttext
 fasttext.FastText.eprint = lambda x: None
 
 tokenizer = RegexTokenizer()
-try:
-    model = FastTextSocialNetworkModel(tokenizer=tokenizer)
-except ValueError:
-    model = None
+# loaded on first use, so commands that don't need it start fast
+model = None
+
+
+def installed():
+    return os.path.exists(FastTextSocialNetworkModel.MODEL_PATH)
+
+
+def load():
+    "the sentiment model, or None when it isn't installed"
+    global model
+    if model is None and installed():
+        model = FastTextSocialNetworkModel(tokenizer=tokenizer)
+    return model
 
 
 def download(model_filename="fasttext-social-network-model"):
@@ -30,7 +40,7 @@ def download(model_filename="fasttext-social-network-model"):
 
 
 def predict(text, k=-1):
-    if model is None:
+    if load() is None:
         raise ValueError("Model not installed")
     result = model.predict(text, k)
     return result
@@ -0,0 +1,290 @@
+import os
+import pathlib
+
+import numpy as np
+import sqlite_utils
+from sqlite_utils.utils import chunks
+
+import spevktator.models as models
+import spevktator.storage as storage
+
+
+ROWS_TABLE = "post_embeddings"
+CENTROIDS_TABLE = "embedding_centroids"
+DIM = 300  # of the NewsEmbedding word vectors
+DTYPE = np.dtype("<f2")  # half the size of float32, plenty for cosine similarity
+BATCH_SIZE = 500  # posts embedded at a time
+SCAN_ROWS = 65536  # matrix rows scored at a time, ~40 MB of float16
+INDEX_ROWS = 2_000_000  # from ~1.2 GB of vectors on, search only the nearest cells
+PROBES = 8  # cells searched per query
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 256  # training rows per cell
+
+# posts that have not been embedded yet, oldest first so rows follow the keys
+PENDING_SQL = f"""
+select key, text from posts
+where text != '' and key not in (select key from {ROWS_TABLE})
+order by key
+"""
+
+
+def matrix_path(db_path):
+    "the vectors live next to the database, in <name>.embeddings"
+    path = pathlib.Path(db_path)
+    return path.parent / f"{path.stem}.embeddings"
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    # the row of each post in the matrix, null for posts without known words
+    if ROWS_TABLE not in db.table_names():
+        db[ROWS_TABLE].create({"key": int, "row": int, "cell": int}, pk="key")
+        db[ROWS_TABLE].create_index(["row"], unique=True)
+        db[ROWS_TABLE].create_index(["cell"])
+    if CENTROIDS_TABLE not in db.table_names():
+        db[CENTROIDS_TABLE].create({"cell": int, "vector": bytes}, pk="cell")
+
+
+def row_count(conn):
+    "the number of rows in the matrix that are committed"
+    return conn.execute(
+        f"select coalesce(max(row) + 1, 0) from {ROWS_TABLE}"
+    ).fetchone()[0]
+
+
+def open_matrix(conn, rows=None):
+    "the committed rows of the matrix, memory-mapped read-only"
+    rows = row_count(conn) if rows is None else rows
+    if not rows:
+        return np.zeros((0, DIM), dtype=DTYPE)
+    path = matrix_path(storage.database_path(conn))
+    return np.memmap(path, dtype=DTYPE, mode="r", shape=(rows, DIM))
+
+
+def centroids(conn):
+    "the centroids of the coarse index as a cells x DIM array, or None without one"
+    rows = conn.execute(
+        f"select vector from {CENTROIDS_TABLE} order by cell"
+    ).fetchall()
+    if not rows:
+        return None
+    return np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+
+
+def normalized(vectors):
+    "unit vectors, so the dot product is the cosine similarity"
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def append(db: sqlite_utils.Database, keys, vectors):
+    """
+    Add the vectors of the posts with keys to the matrix, posts whose vector
+    is zero are recorded without a row. Returns the number of rows added.
+    """
+    found = np.linalg.norm(vectors, axis=1) > 0
+    vectors = normalized(vectors[found]).astype(DTYPE)
+    with storage.writer(db):
+        start = row_count(db)
+        with open(matrix_path(storage.database_path(db)), "ab") as fp:
+            # drop rows written by an append that was not committed
+            fp.truncate(start * DIM * DTYPE.itemsize)
+            fp.write(vectors.tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+        cells = assign(centroids(db), vectors)
+        placed = iter(
+            zip(
+                range(start, start + len(vectors)),
+                [None] * len(vectors) if cells is None else cells.tolist(),
+            )
+        )
+        db[ROWS_TABLE].insert_all(
+            dict(
+                zip(("row", "cell"), next(placed) if has_row else (None, None)), key=key
+            )
+            for key, has_row in zip(keys, found.tolist())
+        )
+    return len(vectors)
+
+
+def embed_posts(db: sqlite_utils.Database, limit=0, progress=None):
+    "embed the posts that have no vector yet, returns the number of posts embedded"
+    sql = PENDING_SQL + (f" limit {int(limit)}" if limit else "")
+    done = 0
+    for chunk in chunks(db.execute(sql).fetchall(), BATCH_SIZE):
+        chunk = list(chunk)
+        vectors = models.embed([text for _, text in chunk])
+        done += append(db, [key for key, _ in chunk], vectors)
+        if progress is not None:
+            progress(len(chunk))
+    return done
+
+
+def assign(cell_centroids, vectors):
+    "the nearest cell of each of the vectors, None without an index"
+    if cell_centroids is None:
+        return None
+    cells = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCAN_ROWS):
+        block = np.asarray(vectors[start : start + SCAN_ROWS], dtype=np.float32)
+        cells[start : start + len(block)] = (block @ cell_centroids.T).argmax(axis=1)
+    return cells
+
+
+def kmeans(matrix, cells, seed=0):
+    "spherical k-means centroids of a sample of the matrix rows"
+    rng = np.random.default_rng(seed)
+    size = min(len(matrix), cells * KMEANS_SAMPLE)
+    sample = np.sort(rng.choice(len(matrix), size=size, replace=False))
+    sample = np.asarray(matrix[sample], dtype=np.float32)
+    result = sample[rng.choice(len(sample), size=cells, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        nearest = (sample @ result.T).argmax(axis=1)
+        sums = np.zeros_like(result)
+        np.add.at(sums, nearest, sample)
+        # cells that lost all their rows keep their centroid
+        empty = ~sums.any(axis=1)
+        sums[empty] = result[empty]
+        result = normalized(sums)
+    return result
+
+
+def build_index(db: sqlite_utils.Database, cells=None):
+    """
+    Cluster the matrix into cells (about sqrt(rows) by default) and assign
+    every row to its nearest cell. Returns the number of cells.
+    """
+    matrix = open_matrix(db)
+    cells = min(cells or int(np.sqrt(len(matrix))), len(matrix))
+    if not cells:
+        return 0
+    cell_centroids = kmeans(matrix, cells)
+    with storage.writer(db):
+        # including the rows appended while clustering
+        nearest = assign(cell_centroids, open_matrix(db))
+        db.execute(f"delete from {CENTROIDS_TABLE}")
+        db[CENTROIDS_TABLE].insert_all(
+            {"cell": cell, "vector": vector.tobytes()}
+            for cell, vector in enumerate(cell_centroids)
+        )
+        db.conn.executemany(
+            f"update {ROWS_TABLE} set cell = ? where row = ?",
+            [(cell, row) for row, cell in enumerate(nearest.tolist())],
+        )
+    return cells
+
+
+def needs_index(db: sqlite_utils.Database):
+    "has the matrix outgrown a full scan, without a coarse index yet?"
+    return row_count(db) >= INDEX_ROWS and centroids(db) is None
+
+
+def top(rows, scores, k):
+    "the k (row, score) pairs with the highest scores, best first"
+    if len(scores) > k:
+        best = np.argpartition(-scores, k)[:k]
+        rows, scores = rows[best], scores[best]
+    order = np.argsort(-scores, kind="stable")
+    return rows[order], scores[order]
+
+
+def scan(matrix, query, k, rows=None):
+    "the k most similar rows of the matrix, of only rows when given, scored in blocks"
+    best_rows = np.zeros(0, dtype=np.int64)
+    best_scores = np.zeros(0, dtype=np.float32)
+    total = len(matrix) if rows is None else len(rows)
+    for start in range(0, total, SCAN_ROWS):
+        if rows is None:
+            block_rows = np.arange(start, min(start + SCAN_ROWS, total))
+            block = matrix[start : start + SCAN_ROWS]
+        else:
+            block_rows = rows[start : start + SCAN_ROWS]
+            block = matrix[block_rows]
+        scores = np.asarray(block, dtype=np.float32) @ query
+        best_rows, best_scores = top(
+            np.concatenate((best_rows, block_rows)),
+            np.concatenate((best_scores, scores)),
+            k,
+        )
+    return best_rows, best_scores
+
+
+def search(conn, query, k=10, probes=PROBES):
+    """
+    The keys and cosine similarities of the k posts most similar to the query
+    vector, only looking in the nearest cells when there is a coarse index
+    """
+    query = normalized(np.asarray(query, dtype=np.float32)[None, :])[0]
+    matrix = open_matrix(conn)
+    cell_centroids = centroids(conn)
+    rows = None
+    if cell_centroids is not None:
+        cells = top(np.arange(len(cell_centroids)), cell_centroids @ query, probes)[0]
+        rows = np.array(
+            [
+                row[0]
+                for row in conn.execute(
+                    f"select row from {ROWS_TABLE} where cell in"
+                    f" ({', '.join('?' * len(cells))}) and row < ? order by row",
+                    [int(cell) for cell in cells] + [len(matrix)],
+                )
+            ],
+            dtype=np.int64,
+        )
+    rows, scores = scan(matrix, query, k, rows)
+    by_row = dict(
+        conn.execute(
+            f"select row, key from {ROWS_TABLE} where row in"
+            f" ({', '.join('?' * len(rows))})",
+            [int(row) for row in rows],
+        ).fetchall()
+    )
+    return [(by_row[int(row)], float(score)) for row, score in zip(rows, scores)]
+
+
+def similar(conn, key, k=10, probes=PROBES):
+    """
+    The k posts most similar to the post with key, as (key, similarity)
+    pairs, or None when the post has no vector
+    """
+    row = conn.execute(f"select row from {ROWS_TABLE} where key = ?", [key]).fetchone()
+    if row is None or row[0] is None:
+        return None
+    matrix = open_matrix(conn)
+    results = search(conn, matrix[row[0]], k + 1, probes)
+    return [(other, score) for other, score in results if other != key][:k]
+
+
+def similar_posts(conn, key, k=10, probes=PROBES):
+    """
+    The k posts most similar to the post with key, as dicts with their key,
+    id, domain, date_utc, text and similarity, or None without a vector
+    """
+    results = similar(conn, key, k, probes)
+    if results is None:
+        return None
+    columns = ("key", "id", "domain", "date_utc", "text")
+    posts = {
+        row[0]: dict(zip(columns, row))
+        for row in conn.execute(
+            f"select {', '.join(columns)} from posts"
+            f" where key in ({', '.join('?' * len(results))})",
+            [other for other, _ in results],
+        )
+    }
+    # posts archived since are left out
+    return [
+        dict(posts[other], similarity=round(score, 4))
+        for other, score in results
+        if other in posts
+    ]
+
+
+def reset(db: sqlite_utils.Database):
+    "forget all vectors"
+    with storage.writer(db):
+        db[ROWS_TABLE].drop(True)
+        db[CENTROIDS_TABLE].drop(True)
+        path = matrix_path(storage.database_path(db))
+        if path.exists():
+            path.unlink()
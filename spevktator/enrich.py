@@ -0,0 +1,533 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import click
+import deepl
+import sqlite_utils
+
+import spevktator.lemmas as lemmas
+import spevktator.models as models
+import spevktator.storage as storage
+import spevktator.text_cache as text_cache
+
+
+QUEUE_SIZE = 500  # posts waiting between two stages, upstream blocks when full
+WRITE_BATCH_SIZE = 200  # posts written per transaction
+BATCH_WAIT = 0.05  # seconds a stage waits to fill up a batch
+MAX_TRANSLATION_LENGTH = 2500  # characters, longer posts are not translated
+_DONE = object()
+
+
+class Stage:
+    """
+    One enrichment step, run by `workers` threads on batches of up to
+    `batch_size` posts. `condition` selects the posts that still need it.
+    """
+
+    name = None
+    condition = None
+    batch_size = 50
+    workers = 1
+
+    def __init__(self, batch_size=None, workers=None):
+        self.batch_size = batch_size or self.batch_size
+        self.workers = workers or self.workers
+        self.posts = self.batches = 0
+        # posts that got the result of an equal text in their batch
+        self.reused = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def flag(self):
+        return "needs_" + self.name.replace("-", "_")
+
+    def needs(self, post):
+        return post[self.flag]
+
+    def process(self, posts):
+        raise NotImplementedError
+
+    def run(self, posts):
+        "process the posts of the batch that need this stage, and keep the stats"
+        todo = [post for post in posts if self.needs(post)]
+        if not todo:
+            return
+        started = time.perf_counter()
+        self.process(todo)
+        with self.lock:
+            self.posts += len(todo)
+            self.batches += 1
+            self.seconds += time.perf_counter() - started
+
+
+def unique_texts(stage, posts):
+    "the distinct texts of the posts, equal texts go through the model once"
+    texts = list(dict.fromkeys(post["text"] for post in posts))
+    with stage.lock:
+        stage.reused += len(posts) - len(texts)
+    return texts
+
+
+class SentimentStage(Stage):
+    name = "sentiment"
+    condition = "p.key not in (select key from posts_sentiment)"
+    batch_size = 100
+
+    def process(self, posts):
+        texts = unique_texts(self, posts)
+        predictions = dict(zip(texts, models.predict_sentiment(texts)))
+        for post in posts:
+            post["sentiment"] = predictions[post["text"]]
+
+
+class EntitiesStage(Stage):
+    name = "entities"
+    condition = "p.key not in (select key from posts_entities_done)"
+    batch_size = 16
+
+    def __init__(self, batch_size=None, workers=None, level=None):
+        super().__init__(batch_size, workers)
+        self.level = level
+
+    def process(self, posts):
+        texts = unique_texts(self, posts)
+        results = dict(zip(texts, models.named_entities(texts, level=self.level)))
+        lemmatized = dict(zip(texts, models.lemmatize(texts)))
+        for post in posts:
+            post["entities"] = results[post["text"]]
+            post["lemmas"] = lemmatized[post["text"]]
+
+
+class TranslationStage(Stage):
+    "DeepL translation, batches that fail are left for the next run"
+
+    workers = 2
+
+    def __init__(self, deepl_auth_key, batch_size=None, workers=None):
+        super().__init__(batch_size, workers)
+        self.translator = deepl.Translator(deepl_auth_key)
+        self.errors = 0
+
+    def translate(self, texts):
+        try:
+            result = self.translator.translate_text(
+                texts, source_lang="RU", target_lang="EN-US"
+            )
+        except deepl.exceptions.DeepLException as e:
+            click.secho(f"DeepL API throws error: {e}", fg="red")
+            with self.lock:
+                self.errors += 1
+            return None
+        return [item.text for item in result]
+
+
+class EntityTranslationStage(TranslationStage):
+    name = "translate-entities"
+    condition = """p.key in (
+        select pe.key from posts_entities pe join entities e on e.id = pe.entity
+        where e.name != '' and (e.name_en = '' or e.name_en is null)
+    )"""
+    batch_size = 50
+
+    def __init__(self, db_path, deepl_auth_key, batch_size=None, workers=None):
+        super().__init__(deepl_auth_key, batch_size, workers)
+        self.db_path = db_path
+        self.local = threading.local()
+        self.translated = {}  # name: name_en, during this run
+
+    def conn(self):
+        "a read connection per worker thread"
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.db_path)
+        return self.local.conn
+
+    def needs(self, post):
+        return post[self.flag] or bool(post.get("entities"))
+
+    def names(self, post):
+        "names of the post's entities that have no translation yet"
+        names = {entity["normal"] for entity in post.get("entities") or []}
+        if post[self.flag]:
+            names.update(
+                row[0]
+                for row in self.conn().execute(
+                    "select e.name from posts_entities pe"
+                    " join entities e on e.id = pe.entity where pe.key = ?"
+                    " and (e.name_en = '' or e.name_en is null)",
+                    [post["key"]],
+                )
+            )
+        names.discard("")
+        return names
+
+    def process(self, posts):
+        names = {post["key"]: self.names(post) for post in posts}
+        missing = sorted(set().union(*names.values()) - set(self.translated))
+        if missing:
+            known = {
+                row[0]
+                for row in self.conn().execute(
+                    "select name from entities where name_en != ''"
+                    " and name in (select value from json_each(?))",
+                    [json.dumps(missing)],
+                )
+            }
+            missing = [name for name in missing if name not in known]
+        if missing:
+            translations = self.translate(missing)
+            if translations is None:
+                return
+            with self.lock:
+                self.translated.update(zip(missing, translations))
+        for post in posts:
+            post["names_en"] = {
+                name: self.translated[name]
+                for name in names[post["key"]]
+                if name in self.translated
+            }
+
+
+class PostTranslationStage(TranslationStage):
+    name = "translate-posts"
+    condition = (
+        f"length(p.text) <= {MAX_TRANSLATION_LENGTH}"
+        " and p.key not in (select key from posts_translation)"
+    )
+    batch_size = 10
+
+    def process(self, posts):
+        translations = self.translate([post["text"] for post in posts])
+        if translations is None:
+            return
+        for post, text_en in zip(posts, translations):
+            post["text_en"] = text_en
+
+
+STAGES = ("sentiment", "entities", "translate-entities", "translate-posts")
+
+
+def pending_sql(stages, limit=None):
+    "posts with text that still need any of the stages, newest first"
+    flags = ", ".join(f"{stage.condition} as {stage.flag}" for stage in stages)
+    conditions = " or ".join(f"({stage.condition})" for stage in stages)
+    sql = (
+        f"select p.key, p.text, {flags} from posts p"
+        f" where p.text != '' and ({conditions}) order by p.date_utc desc"
+    )
+    if limit:
+        sql += f" limit {int(limit)}"
+    return sql
+
+
+def undone(db: sqlite_utils.Database, posts):
+    "the posts whose entities are not stored yet, another run may have done some since"
+    done = {
+        row[0]
+        for row in db.execute(
+            "select key from posts_entities_done"
+            " where key in (select value from json_each(?))",
+            [json.dumps([post["key"] for post in posts])],
+        )
+    }
+    return [post for post in posts if post["key"] not in done]
+
+
+def write(db: sqlite_utils.Database, posts):
+    "store the enrichments of a batch of posts in one transaction"
+    with storage.writer(db):
+        sentiments = [
+            dict(post["sentiment"], key=post["key"])
+            for post in posts
+            if "sentiment" in post
+        ]
+        if sentiments:
+            db["posts_sentiment"].insert_all(
+                sentiments,
+                pk="key",
+                column_order=(
+                    "key",
+                    "positive",
+                    "negative",
+                    "neutral",
+                    "skip",
+                    "speech",
+                ),
+                foreign_keys=[("key", "posts")],
+                replace=True,
+            )
+            text_cache.store_sentiment(db, [row["key"] for row in sentiments])
+
+        entity_posts = undone(db, [post for post in posts if "entities" in post])
+
+        for post in entity_posts:
+            db["posts_entities"].insert_all(
+                {
+                    "key": post["key"],
+                    "entity": db["entities"].lookup(
+                        {
+                            "type": db["entity_types"].lookup(
+                                {"value": entity["type"]}
+                            ),
+                            "name": entity["normal"],
+                        }
+                    ),
+                    "begin_offset": entity["start"],
+                    "end_offset": entity["stop"],
+                }
+                for entity in post["entities"]
+            )
+            db["posts_entities_done"].insert(
+                {"key": post["key"]}, pk="key", foreign_keys=[("key", "posts", "key")]
+            )
+        text_cache.store_entities(db, [post["key"] for post in entity_posts])
+        lemmas.insert(
+            db,
+            (
+                {"key": post["key"], "lemmas": post["lemmas"]}
+                for post in posts
+                if "lemmas" in post
+            ),
+        )
+
+        for post in posts:
+            for name, name_en in (post.get("names_en") or {}).items():
+                db.execute(
+                    "update entities set name_en = ? where name = ?"
+                    " and (name_en = '' or name_en is null)",
+                    [name_en, name],
+                )
+
+        translations = [
+            {"key": post["key"], "text_en": post["text_en"]}
+            for post in posts
+            if "text_en" in post
+        ]
+        if translations:
+            db["posts_translation"].insert_all(
+                translations,
+                pk="key",
+                column_order=("key", "text_en"),
+                foreign_keys=[("key", "posts")],
+                replace=True,
+            )
+
+
+class Pipeline:
+    """
+    Streams pending posts through the stages, each on its own threads,
+    connected by bounded queues. The calling thread is the single writer
+    and commits every batch, so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(
+        self,
+        db: sqlite_utils.Database,
+        stages,
+        limit=None,
+        write_batch_size=WRITE_BATCH_SIZE,
+        queue_size=QUEUE_SIZE,
+    ):
+        self.db = db
+        self.db_path = storage.database_path(db)
+        self.stages = stages
+        self.sql = pending_sql(stages, limit)
+        self.write_batch_size = write_batch_size
+        self.queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+        self.error = None
+        self.written = 0
+        self.write_seconds = 0.0
+        self.copied = None
+
+    def copy_cached(self):
+        "give the posts of this run with a text enriched before a copy of its results, once"
+        if self.copied is None:
+            self.copied = 0
+            names = {stage.name for stage in self.stages}
+            # the posts pending now, the copies take them out of the pending ones
+            params = {
+                "keys": json.dumps(
+                    [row[0] for row in self.db.execute(f"select key from ({self.sql})")]
+                )
+            }
+            run_keys = "select value from json_each(:keys)"
+            if "sentiment" in names:
+                self.copied += text_cache.copy_sentiment(self.db, run_keys, params)
+            if "entities" in names:
+                self.copied += text_cache.copy_entities(self.db, run_keys, params)
+                # the stage lemmatizes the posts it does, these got their entities copied
+                lemmas.fill(
+                    self.db,
+                    f"select key from posts_entities_done where key in ({run_keys})",
+                    params,
+                )
+        return self.copied
+
+    def count(self):
+        return self.db.execute(f"select count(*) from ({self.sql})").fetchone()[0]
+
+    def source(self, outbox):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            for row in conn.execute(self.sql):
+                if self.error is not None:
+                    break
+                outbox.put(dict(row))
+        except Exception as e:
+            self.error = e
+        finally:
+            conn.close()
+            outbox.put(_DONE)
+
+    def take(self, inbox, size):
+        "a batch of up to size posts, and whether upstream is done"
+        item = inbox.get()
+        if item is _DONE:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + BATCH_WAIT
+        while len(batch) < size:
+            try:
+                item = inbox.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def worker(self, stage, inbox, outbox, remaining):
+        done = False
+        while not done:
+            batch, done = self.take(inbox, stage.batch_size)
+            if batch and self.error is None:
+                try:
+                    stage.run(batch)
+                except Exception as e:
+                    self.error = e
+            for post in batch:
+                outbox.put(post)
+        # let the other workers of this stage see the end as well
+        inbox.put(_DONE)
+        with stage.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            outbox.put(_DONE)
+
+    def start(self):
+        "start the source and stage threads, returns them"
+        threads = [threading.Thread(target=self.source, args=(self.queues[0],))]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self.worker,
+                        args=(stage, self.queues[i], self.queues[i + 1], remaining),
+                    )
+                )
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def run(self, progress=None):
+        "enrich all pending posts, returns the number of posts written"
+        self.copy_cached()
+        threads = self.start()
+        outbox = self.queues[-1]
+        done = False
+        while not done:
+            batch, done = self.take(outbox, self.write_batch_size)
+            if batch and self.error is None:
+                started = time.perf_counter()
+                try:
+                    write(self.db, batch)
+                except Exception as e:
+                    # keep draining, so the other threads can finish
+                    self.error = e
+                    continue
+                self.write_seconds += time.perf_counter() - started
+                self.written += len(batch)
+                if progress is not None:
+                    progress(len(batch))
+        for thread in threads:
+            thread.join()
+        for stage in self.stages:
+            if stage.name in ("sentiment", "entities"):
+                text_cache.record(
+                    self.db,
+                    stage.name,
+                    hits=stage.reused,
+                    misses=stage.posts - stage.reused,
+                )
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+    def report(self, elapsed):
+        "throughput per stage, as rows for tabulate"
+        rows = [
+            {
+                "stage": stage.name,
+                "workers": stage.workers,
+                "batch size": stage.batch_size,
+                "posts": stage.posts,
+                "batches": stage.batches,
+                "busy s": round(stage.seconds, 1),
+                "posts/s": round(stage.posts / stage.seconds, 1)
+                if stage.seconds
+                else None,
+            }
+            for stage in self.stages
+        ]
+        rows.append(
+            {
+                "stage": "write",
+                "workers": 1,
+                "batch size": self.write_batch_size,
+                "posts": self.written,
+                "busy s": round(self.write_seconds, 1),
+                "posts/s": round(self.written / elapsed, 1) if elapsed else None,
+            }
+        )
+        return rows
+
+
+def build_stages(
+    db_path,
+    deepl_auth_key=None,
+    skip=(),
+    batch_sizes=None,
+    workers=None,
+    ner_level=None,
+):
+    "the stages that can run here, in pipeline order"
+    batch_sizes = batch_sizes or {}
+    workers = workers or {}
+    stages = []
+
+    def options(name):
+        return {"batch_size": batch_sizes.get(name), "workers": workers.get(name)}
+
+    if "sentiment" not in skip and models.sentiment_available():
+        stages.append(SentimentStage(**options("sentiment")))
+    if "entities" not in skip:
+        stages.append(EntitiesStage(level=ner_level, **options("entities")))
+    if deepl_auth_key:
+        if "translate-entities" not in skip:
+            stages.append(
+                EntityTranslationStage(
+                    db_path, deepl_auth_key, **options("translate-entities")
+                )
+            )
+        if "translate-posts" not in skip:
+            stages.append(
+                PostTranslationStage(deepl_auth_key, **options("translate-posts"))
+            )
+    return stages
@@ -0,0 +1,85 @@
+import json
+
+import sqlite_utils
+
+import spevktator.post_detail as post_detail
+
+
+EVENTS_TABLE = "post_events"
+BATCH_SIZE = 200  # events read at a time
+POLL_INTERVAL = 0.2  # seconds between looking for new events when following
+STREAM_TIMEOUT = 300  # seconds, after which a streaming client reconnects
+KEEPALIVE = 15  # seconds without events before sending a comment
+
+# the tables whose new rows are events, by the kind of event
+KINDS = {
+    "posts": "post",
+    "posts_sentiment": "sentiment",
+    "posts_translation": "translation",
+    "posts_entities_done": "entities",
+}
+
+# the events of a batch, one per post with the kinds of all its events
+READ_SQL = f"""
+select key, max(seq) as seq, group_concat(distinct kind) as kinds
+from (
+    select seq, key, kind from {EVENTS_TABLE}
+    where seq > :after order by seq limit :limit
+)
+group by key
+order by seq
+"""
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    # autoincrement, so a seq is never handed out twice and cursors stay valid
+    db.execute(
+        f"""
+        create table if not exists {EVENTS_TABLE} (
+            seq integer primary key autoincrement,
+            key integer not null,
+            kind text not null,
+            at text not null default (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
+        )
+        """
+    )
+    # written by the same statement, so in the same transaction, as the row
+    for table, kind in KINDS.items():
+        db.execute(
+            f"""
+            create trigger if not exists {table}_events_ai after insert on {table} begin
+                insert into {EVENTS_TABLE} (key, kind) values (new.key, '{kind}');
+            end
+            """
+        )
+
+
+def latest(conn):
+    "the seq of the most recent event, 0 when there are none"
+    return conn.execute(f"select coalesce(max(seq), 0) from {EVENTS_TABLE}").fetchone()[
+        0
+    ]
+
+
+def read(conn, after, domains=None, limit=BATCH_SIZE):
+    """
+    (cursor, events) of up to limit events after the cursor after, as
+    {seq, kinds, post} dicts with the current state of each post
+    """
+    rows = conn.execute(READ_SQL, {"after": after, "limit": limit}).fetchall()
+    events = []
+    for key, seq, kinds in rows:
+        post = post_detail.fetch(conn, key)
+        # archived since, or from another domain
+        if post is None or (domains and post["domain"] not in domains):
+            continue
+        events.append({"seq": seq, "kinds": kinds.split(","), "post": post})
+    return max([after] + [row[1] for row in rows]), events
+
+
+def server_sent(event):
+    "the event in the text/event-stream format"
+    data = json.dumps(
+        {"kinds": event["kinds"], "post": event["post"]}, ensure_ascii=False
+    )
+    return f"id: {event['seq']}\nevent: post\ndata: {data}\n\n"
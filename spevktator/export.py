@@ -0,0 +1,308 @@
+import datetime
+import gzip
+import json
+
+import sqlite_utils
+
+import spevktator.storage as storage
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = ("parquet", "arrow", "ndjson")
+DEFAULT_CHUNK_SIZE = 10_000
+WATERMARK_TABLE = "export_watermarks"
+CHANGES_TABLE = "export_changes"
+METRICS_CHANGES_TABLE = "export_metrics_changes"
+
+# tables whose new rows make a post part of an incremental export
+TRACKED_TABLES = (
+    "posts",
+    "posts_sentiment",
+    "posts_translation",
+    "posts_entities_done",
+    "posts_lemmas",
+)
+
+EXPORT_SQL = """
+select
+    p.key as _key, p.id, p.domain, p.date_utc, p.text, pt.text_en,
+    pm.likes, pm.shares, pm.views, pm.timestamp as metrics_timestamp,
+    ps.positive, ps.negative, ps.neutral, ps.skip, ps.speech,
+    (ps.positive - ps.negative) as sentiment,
+    (
+        select json_group_array(
+            json_object(
+                'name', e.name, 'name_en', e.name_en, 'type', et.value,
+                'begin_offset', pe.begin_offset, 'end_offset', pe.end_offset
+            )
+        )
+        from posts_entities pe
+        join entities e on e.id = pe.entity
+        join entity_types et on et.id = e.type
+        where pe.key = p.key
+    ) as entities
+from
+    posts p
+    left join posts_metrics pm on p.key = pm.key
+    left join posts_sentiment ps on p.key = ps.key
+    left join posts_translation pt on p.key = pt.key
+where p.key > :after and ({changed})
+order by p.key
+limit :chunk_size
+"""
+
+
+def arrow_schema():
+    entity = pyarrow.struct(
+        [
+            ("name", pyarrow.string()),
+            ("name_en", pyarrow.string()),
+            ("type", pyarrow.string()),
+            ("begin_offset", pyarrow.int32()),
+            ("end_offset", pyarrow.int32()),
+        ]
+    )
+    return pyarrow.schema(
+        [
+            ("id", pyarrow.string()),
+            ("domain", pyarrow.string()),
+            ("date_utc", pyarrow.timestamp("s")),
+            ("text", pyarrow.string()),
+            ("text_en", pyarrow.string()),
+            ("likes", pyarrow.int64()),
+            ("shares", pyarrow.int64()),
+            ("views", pyarrow.int64()),
+            ("metrics_timestamp", pyarrow.timestamp("s")),
+            ("positive", pyarrow.float64()),
+            ("negative", pyarrow.float64()),
+            ("neutral", pyarrow.float64()),
+            ("skip", pyarrow.float64()),
+            ("speech", pyarrow.float64()),
+            ("sentiment", pyarrow.float64()),
+            ("entities", pyarrow.list_(entity)),
+        ]
+    )
+
+
+def format_for(path):
+    "guess the export format from the output file name"
+    name = str(path).lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith(".parquet"):
+        return "parquet"
+    if name.endswith((".arrow", ".feather", ".ipc")):
+        return "arrow"
+    return "ndjson"
+
+
+class NDJSONWriter:
+    def __init__(self, path):
+        opener = gzip.open if str(path).endswith(".gz") else open
+        self.fp = opener(path, "wt", encoding="utf-8")
+
+    def write(self, rows):
+        for row in rows:
+            self.fp.write(json.dumps(row, ensure_ascii=False))
+            self.fp.write("\n")
+
+    def close(self):
+        self.fp.close()
+
+
+class ArrowWriter:
+    def __init__(self, path, parquet=False):
+        self.schema = arrow_schema()
+        if parquet:
+            self.writer = pyarrow.parquet.ParquetWriter(
+                path, self.schema, compression="zstd"
+            )
+        else:
+            self.writer = pyarrow.ipc.new_file(str(path), self.schema)
+
+    def write(self, rows):
+        for row in rows:
+            for column in ("date_utc", "metrics_timestamp"):
+                if row[column]:
+                    row[column] = datetime.datetime.fromisoformat(row[column])
+        batch = pyarrow.RecordBatch.from_pylist(rows, schema=self.schema)
+        if isinstance(self.writer, pyarrow.parquet.ParquetWriter):
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(path, export_format):
+    if export_format == "ndjson":
+        return NDJSONWriter(path)
+    if pyarrow is None:
+        raise ValueError(
+            f"Exporting to {export_format} requires pyarrow, run `pip install pyarrow`"
+            " or export to ndjson"
+        )
+    return ArrowWriter(path, parquet=export_format == "parquet")
+
+
+def ensure_metrics_changes(db: sqlite_utils.Database):
+    """
+    Log the posts whose metrics changed in the order they were written, the
+    fetch timestamps of the metrics are not. Posts from before the log are
+    entered in the order of those timestamps.
+    """
+    if METRICS_CHANGES_TABLE not in db.table_names():
+        db[METRICS_CHANGES_TABLE].create({"key": int, "seq": int}, pk="key")
+        db[METRICS_CHANGES_TABLE].create_index(["seq"])
+        if db["posts_metrics"].exists():
+            db.execute(
+                f"insert into {METRICS_CHANGES_TABLE} (key, seq)"
+                " select key, row_number() over (order by timestamp, key)"
+                " from posts_metrics"
+            )
+    for event, suffix in (("insert", "ai"), ("update", "au")):
+        db.execute(
+            f"""
+            create trigger if not exists posts_metrics_export_{suffix}
+            after {event} on posts_metrics begin
+                delete from {METRICS_CHANGES_TABLE} where key = new.key;
+                insert into {METRICS_CHANGES_TABLE} (key, seq) values (
+                    new.key,
+                    (select coalesce(max(seq), 0) + 1 from {METRICS_CHANGES_TABLE})
+                );
+            end
+            """
+        )
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    if WATERMARK_TABLE not in db.table_names():
+        db[WATERMARK_TABLE].create(
+            {"name": str, "seq": int, "metrics_seq": int, "exported_at": str},
+            pk="name",
+        )
+    elif "metrics_seq" not in db[WATERMARK_TABLE].columns_dict:
+        db[WATERMARK_TABLE].add_column("metrics_seq", int)
+    if CHANGES_TABLE not in db.table_names():
+        # the last change of each post, post keys say nothing about insertion order
+        db[CHANGES_TABLE].create({"key": int, "seq": int}, pk="key")
+        db[CHANGES_TABLE].create_index(["seq"])
+    ensure_metrics_changes(db)
+    for table in TRACKED_TABLES:
+        # delete and insert, an insert or ignore into the table would turn an
+        # insert or replace into an ignore and keep the old seq
+        trigger = db.execute(
+            "select sql from sqlite_master where type = 'trigger' and name = ?",
+            [f"{table}_export_ai"],
+        ).fetchone()
+        if trigger and "insert or replace" in trigger[0]:
+            db.execute(f"drop trigger {table}_export_ai")
+        db.execute(
+            f"""
+            create trigger if not exists {table}_export_ai after insert on {table} begin
+                delete from {CHANGES_TABLE} where key = new.key;
+                insert into {CHANGES_TABLE} (key, seq) values (
+                    new.key, (select coalesce(max(seq), 0) + 1 from {CHANGES_TABLE})
+                );
+            end
+            """
+        )
+
+
+def current_watermark(db: sqlite_utils.Database, schema="main"):
+    "(changes seq, metrics changes seq) of the database"
+    return tuple(
+        db.execute(f"select coalesce(max(seq), 0) from {schema}.{table}").fetchone()[0]
+        for table in (CHANGES_TABLE, METRICS_CHANGES_TABLE)
+    )
+
+
+def mark_metrics_seq(db: sqlite_utils.Database, mark, schema="main"):
+    """
+    The metrics changes seq of a stored watermark. Watermarks from before
+    the log hold the newest fetch timestamp instead, which maps to the posts
+    the log was started with.
+    """
+    if mark.get("metrics_seq") is not None:
+        return mark["metrics_seq"]
+    return db.execute(
+        f"select coalesce(max(c.seq), 0) from {schema}.{METRICS_CHANGES_TABLE} c"
+        f" join {schema}.posts_metrics pm on pm.key = c.key where pm.timestamp <= ?",
+        [mark.get("metrics_timestamp") or ""],
+    ).fetchone()[0]
+
+
+def changed_since(db: sqlite_utils.Database, name):
+    "SQL condition and params selecting posts changed since the named export"
+    mark = next(
+        db.query(f"select * from {WATERMARK_TABLE} where name = ?", [name]), None
+    )
+    if mark is None:
+        return "1", {}
+    condition = (
+        f"p.key in (select key from {CHANGES_TABLE} where seq > :seq)"
+        f" or p.key in (select key from {METRICS_CHANGES_TABLE} where seq > :metrics_seq)"
+    )
+    return condition, {"seq": mark["seq"], "metrics_seq": mark_metrics_seq(db, mark)}
+
+
+def export(
+    db: sqlite_utils.Database,
+    path,
+    export_format=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    incremental=None,
+    progress=None,
+):
+    """
+    Stream posts with all their enrichments to path, chunk by chunk.
+    With incremental set to a name, only posts changed since the previous
+    export with that name are written. Returns the number of posts exported.
+    """
+    export_format = export_format or format_for(path)
+    seq, metrics_seq = current_watermark(db)
+    changed, params = "1", {}
+    if incremental:
+        changed, params = changed_since(db, incremental)
+    sql = EXPORT_SQL.format(changed=changed)
+
+    writer = open_writer(path, export_format)
+    count = 0
+    after = -(2**63)
+    try:
+        while True:
+            rows = list(db.query(sql, dict(params, after=after, chunk_size=chunk_size)))
+            if not rows:
+                break
+            after = rows[-1]["_key"]
+            for row in rows:
+                del row["_key"]
+                row["entities"] = json.loads(row["entities"])
+            writer.write(rows)
+            count += len(rows)
+            if progress is not None:
+                progress(len(rows))
+    finally:
+        writer.close()
+
+    if incremental:
+        with storage.writer(db):
+            db[WATERMARK_TABLE].insert(
+                {
+                    "name": incremental,
+                    "seq": seq,
+                    "metrics_seq": metrics_seq,
+                    "exported_at": datetime.datetime.utcnow()
+                    .replace(microsecond=0)
+                    .isoformat(),
+                },
+                replace=True,
+            )
+    return count
@@ -0,0 +1,321 @@
+import contextlib
+import os
+import socket
+import sqlite3
+import time
+
+import sqlite_utils
+
+import spevktator.storage as storage
+
+
+FTS_TABLES = ("posts", "posts_translation", "entities", "posts_lemmas")
+AUTOMERGE = 8  # merge once 8 segments of the same level exist
+MERGE_PAGES = 64  # pages written per incremental merge step
+MERGE_BUDGET = 2.0  # seconds
+# substring search, next to the word index {table}_fts of the same table
+TRIGRAM_COLUMNS = {"posts": "text", "posts_translation": "text_en"}
+
+
+def trigram_table(table):
+    return f"{table}_trigram"
+
+
+def trigger_names(table):
+    "the triggers keeping {table}_fts, created by sqlite-utils, and {table}_trigram up-to-date"
+    return [
+        f"{prefix}{suffix}"
+        for prefix in (table, trigram_table(table))
+        for suffix in ("_ai", "_ad", "_au")
+    ]
+
+
+def indexes(db: sqlite_utils.Database, table):
+    "the full-text indexes of table"
+    return [
+        name for name in (f"{table}_fts", trigram_table(table)) if db[name].exists()
+    ]
+
+
+def enable_trigram(db: sqlite_utils.Database, table, triggers=True):
+    """
+    Create or rebuild the trigram index of the text column of table, which
+    finds any part of a word of at least 3 characters, case-insensitive
+    """
+    column = TRIGRAM_COLUMNS[table]
+    index = trigram_table(table)
+    db.execute(
+        f"create virtual table if not exists [{index}]"
+        f" using fts5([{column}], content=[{table}], tokenize='trigram')"
+    )
+    db.execute(f"insert into [{index}] ([{index}]) values ('rebuild')")
+    if not triggers:
+        return
+    delete = (
+        f"insert into [{index}] ([{index}], rowid, [{column}])"
+        f" values ('delete', old.rowid, old.[{column}]);"
+    )
+    insert = (
+        f"insert into [{index}] (rowid, [{column}]) values (new.rowid, new.[{column}]);"
+    )
+    for suffix, event, body in (
+        ("_ai", "insert", insert),
+        ("_ad", "delete", delete),
+        ("_au", f"update of [{column}]", delete + " " + insert),
+    ):
+        db.execute(
+            f"create trigger if not exists [{index}{suffix}]"
+            f" after {event} on [{table}] begin {body} end"
+        )
+    set_automerge(db, table, index=index)
+
+
+def disable(db: sqlite_utils.Database, table):
+    "drop the full-text indexes of table and their triggers"
+    if db[f"{table}_fts"].exists():
+        db[table].disable_fts()
+    for name in trigger_names(table):
+        db.execute(f"drop trigger if exists [{name}]")
+    db.execute(f"drop table if exists [{trigram_table(table)}]")
+
+
+def rebuild_indexes(db: sqlite_utils.Database, table):
+    for index in indexes(db, table):
+        db.execute(f"insert into [{index}] ([{index}]) values ('rebuild')")
+
+
+def ensure_suspended_table(db: sqlite_utils.Database):
+    if "fts_suspended" not in db.table_names():
+        db["fts_suspended"].create(
+            {"name": str, "tbl_name": str, "sql": str, "owner": str},
+            pk="name",
+        )
+    elif "owner" not in db["fts_suspended"].columns_dict:
+        db["fts_suspended"].add_column("owner", str)
+
+
+def owner():
+    "the host and pid of this process, which suspends and resumes triggers"
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def abandoned(suspended_by):
+    """
+    Whether the process that suspended triggers is gone. Entries without an
+    owner, from older versions, count as abandoned. Those from another host
+    do not, as there is no way to tell.
+    """
+    if suspended_by is None:
+        return True
+    host, _, pid = suspended_by.rpartition(":")
+    if host != socket.gethostname():
+        return False
+    if os.name == "nt":
+        # os.kill would terminate it, so resume as before
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def suspend_triggers(db: sqlite_utils.Database, table):
+    "drop the FTS triggers of table, remembering them so they can be restored"
+    with storage.writer(db):
+        ensure_suspended_table(db)
+        triggers = [t for t in db[table].triggers if t.name in trigger_names(table)]
+        for trigger in triggers:
+            db["fts_suspended"].insert(
+                {
+                    "name": trigger.name,
+                    "tbl_name": table,
+                    "sql": trigger.sql,
+                    "owner": owner(),
+                },
+                replace=True,
+            )
+            db.execute(f"drop trigger [{trigger.name}]")
+
+
+def resume_triggers(db: sqlite_utils.Database, table=None, rebuild=True):
+    """
+    Rebuild the FTS index once and restore the triggers of suspended tables,
+    those suspended by this process or by one that is gone. A bulk load of
+    another process keeps going. Without rebuild, the caller has already
+    indexed the rows it loaded.
+    """
+    if "fts_suspended" not in db.table_names():
+        return []
+    with storage.writer(db):
+        ensure_suspended_table(db)
+    sql = "select tbl_name, owner from fts_suspended"
+    if table is not None:
+        sql += " where tbl_name = :table"
+    rows = db.execute(sql, {"table": table}).fetchall()
+    # tables another process is still loading
+    busy = {name for name, by in rows if by != owner() and not abandoned(by)}
+    tables = sorted({name for name, _ in rows} - busy)
+    for name in tables:
+        with storage.writer(db):
+            if rebuild:
+                rebuild_indexes(db, name)
+            suspended = list(
+                db.query(
+                    "select name, sql from fts_suspended where tbl_name = :table",
+                    {"table": name},
+                )
+            )
+            for row in suspended:
+                db.execute(row["sql"])
+            db.execute(
+                "delete from fts_suspended where tbl_name = :table", {"table": name}
+            )
+    return tables
+
+
+@contextlib.contextmanager
+def bulk_load(db: sqlite_utils.Database, tables=FTS_TABLES):
+    """
+    Load data without updating the FTS index row by row, then rebuild it once.
+    If the process dies halfway, the next ensure_fts() finishes the rebuild.
+    """
+    tables = [t for t in tables if indexes(db, t)]
+    for table in tables:
+        suspend_triggers(db, table)
+    yield db
+    for table in tables:
+        resume_triggers(db, table)
+
+
+def index_rows(db: sqlite_utils.Database, table, rowids_sql, params=None):
+    "add the rows of table selected by rowids_sql to its indexes, one statement each"
+    for fts_table in indexes(db, table):
+        columns = ", ".join(f"[{column.name}]" for column in db[fts_table].columns)
+        db.execute(
+            f"insert into [{fts_table}] (rowid, {columns})"
+            f" select rowid, {columns} from [{table}] where rowid in ({rowids_sql})",
+            params or {},
+        )
+
+
+def set_automerge(db: sqlite_utils.Database, table, segments=AUTOMERGE, index=None):
+    fts_table = index or f"{table}_fts"
+    db.execute(
+        f"insert into [{fts_table}] ([{fts_table}], rank) values ('automerge', ?)",
+        [segments],
+    )
+
+
+def merge(db: sqlite_utils.Database, table, budget=MERGE_BUDGET, pages=MERGE_PAGES):
+    """
+    Incrementally merge the segments of the indexes of table in small steps,
+    each in its own short write batch, until done or the time budget is used up.
+    Returns the number of steps that did any work.
+    """
+    steps = 0
+    deadline = time.monotonic() + budget
+    for fts_table in indexes(db, table):
+        steps += merge_index(db, fts_table, deadline, pages)
+    return steps
+
+
+def merge_index(db: sqlite_utils.Database, fts_table, deadline, pages):
+    steps = 0
+    while time.monotonic() < deadline:
+        with storage.writer(db):
+            before = db.conn.total_changes
+            db.execute(
+                f"insert into [{fts_table}] ([{fts_table}], rank) values ('merge', ?)",
+                [pages],
+            )
+            # fewer than 2 changes means there was nothing left to merge
+            if db.conn.total_changes - before < 2:
+                break
+        steps += 1
+    return steps
+
+
+ENTITY_SEARCH_SQL = """
+select e.id, e.name, e.name_en, et.value as type, m.rank
+from
+    (
+        select rowid, rank from entities_fts
+        where entities_fts match :match
+        order by rank
+        limit :candidates
+    ) m
+    join entities e on e.id = m.rowid
+    join entity_types et on et.id = e.type
+order by
+    lower(e.name) = lower(:query) or lower(e.name_en) = lower(:query) desc,
+    {prefix} desc,
+    m.rank
+limit :limit
+"""
+
+# names starting with :query as a range, which the nocase indexes of the names
+# answer, and in which % and _ are just characters
+ENTITY_PREFIX = """(
+    e.name collate nocase >= :query and e.name collate nocase < :upper
+    or e.name_en collate nocase >= :query and e.name_en collate nocase < :upper
+)"""
+ENTITY_SEARCH_SQL = ENTITY_SEARCH_SQL.format(prefix=ENTITY_PREFIX)
+
+ENTITY_PREFIX_SQL = f"""
+select e.id, e.name, e.name_en, et.value as type, null as rank
+from entities e join entity_types et on et.id = e.type
+where {ENTITY_PREFIX}
+limit :limit
+"""
+
+
+def trigram_available():
+    "the trigram tokenizer needs SQLite 3.34 or later"
+    return sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def indexed_queries(config, tables):
+    """
+    The canned queries of config whose full-text index is one of tables,
+    they replace the queries of the same name that do without it
+    """
+    return {
+        name: {k: v for k, v in query.items() if k != "requires"}
+        for name, query in (config or {}).items()
+        if query["requires"] in tables
+    }
+
+
+def phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def trigrams(text):
+    text = text.lower()
+    return sorted({text[i : i + 3] for i in range(len(text) - 2)})
+
+
+def search_entities(db: sqlite_utils.Database, query, limit=20):
+    """
+    Entities whose name or English name contains query, exact and prefix
+    matches first. When there are fewer than limit of those, entities
+    sharing the most trigrams with query are added, to catch misspellings
+    and other transliterations.
+    """
+    query = query.strip()
+    # the highest code point, every name starting with query sorts before this
+    params = {"query": query, "upper": query + "\U0010ffff", "limit": limit}
+    if len(query) < 3 or not db["entities_fts"].exists():
+        return list(db.query(ENTITY_PREFIX_SQL, params))
+    params["candidates"] = limit * 10
+    rows = list(db.query(ENTITY_SEARCH_SQL, dict(params, match=phrase(query))))
+    if len(rows) < limit:
+        found = {row["id"] for row in rows}
+        fuzzy = " OR ".join(phrase(trigram) for trigram in trigrams(query))
+        for row in db.query(ENTITY_SEARCH_SQL, dict(params, match=fuzzy)):
+            if row["id"] not in found and len(rows) < limit:
+                rows.append(row)
+    return rows
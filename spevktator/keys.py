@@ -0,0 +1,125 @@
+import sqlite_utils
+
+import spevktator.fts as fts
+import spevktator.storage as storage
+
+
+# posts are keyed by their VK owner id and post id packed into one 64-bit
+# integer, the string id like -24199209_18932515 is generated from that key
+POST_ID_SQL = "(key >> 32) || '_' || (key & 4294967295)"
+KEY_SQL = (
+    "(cast(substr({id}, 1, instr({id}, '_') - 1) as integer) << 32)"
+    " | cast(substr({id}, instr({id}, '_') + 1) as integer)"
+)
+
+# {table: (column definitions after key and id, one row per post)}
+POST_TABLES = {
+    "posts": (
+        ["[domain] TEXT", "[date_utc] TEXT", "[text] TEXT", "[text_hash] INTEGER"],
+        True,
+    ),
+    "posts_metrics": (
+        ["[likes] INTEGER", "[shares] INTEGER", "[views] INTEGER", "[timestamp] TEXT"],
+        True,
+    ),
+    "posts_sentiment": (
+        [
+            "[positive] FLOAT",
+            "[negative] FLOAT",
+            "[neutral] FLOAT",
+            "[skip] FLOAT",
+            "[speech] FLOAT",
+        ],
+        True,
+    ),
+    "posts_translation": (["[text_en] TEXT"], True),
+    "posts_entities": (
+        [
+            "[entity] INTEGER REFERENCES [entities]([id])",
+            "[begin_offset] INTEGER",
+            "[end_offset] INTEGER",
+        ],
+        False,
+    ),
+    "posts_entities_done": ([], True),
+    "posts_lemmas": (["[lemmas] TEXT"], True),
+}
+
+
+def post_key(post_id):
+    "the packed key of a post id like -24199209_18932515"
+    owner, post = post_id.split("_")
+    return int(owner) << 32 | int(post)
+
+
+def post_id(key):
+    return f"{key >> 32}_{key & 0xFFFFFFFF}"
+
+
+def create_table_sql(table, name=None):
+    columns, unique = POST_TABLES[table]
+    key = "[key] INTEGER PRIMARY KEY" if unique else "[key] INTEGER"
+    if table != "posts":
+        key += " REFERENCES [posts]([key])"
+    definitions = [key, f"[id] TEXT GENERATED ALWAYS AS ({POST_ID_SQL}) VIRTUAL"]
+    return "CREATE TABLE [{}] (\n   {}\n)".format(
+        name or table, ",\n   ".join(definitions + columns)
+    )
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    table_names = set(db.table_names())
+    for table in POST_TABLES:
+        if table not in table_names:
+            db.execute(create_table_sql(table))
+    # post urls and near-duplicates look posts up by their string id
+    db["posts"].create_index(["id"], unique=True, if_not_exists=True)
+    # for looking up the entities of a post
+    db["posts_entities"].create_index(["key"], if_not_exists=True)
+
+
+def legacy(db: sqlite_utils.Database):
+    "is this a database from before the packed integer keys?"
+    return db["posts"].exists() and "key" not in db["posts"].columns_dict
+
+
+def migrate_tables(db: sqlite_utils.Database):
+    """
+    Rebuild the post tables of db with packed integer keys. Their triggers,
+    full-text indexes and the views on them are dropped, ensure_tables,
+    ensure_views and ensure_fts create them again. Returns the dropped views.
+    """
+    views = [
+        name
+        for name, sql in db.execute(
+            "select name, sql from sqlite_master where type = 'view'"
+        ).fetchall()
+        if any(table in sql for table in POST_TABLES)
+    ]
+    with storage.writer(db):
+        for view in views:
+            db[view].drop()
+        for table in ("posts", "posts_translation"):
+            fts.disable(db, table)
+        # the renamed tables take the place of the dropped ones as they are
+        db.execute("pragma legacy_alter_table = on")
+        for table in POST_TABLES:
+            if not db[table].exists() or "key" in db[table].columns_dict:
+                continue
+            db.execute(create_table_sql(table, f"{table}_new"))
+            columns = ", ".join(
+                f"[{c}]"
+                for c in db[f"{table}_new"].columns_dict
+                if c != "key" and c in db[table].columns_dict
+            )
+            db.execute(
+                f"insert into [{table}_new] (key, {columns})"
+                f" select {KEY_SQL.format(id='id')}, {columns} from [{table}] order by 1"
+                if columns
+                else f"insert into [{table}_new] (key)"
+                f" select {KEY_SQL.format(id='id')} from [{table}] order by 1"
+            )
+            db[table].drop()
+            db.execute(f"alter table [{table}_new] rename to [{table}]")
+        db.execute("pragma legacy_alter_table = off")
+    return views
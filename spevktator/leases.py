@@ -0,0 +1,143 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import sqlite_utils
+
+import spevktator.storage as storage
+
+
+LEASES_TABLE = "domain_leases"
+LEASE_SECONDS = 60  # a lease not renewed for this long is up for grabs
+RENEW_INTERVAL = 20  # seconds between renewals while a domain is being fetched
+IDLE_POLL = 5  # at most this many seconds between looking for a domain that is due
+STOP_TIMEOUT = 30  # seconds a stopped worker gets to give up its lease
+
+# the domain that is due the longest, and not leased by another worker
+CLAIM_SQL = f"""
+select domain from {LEASES_TABLE}
+where domain in (select value from json_each(:domains))
+    and (owner is null or owner = :owner or expires_at < :now)
+    and coalesce(fetched_at, 0) <= :now - :interval
+order by coalesce(fetched_at, 0), random()
+limit 1
+"""
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    if LEASES_TABLE not in db.table_names():
+        db[LEASES_TABLE].create(
+            {
+                "domain": str,
+                "owner": str,
+                "expires_at": float,
+                "claimed_at": float,
+                "fetched_at": float,
+            },
+            pk="domain",
+        )
+
+
+def worker_id():
+    "unique per process, and telling which machine and process holds a lease"
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def claim(db: sqlite_utils.Database, domains, owner, interval, now=None):
+    """
+    Lease the domain that has waited longest since it was fetched, at least
+    interval seconds ago, and is not leased by another worker. Returns the
+    domain, or None when no domain is due.
+    """
+    now = time.time() if now is None else now
+    with storage.writer(db):
+        db.execute(
+            f"insert or ignore into {LEASES_TABLE} (domain)"
+            " select value from json_each(?)",
+            [json.dumps(list(domains))],
+        )
+        row = db.execute(
+            CLAIM_SQL,
+            {
+                "domains": json.dumps(list(domains)),
+                "owner": owner,
+                "now": now,
+                "interval": interval,
+            },
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute(
+            f"update {LEASES_TABLE} set owner = ?, expires_at = ?, claimed_at = ?"
+            " where domain = ?",
+            [owner, now + LEASE_SECONDS, now, row[0]],
+        )
+    return row[0]
+
+
+def renew(db: sqlite_utils.Database, domain, owner, now=None):
+    "extend the lease, False when it expired and another worker took it"
+    now = time.time() if now is None else now
+    with storage.writer(db):
+        return (
+            db.execute(
+                f"update {LEASES_TABLE} set expires_at = ? where domain = ? and owner = ?",
+                [now + LEASE_SECONDS, domain, owner],
+            ).rowcount
+            == 1
+        )
+
+
+def release(db: sqlite_utils.Database, domain, owner, fetched=True, now=None):
+    "give up the lease, noting when the domain was fetched"
+    now = time.time() if now is None else now
+    with storage.writer(db):
+        db.execute(
+            f"update {LEASES_TABLE} set owner = null, expires_at = null,"
+            " fetched_at = case when ? then ? else fetched_at end"
+            " where domain = ? and owner = ?",
+            [fetched, now, domain, owner],
+        )
+
+
+def next_due(db: sqlite_utils.Database, domains, interval, now=None):
+    "seconds until a domain may be due, capped at IDLE_POLL"
+    now = time.time() if now is None else now
+    row = db.execute(
+        f"select min(max(coalesce(fetched_at, 0) + ?, coalesce(expires_at, 0)))"
+        f" from {LEASES_TABLE} where domain in (select value from json_each(?))",
+        [interval, json.dumps(list(domains))],
+    ).fetchone()
+    if row[0] is None:
+        return 0
+    return min(max(row[0] - now, 0), IDLE_POLL)
+
+
+class Heartbeat(threading.Thread):
+    "renews a lease every RENEW_INTERVAL seconds, from its own connection"
+
+    def __init__(self, db_path, domain, owner, interval=RENEW_INTERVAL):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.domain = domain
+        self.owner = owner
+        self.interval = interval
+        self.lost = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        db = storage.open_database(self.db_path)
+        try:
+            while not self.stopped.wait(self.interval):
+                if not renew(db, self.domain, self.owner):
+                    self.lost = True
+                    break
+        finally:
+            db.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,117 @@
+import re
+
+import sqlite_utils
+
+import spevktator.fts as fts
+import spevktator.models as models
+import spevktator.storage as storage
+
+
+LEMMAS_TABLE = "posts_lemmas"
+BATCH_SIZE = 500  # posts lemmatized per write batch
+
+# the next batch of posts that are not lemmatized yet, selected by {keys}
+PENDING_SQL = f"""
+select key, text from posts
+where key > :after and key in ({{keys}})
+    and key not in (select key from {LEMMAS_TABLE})
+order by key
+limit :limit
+"""
+
+# scalar subqueries rather than joins, which also look posts up by key in the
+# views over the partitions
+SEARCH_SQL = f"""
+with m as materialized (
+    select rowid, rank from {LEMMAS_TABLE}_fts
+    where lemmas match :match
+        and (:after_rank is null or (rank, rowid) > (:after_rank, :after_key))
+    order by rank, rowid
+    limit :limit
+)
+select
+    m.rowid as key,
+    (select id from posts where key = m.rowid) as id,
+    (select domain from posts where key = m.rowid) as domain,
+    (select date_utc from posts where key = m.rowid) as date_utc,
+    (select text from posts where key = m.rowid) as text,
+    m.rank
+from m
+order by m.rank, m.rowid
+"""
+
+_RE_TERM = re.compile(r"(\w+)(\*?)")
+
+
+def insert(db: sqlite_utils.Database, rows):
+    "save the lemmas of posts, rows with a key and lemmas"
+    # ignore rather than replace, the full-text index is kept up by triggers
+    db[LEMMAS_TABLE].insert_all(rows, pk="key", ignore=True)
+
+
+def fill(db: sqlite_utils.Database, keys_sql=None, params=None, progress=None):
+    """
+    Lemmatize the posts selected by keys_sql, all posts by default, that are
+    not lemmatized yet. Returns the number of posts.
+    """
+    sql = PENDING_SQL.format(keys=keys_sql or "select key from posts")
+    params = dict(params or {}, limit=BATCH_SIZE)
+    after = -(2**63)
+    count = 0
+    while True:
+        batch = db.execute(sql, dict(params, after=after)).fetchall()
+        if not batch:
+            return count
+        with storage.writer(db):
+            insert(
+                db,
+                (
+                    {"key": key, "lemmas": lemmas}
+                    for (key, _), lemmas in zip(
+                        batch, models.lemmatize([text for _, text in batch])
+                    )
+                ),
+            )
+        after = batch[-1][0]
+        count += len(batch)
+        if progress:
+            progress(len(batch))
+
+
+def match(query):
+    """
+    The posts_lemmas_fts query for the words of query, all of which must be
+    found in any of their forms. A word ending in * matches every lemma
+    starting with it, so Запорож* also finds запорожский.
+    """
+    import spevktator.natasha_entities as natasha_entities
+
+    terms = []
+    for word, star in _RE_TERM.findall(query.lower()):
+        if star:
+            terms.append(fts.phrase(word.replace("ё", "е")) + "*")
+        else:
+            terms.append(fts.phrase(natasha_entities.lemma(word)))
+    return " ".join(terms)
+
+
+def search(db: sqlite_utils.Database, query, limit=20, after=None):
+    """
+    Posts containing every word of query in any form, the best matches first.
+    after is the (rank, key) of the last post of the previous page.
+    """
+    terms = match(query)
+    if not terms or not db[f"{LEMMAS_TABLE}_fts"].exists():
+        return []
+    after_rank, after_key = after or (None, None)
+    return list(
+        db.query(
+            SEARCH_SQL,
+            {
+                "match": terms,
+                "after_rank": after_rank,
+                "after_key": after_key,
+                "limit": limit,
+            },
+        )
+    )
@@ -0,0 +1,139 @@
+import collections
+import datetime
+import gzip
+import json
+import os
+import pathlib
+import time
+
+import sqlite_utils
+
+import spevktator.storage as storage
+
+
+# {table: (timestamp column, days kept by default, moved to cold storage)}
+RETENTION = {
+    "scrape_log": ("timestamp", 30, True),
+    "post_events": ("at", 30, False),
+    "listen_diagnostics": ("timestamp", 90, False),
+}
+BATCH_SIZE = 1000  # rows expired per write batch
+VACUUM_PAGES = 256  # pages freed per write batch
+VACUUM_BUDGET = 2.0  # seconds listen spends freeing pages between rounds
+COMPRESS_LEVEL = 6
+
+# the next batch of expired rows, in the order they were written
+EXPIRED_SQL = """
+select rowid as rowid, * from [{table}]
+where rowid > :after and [{column}] < :before
+order by rowid
+limit :limit
+"""
+
+
+def cold_path(db_path, table, month):
+    "the cold storage file of the rows of table written in month, next to the database"
+    path = pathlib.Path(db_path)
+    return path.parent / f"{path.stem}.cold" / f"{table}-{month}.jsonl.gz"
+
+
+def cutoff(days, now=None):
+    now = now or datetime.datetime.utcnow()
+    return (now - datetime.timedelta(days=days)).replace(microsecond=0).isoformat()
+
+
+def archive(db_path, table, column, rows):
+    """
+    Append rows to the cold storage files of their months, as gzipped JSON
+    lines, and sync them to disk. Each call adds a gzip member, which gzip
+    and zcat read as one file.
+    """
+    by_month = collections.defaultdict(list)
+    for row in rows:
+        by_month[(row[column] or "")[:7]].append(row)
+    for month, month_rows in by_month.items():
+        path = cold_path(db_path, table, month or "undated")
+        path.parent.mkdir(exist_ok=True)
+        with open(path, "ab") as fp:
+            with gzip.GzipFile(
+                fileobj=fp, mode="ab", compresslevel=COMPRESS_LEVEL
+            ) as out:
+                for row in month_rows:
+                    out.write(json.dumps(row, ensure_ascii=False).encode() + b"\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+def expire(db: sqlite_utils.Database, table, days, now=None):
+    """
+    Delete the rows of table older than days, moving them to cold storage
+    first for the tables kept there. Returns the number of rows.
+    """
+    column, _, cold = RETENTION[table]
+    if not db[table].exists():
+        return 0
+    sql = EXPIRED_SQL.format(table=table, column=column)
+    params = {"before": cutoff(days, now), "limit": BATCH_SIZE}
+    after = 0
+    count = 0
+    while True:
+        with storage.writer(db):
+            cursor = db.execute(sql, dict(params, after=after))
+            names = [d[0] for d in cursor.description]
+            rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+            if not rows:
+                return count
+            rowids = [row.pop("rowid") for row in rows]
+            # on disk before the rows are gone, a crash at worst archives them twice
+            if cold:
+                archive(storage.database_path(db), table, column, rows)
+            db.execute(
+                f"delete from [{table}] where rowid in (select value from json_each(?))",
+                [json.dumps(rowids)],
+            )
+        after = rowids[-1]
+        count += len(rows)
+
+
+def incremental(db: sqlite_utils.Database):
+    "whether the database gives free pages back with incremental_vacuum"
+    # reading refreshes the header, another connection may have converted it
+    db.execute("pragma schema_version").fetchone()
+    return db.execute("pragma auto_vacuum").fetchone()[0] == 2
+
+
+def free_bytes(db: sqlite_utils.Database):
+    page_size = db.execute("pragma page_size").fetchone()[0]
+    return db.execute("pragma freelist_count").fetchone()[0] * page_size
+
+
+def vacuum(db: sqlite_utils.Database, budget=VACUUM_BUDGET, pages=VACUUM_PAGES):
+    """
+    Give free pages back to the file system, a few at a time so writers
+    hardly wait, until none are left or budget seconds are used up. Returns
+    the bytes reclaimed, 0 unless auto_vacuum is incremental.
+    """
+    if not incremental(db):
+        return 0
+    page_size = db.execute("pragma page_size").fetchone()[0]
+    deadline = time.monotonic() + budget
+    freed = 0
+    while time.monotonic() < deadline:
+        with storage.writer(db):
+            free = db.execute("pragma freelist_count").fetchone()[0]
+            if not free:
+                break
+            for _ in range(min(free, pages)):
+                # the sqlite3 module steps a pragma only once, which frees one page
+                db.conn.execute("pragma incremental_vacuum(1)")
+            freed += free - db.execute("pragma freelist_count").fetchone()[0]
+    return freed * page_size
+
+
+def convert(db: sqlite_utils.Database):
+    "switch an existing database to incremental auto_vacuum, one full VACUUM"
+    db.execute("pragma auto_vacuum = incremental")
+    storage.checkpoint(db, "truncate")
+    db.vacuum()
+    # the rewritten pages are in the WAL until then
+    storage.checkpoint(db, "truncate")
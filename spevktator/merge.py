@@ -0,0 +1,291 @@
+from dataclasses import dataclass
+import datetime
+import json
+import os
+
+import sqlite_utils
+
+import spevktator.export as export_
+import spevktator.fts as fts
+import spevktator.partitions as partitions
+import spevktator.storage as storage
+import spevktator.text_cache as text_cache
+
+
+SHARDS_TABLE = "merge_shards"
+SCHEMA = "shard"
+
+# post tables that are filled once per post, the first shard to bring a row wins.
+# rows that exist are skipped with a where rather than an upsert, which would
+# override the conflict handling of the rollups, refresh and export triggers
+ONCE_TABLES = (
+    "posts_sentiment",
+    "posts_translation",
+    "posts_entities_done",
+    "posts_lemmas",
+)
+# the merged tables with a full-text index, filled in one statement each
+FTS_TABLES = ("posts", "posts_translation", "posts_lemmas")
+
+# posts that are new or changed in the shard since its previous merge
+CHANGED_SQL = f"""
+select key from {SCHEMA}.{export_.CHANGES_TABLE} where seq > :seq
+union select key from {SCHEMA}.{export_.METRICS_CHANGES_TABLE} where seq > :metrics_seq
+"""
+
+# entity ids of the shard mentioned by the changed posts, mapped to those of main
+ENTITY_MAP_SQL = f"""
+update temp.merge_entities set id = (
+    select e.id from {SCHEMA}.entities se
+    join {SCHEMA}.entity_types st on st.id = se.type
+    join main.entity_types t on t.value = st.value
+    join main.entities e on e.type = t.id and e.name = se.name
+    where se.id = merge_entities.shard_id
+)
+"""
+
+NEW_ENTITIES_SQL = f"""
+insert into main.entities (name, name_en, type)
+select distinct se.name, se.name_en, t.id
+from temp.merge_entities m
+    join {SCHEMA}.entities se on se.id = m.shard_id
+    join {SCHEMA}.entity_types st on st.id = se.type
+    join main.entity_types t on t.value = st.value
+where m.id is null
+"""
+
+# translations of entity names done on the shard
+ENTITY_NAMES_SQL = f"""
+update main.entities set name_en = (
+    select se.name_en from temp.merge_entities m
+    join {SCHEMA}.entities se on se.id = m.shard_id
+    where m.id = entities.id and se.name_en != ''
+)
+where coalesce(name_en, '') = '' and id in (
+    select m.id from temp.merge_entities m
+    join {SCHEMA}.entities se on se.id = m.shard_id
+    where se.name_en != ''
+)
+"""
+
+
+@dataclass
+class MergeResult:
+    shard: str
+    posts: int = 0
+    metrics: int = 0
+    enrichments: int = 0
+    entities: int = 0
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    if SHARDS_TABLE not in db.table_names():
+        db[SHARDS_TABLE].create(
+            {
+                "shard": str,
+                "seq": int,
+                "metrics_seq": int,
+                "posts": int,
+                "merged_at": str,
+            },
+            pk="shard",
+        )
+    elif "metrics_seq" not in db[SHARDS_TABLE].columns_dict:
+        db[SHARDS_TABLE].add_column("metrics_seq", int)
+
+
+def shard_name(path):
+    "shards are remembered by their absolute path"
+    return os.path.abspath(path)
+
+
+def high_water_mark(db: sqlite_utils.Database, shard):
+    "(changes seq, metrics changes seq) of the previous merge of shard, or None"
+    mark = next(
+        db.query(f"select * from {SHARDS_TABLE} where shard = ?", [shard]), None
+    )
+    if mark is None:
+        return None
+    return mark["seq"], export_.mark_metrics_seq(db, mark, SCHEMA)
+
+
+def columns(db: sqlite_utils.Database, table):
+    "stored columns, without the generated id, that the shard has as well"
+    shard = {row[1] for row in db.execute(f"pragma {SCHEMA}.table_info([{table}])")}
+    return ", ".join(f"[{c}]" for c in db[table].columns_dict if c in shard)
+
+
+def check_shard(path):
+    shard = sqlite_utils.Database(path)
+    try:
+        if not shard["posts"].exists():
+            raise ValueError(f"{path} contains no posts")
+        if "key" not in shard["posts"].columns_dict:
+            raise ValueError(
+                f"{path} uses string post keys, run `spevktator migrate-keys` on it first"
+            )
+        return all(
+            shard[table].exists()
+            for table in (export_.CHANGES_TABLE, export_.METRICS_CHANGES_TABLE)
+        )
+    finally:
+        shard.close()
+
+
+def fill_keys(db: sqlite_utils.Database, mark, tracked):
+    "the keys of the posts to merge into temp.merge_keys"
+    db.execute("create temp table merge_keys (key integer primary key)")
+    if mark is None or not tracked:
+        # first merge, or a shard without change tracking: everything
+        db.execute(
+            f"insert into temp.merge_keys select key from {SCHEMA}.posts"
+            f" union select key from {SCHEMA}.posts_metrics"
+        )
+    else:
+        db.execute(
+            f"insert into temp.merge_keys {CHANGED_SQL}",
+            {"seq": mark[0], "metrics_seq": mark[1]},
+        )
+
+
+def merge_entities(db: sqlite_utils.Database):
+    "add the entities (and types) of the shard to main, with a map of their ids"
+    db.execute(
+        f"insert into main.entity_types (value) select value from {SCHEMA}.entity_types"
+        " where value not in (select value from main.entity_types)"
+    )
+    db.execute("create temp table merge_entities (shard_id integer primary key, id)")
+    db.execute(
+        "insert into temp.merge_entities (shard_id)"
+        f" select distinct entity from {SCHEMA}.posts_entities"
+        " where key in (select key from temp.merge_keys)"
+    )
+    db.execute(ENTITY_MAP_SQL)
+    added = db.execute(NEW_ENTITIES_SQL).rowcount
+    if added:
+        db.execute(ENTITY_MAP_SQL)
+    db.execute(ENTITY_NAMES_SQL)
+    return added
+
+
+def merge_posts(db: sqlite_utils.Database, result):
+    "copy the changed posts and their metrics and enrichments, main wins on conflicts"
+    # archived posts stay in their partition, only their metrics are staged in main
+    archived = json.dumps(sorted(partitions.catalog(db)))
+    merged = (
+        "key in (select key from temp.merge_keys)"
+        " and key in (select key from main.posts)"
+    )
+    fts_tables = [t for t in FTS_TABLES if db[f"{t}_fts"].exists()]
+    db.execute("create temp table merge_fts (tbl text, key integer)")
+    for table in fts_tables:
+        db.execute(
+            "insert into temp.merge_fts select ?, key from temp.merge_keys"
+            f" where key not in (select key from main.[{table}])",
+            [table],
+        )
+
+    posts = columns(db, "posts")
+    result.posts = db.execute(
+        f"insert into main.posts ({posts}) select {posts} from {SCHEMA}.posts"
+        " where key in (select key from temp.merge_keys)"
+        " and key not in (select key from main.posts)"
+        " and substr(date_utc, 1, 7) not in (select value from json_each(?))"
+        " order by key",
+        [archived],
+    ).rowcount
+
+    metrics = columns(db, "posts_metrics")
+    updates = ", ".join(
+        f"[{column}] = s.[{column}]"
+        for column in db["posts_metrics"].columns_dict
+        if column != "key"
+    )
+    # the newest metrics win
+    result.metrics = db.execute(
+        f"update main.posts_metrics set {updates} from {SCHEMA}.posts_metrics s"
+        " where s.key = posts_metrics.key and s.key in (select key from temp.merge_keys)"
+        " and (s.timestamp > posts_metrics.timestamp or posts_metrics.timestamp is null)"
+    ).rowcount
+    result.metrics += db.execute(
+        f"insert into main.posts_metrics ({metrics})"
+        f" select {metrics} from {SCHEMA}.posts_metrics"
+        " where key in (select key from temp.merge_keys)"
+        " and key not in (select key from main.posts_metrics) order by key"
+    ).rowcount
+
+    result.entities = merge_entities(db)
+    # entities are only added with their posts_entities_done row, never twice
+    result.enrichments = db.execute(
+        "insert into main.posts_entities (key, entity, begin_offset, end_offset)"
+        " select pe.key, m.id, pe.begin_offset, pe.end_offset"
+        f" from {SCHEMA}.posts_entities pe"
+        " join temp.merge_entities m on m.shard_id = pe.entity"
+        f" where pe.{merged}"
+        " and pe.key not in (select key from main.posts_entities_done)",
+    ).rowcount
+    for table in ONCE_TABLES:
+        names = columns(db, table)
+        result.enrichments += db.execute(
+            f"insert into main.[{table}] ({names})"
+            f" select {names} from {SCHEMA}.[{table}] where {merged}"
+            f" and key not in (select key from main.[{table}]) order by key"
+        ).rowcount
+
+    # shards from before the text hashes
+    text_cache.fill_hashes(db)
+
+    # index the new rows in one go, rather than row by row from the triggers
+    for table in fts_tables:
+        fts.index_rows(
+            db,
+            table,
+            "select key from temp.merge_fts where tbl = :table",
+            {"table": table},
+        )
+
+
+def merge(db: sqlite_utils.Database, path):
+    """
+    Merge the posts of the shard database at path into db, in one transaction.
+    Only rows changed since the previous merge of the shard are read.
+    Returns a MergeResult.
+    """
+    tracked = check_shard(path)
+    shard = shard_name(path)
+    result = MergeResult(shard)
+    partitions.ensure_catalog(db)
+    db.execute(f"attach database ? as {SCHEMA}", [path])
+    try:
+        with storage.writer(db):
+            mark = high_water_mark(db, shard) if tracked else None
+            fill_keys(db, mark, tracked)
+            for table in FTS_TABLES:
+                if db[f"{table}_fts"].exists():
+                    fts.suspend_triggers(db, table)
+            merge_posts(db, result)
+            for table in FTS_TABLES:
+                fts.resume_triggers(db, table, rebuild=False)
+
+            seq, metrics_seq = (
+                export_.current_watermark(db, SCHEMA) if tracked else (0, 0)
+            )
+            db[SHARDS_TABLE].insert(
+                {
+                    "shard": shard,
+                    "seq": seq,
+                    "metrics_seq": metrics_seq,
+                    "posts": db.execute(
+                        f"select count(*) from {SCHEMA}.posts"
+                    ).fetchone()[0],
+                    "merged_at": datetime.datetime.utcnow()
+                    .replace(microsecond=0)
+                    .isoformat(),
+                },
+                replace=True,
+            )
+    finally:
+        for table in ("merge_keys", "merge_entities", "merge_fts"):
+            db.execute(f"drop table if exists temp.{table}")
+        db.execute(f"detach database {SCHEMA}")
+    return result
@@ -0,0 +1,217 @@
+from dataclasses import dataclass
+import datetime
+import http.server
+import pathlib
+import random
+import threading
+import time
+import urllib.parse
+
+from bs4 import BeautifulSoup
+
+import spevktator.keys as keys
+
+
+DEFAULT_PORT = 8000
+DEFAULT_FIXTURE = pathlib.Path(__file__).parent.parent / "tests" / "vk_life.html"
+PAGE_SIZE = 5  # posts per wall page, as on m.vk.com
+OWNER_BASE = 100000  # the walls are owned by groups -100000, -100001, ...
+BACKLOG_SPACING = 600  # seconds between the posts already on a wall
+ERROR_CODES = (500, 502, 503)
+RETRY_AFTER = 1  # seconds, sent with a 429
+MOSCOW = datetime.timezone(datetime.timedelta(hours=3))
+
+# placeholders in the wall item templates
+POST_ID = "%POST_ID%"
+DATE = "%DATE%"
+MARKER = "%MARKER%"
+
+
+@dataclass
+class Wall:
+    domain: str
+    owner: int
+    posts: int  # on the wall at the start
+    start: float
+    interval: float = 0  # seconds between new posts, 0 for a wall that doesn't grow
+
+    def count(self, now):
+        if not self.interval:
+            return self.posts
+        return self.posts + int((now - self.start) / self.interval)
+
+    def published(self, number):
+        "epoch time of post number, 1 being the oldest"
+        if number <= self.posts:
+            return self.start - (self.posts - number) * BACKLOG_SPACING
+        return self.start + (number - self.posts) * self.interval
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    pages: int = 0
+    errors: int = 0
+    limited: int = 0
+
+
+def load_templates(path):
+    "(head, wall item templates, tail) of a saved wall page"
+    html = pathlib.Path(path).read_text()
+    soup = BeautifulSoup(html, "html.parser")
+    items = []
+    for div in soup.find_all("div", class_="wall_item"):
+        post_id = div.find("a", class_="post__anchor")["name"].replace("post", "")
+        div.find("a", class_="wi_date").string = DATE
+        div.find(class_="pi_text").insert(0, f"{MARKER} ")
+        items.append(str(div).replace(post_id, POST_ID))
+    more = html.index('<div class="show_more_wrap">')
+    tail = html.index("</div>", more) + len("</div>")
+    return html[: html.index('<div class="wall_item">')], items, html[tail:]
+
+
+def format_date(timestamp):
+    "like the absolute dates of m.vk.com, in Moscow time"
+    d = datetime.datetime.fromtimestamp(timestamp, MOSCOW)
+    hour = d.hour % 12 or 12
+    return f"{d.day} {d:%b} {d.year} at {hour}:{d:%M} {'am' if d.hour < 12 else 'pm'}"
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, body = self.server.respond(self.path)
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("content-type", "text/html; charset=utf-8")
+        self.send_header("content-length", str(len(data)))
+        if status == 429:
+            self.send_header("retry-after", str(RETRY_AFTER))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # the requests are counted in the stats instead
+        pass
+
+
+class MockVK(http.server.ThreadingHTTPServer):
+    """
+    A stand-in for the m.vk.com walls: paginated walls of generated posts, from the
+    wall items of a saved page, with latency, errors and a rate limit.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port=0,
+        domains=("life",),
+        posts=100,
+        new_posts=0,
+        latency=0,
+        error_rate=0,
+        rate_limit=0,
+        fixture=DEFAULT_FIXTURE,
+        seed=0,
+    ):
+        "new_posts per minute on each wall, latency in seconds, rate_limit in requests/s"
+        self.head, self.templates, self.tail = load_templates(fixture)
+        self.start = time.time()
+        interval = 60 / new_posts if new_posts else 0
+        self.walls = {
+            domain: Wall(domain, -(OWNER_BASE + i), posts, self.start, interval)
+            for i, domain in enumerate(domains)
+        }
+        self.owners = {wall.owner: wall for wall in self.walls.values()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.stats = MockStats()
+        # first time each post was served, by key
+        self.served = {}
+        self.tokens = rate_limit
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", port), Handler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def published(self, key):
+        "epoch time the post with key appeared on its wall"
+        owner, number = map(int, keys.post_id(key).split("_"))
+        return self.owners[owner].published(number)
+
+    def limited(self):
+        "token bucket, refilled at rate_limit tokens/s"
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate_limit, self.tokens + (now - self.refilled) * self.rate_limit
+            )
+            self.refilled = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+    def respond(self, path):
+        "(status, html) for a GET of path"
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+        with self.lock:
+            self.stats.requests += 1
+            delay = self.latency * self.random.uniform(0.5, 1.5)
+            failed = self.random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        wall = self.walls.get(url.path.strip("/"))
+        if self.limited():
+            status, body = 429, "Too many requests"
+        elif failed:
+            status, body = self.random.choice(ERROR_CODES), "Server error"
+        elif wall is None:
+            status, body = 404, "Not found"
+        else:
+            status, body = 200, self.page(wall, int(query.get("offset", ["0"])[0]))
+        with self.lock:
+            if status == 200:
+                self.stats.pages += 1
+            elif status == 429:
+                self.stats.limited += 1
+            else:
+                self.stats.errors += 1
+        return status, body
+
+    def page(self, wall, offset):
+        now = time.time()
+        count = wall.count(now)
+        items = []
+        for number in range(count - offset, max(count - offset - PAGE_SIZE, 0), -1):
+            post_id = f"{wall.owner}_{number}"
+            with self.lock:
+                self.served.setdefault(keys.post_key(post_id), now)
+            items.append(
+                self.templates[number % len(self.templates)]
+                .replace(POST_ID, post_id)
+                .replace(DATE, format_date(wall.published(number)))
+                .replace(MARKER, f"#{wall.domain}{number}")
+            )
+        if count - offset > PAGE_SIZE:
+            items.append(
+                '<div class="show_more_wrap"><a class="show_more"'
+                f' href="/{wall.domain}?offset={offset + PAGE_SIZE}&own=1"'
+                ' rel="noopener">Show more</a></div>'
+            )
+        return self.head + "".join(items) + self.tail
+
+    def run_in_thread(self):
+        "serve from a daemon thread, stop with shutdown()"
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,207 @@
+import concurrent.futures
+import functools
+import json
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+
+SOCKET_ENV = "SPEVKTATOR_MODEL_SOCKET"
+MAX_BATCH = 64  # texts per model call
+BATCH_WAIT = 0.005  # seconds to wait for more requests to batch with
+REQUEST_TIMEOUT = 300.0  # seconds, a batch of long posts can take a while
+
+
+def default_socket_path():
+    return os.environ.get(SOCKET_ENV) or os.path.join(
+        tempfile.gettempdir(), f"spevktator-models-{getattr(os, 'getuid', str)()}.sock"
+    )
+
+
+class Batcher:
+    """
+    Runs fn(texts) -> results on a single thread, combining the texts of
+    requests that arrive close together into batches of up to MAX_BATCH.
+    """
+
+    def __init__(self, fn, max_batch=MAX_BATCH, wait=BATCH_WAIT):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.wait = wait
+        self.queue = queue.Queue()
+        self.batches = self.texts = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, texts):
+        future = concurrent.futures.Future()
+        self.queue.put((texts, future))
+        return future
+
+    def collect(self):
+        pending = [self.queue.get()]
+        size = len(pending[0][0])
+        deadline = time.monotonic() + self.wait
+        while size < self.max_batch:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            pending.append(item)
+            size += len(item[0])
+        return pending
+
+    def run(self):
+        while True:
+            pending = self.collect()
+            texts = [text for item, _ in pending for text in item]
+            try:
+                results = self.fn(texts) if texts else []
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            offset = 0
+            for item, future in pending:
+                future.set_result(results[offset : offset + len(item)])
+                offset += len(item)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    "one JSON request per line: {op, texts}, answered by {ok, results} or {ok, error}"
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request["op"]
+                if op == "ping":
+                    response = {"ok": True, "models": sorted(self.server.batchers)}
+                elif op == "stats":
+                    response = {
+                        "ok": True,
+                        "stats": {
+                            name: {"batches": b.batches, "texts": b.texts}
+                            for name, b in self.server.batchers.items()
+                        },
+                    }
+                elif op in self.server.batchers:
+                    future = self.server.batchers[op].submit(list(request["texts"]))
+                    response = {"ok": True, "results": future.result()}
+                else:
+                    response = {"ok": False, "error": f"Unknown model: {op}"}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+            self.wfile.flush()
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128  # concurrent jobs connecting at once
+
+    def __init__(self, path, models):
+        "models is a dict of {op: fn(list of texts) -> list of results}"
+        remove_stale_socket(path)
+        self.path = path
+        self.batchers = {op: Batcher(fn) for op, fn in models.items()}
+        super().__init__(path, Handler)
+        # only the user running the server can use the models
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    client = Client(path)
+    if client.ping() is not None:
+        raise OSError(f"A model server is already listening on {path}")
+    os.unlink(path)
+
+
+def load_models():
+    "load the models once, returns the {op: fn} the server hosts"
+    import spevktator.dostoevsky_sentiment as dostoevsky_sentiment
+    import spevktator.models
+    import spevktator.natasha_entities as natasha_entities
+
+    models = {}
+    if dostoevsky_sentiment.load() is not None:
+        models["sentiment"] = dostoevsky_sentiment.predict
+    natasha_entities.load()
+    models["entities"] = natasha_entities.named_entities
+    for level in spevktator.models.NER_LEVELS:
+        models[f"entities-{level}"] = functools.partial(
+            natasha_entities.named_entities, level=level
+        )
+    models["lemmas"] = lambda texts: [natasha_entities.lemmatize(t) for t in texts]
+    models["embeddings"] = lambda texts: natasha_entities.embed(texts).tolist()
+    return models
+
+
+class Client:
+    "a connection to the model server, reconnecting once when it was dropped"
+
+    def __init__(self, path=None):
+        self.path = path or default_socket_path()
+        self.sock = None
+        self.fp = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # blocking, a connect with timeout fails right away when the backlog is full
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(REQUEST_TIMEOUT)
+        self.sock = sock
+        self.fp = sock.makefile("rwb")
+
+    def close(self):
+        if self.sock is not None:
+            self.fp.close()
+            self.sock.close()
+            self.sock = self.fp = None
+
+    def request(self, op, texts=None):
+        message = json.dumps({"op": op, "texts": texts or []}, ensure_ascii=False)
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.fp.write(message.encode() + b"\n")
+                self.fp.flush()
+                line = self.fp.readline()
+                if not line:
+                    raise ConnectionResetError("Model server closed the connection")
+                break
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+        response = json.loads(line)
+        if not response["ok"]:
+            raise ValueError(response["error"])
+        return response
+
+    def ping(self):
+        "the models hosted by the server, or None when there is no server"
+        if not os.path.exists(self.path):
+            return None
+        try:
+            return self.request("ping")["models"]
+        except (OSError, ValueError):
+            return None
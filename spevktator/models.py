@@ -0,0 +1,97 @@
+import os
+import time
+
+import numpy as np
+
+import spevktator.model_server as model_server
+
+
+RETRY_INTERVAL = 60  # seconds before looking for a model server again
+
+# how much of the natasha pipeline named-entity recognition runs, cheapest first:
+# spans   - only the NER tagger, names as they are written ("Москве")
+# normal  - names in their normal form ("Москва"), morph tagging and syntax
+#           parsing only for the sentences that need it, the same names as full
+# full    - every step for every sentence, lemmas included
+NER_LEVELS = ("spans", "normal", "full")
+DEFAULT_NER_LEVEL = os.environ.get("SPEVKTATOR_NER_LEVEL", "normal")
+
+# the model server, when one is running, otherwise models are loaded in-process
+client = None
+server_models = []
+checked_at = None
+
+
+def hosted(op):
+    "is op served by a running model server?"
+    global client, server_models, checked_at
+    now = time.monotonic()
+    if checked_at is None or (not server_models and now - checked_at > RETRY_INTERVAL):
+        client = model_server.Client()
+        server_models = client.ping() or []
+        checked_at = now
+    return op in server_models
+
+
+def remote(op, texts):
+    "results from the model server, or None when it went away"
+    global server_models, checked_at
+    try:
+        return client.request(op, texts)["results"]
+    except OSError:
+        server_models = []
+        checked_at = time.monotonic()
+        return None
+
+
+def sentiment_available():
+    if hosted("sentiment"):
+        return True
+    import spevktator.dostoevsky_sentiment as dostoevsky_sentiment
+
+    return dostoevsky_sentiment.installed()
+
+
+def predict_sentiment(texts):
+    "dostoevsky sentiment scores for each of the texts"
+    if hosted("sentiment"):
+        results = remote("sentiment", texts)
+        if results is not None:
+            return results
+    import spevktator.dostoevsky_sentiment as dostoevsky_sentiment
+
+    return dostoevsky_sentiment.predict(texts)
+
+
+def named_entities(texts, level=None):
+    "natasha named-entities for each of the texts, at the pipeline level or the default"
+    op = "entities" if level is None else f"entities-{level}"
+    if hosted(op):
+        results = remote(op, texts)
+        if results is not None:
+            return results
+    import spevktator.natasha_entities as natasha_entities
+
+    return natasha_entities.named_entities(texts, level)
+
+
+def lemmatize(texts):
+    "the lemmas of each of the texts, as one string of words"
+    if hosted("lemmas"):
+        results = remote("lemmas", texts)
+        if results is not None:
+            return results
+    import spevktator.natasha_entities as natasha_entities
+
+    return [natasha_entities.lemmatize(text) for text in texts]
+
+
+def embed(texts):
+    "mean NewsEmbedding word vectors of the texts, as a float32 array"
+    if hosted("embeddings"):
+        results = remote("embeddings", texts)
+        if results is not None:
+            return np.array(results, dtype=np.float32).reshape(len(texts), -1)
+    import spevktator.natasha_entities as natasha_entities
+
+    return natasha_entities.embed(texts)
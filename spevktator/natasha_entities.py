@@ -1,3 +1,8 @@
+import functools
+import re
+from dataclasses import dataclass
+
+import numpy as np
 from natasha import (
     Segmenter,
     MorphVocab,
@@ -8,43 +13,198 @@ from natasha import (
     NamesExtractor,
     Doc,
 )
+from natasha.const import ORG
+from natasha.doc import DocSpan
 
-segmenter = Segmenter()
-morph_vocab = MorphVocab()
+import spevktator.models as models
 
-emb = NewsEmbedding()
-morph_tagger = NewsMorphTagger(emb)
-syntax_parser = NewsSyntaxParser(emb)
-ner_tagger = NewsNERTagger(emb)
 
-names_extractor = NamesExtractor(morph_vocab)
+@dataclass
+class Pipeline:
+    segmenter: Segmenter
+    morph_vocab: MorphVocab
+    morph_tagger: NewsMorphTagger
+    syntax_parser: NewsSyntaxParser
+    ner_tagger: NewsNERTagger
+    names_extractor: NamesExtractor
 
 
-def named_entity_normalization(text):
-    doc = Doc(text)
-    # print(doc)
-    doc.segment(segmenter)
-    doc.tag_morph(morph_tagger)
-    for token in doc.tokens:
-        token.lemmatize(morph_vocab)
-    doc.parse_syntax(syntax_parser)
-    doc.tag_ner(ner_tagger)
+# loaded on first use, the embedding alone takes a few hundred MB
+pipeline = None
+emb = None
+vocab = None
 
-    for span in doc.spans:
-        span.normalize(morph_vocab)
+LEMMA_CACHE_SIZE = 200_000  # words, most posts reuse the same few thousand
 
-    # print(doc.spans)
-    # start=6, stop=13, type='LOC', text='Израиля', tokens=[...], normal='Израиль'
-    return [
-        {
-            "text": _.text,
-            "normal": _.normal,
-            "type": _.type,
-            "start": _.start,
-            "stop": _.stop,
-        }
-        for _ in doc.spans
+_RE_WORD = re.compile(r"\w+(?:-\w+)*")
+# the words as the FTS5 unicode61 tokenizer splits them
+_RE_TOKEN = re.compile(r"\w+")
+
+
+def embedding() -> NewsEmbedding:
+    "the word vectors, shared by the taggers and the post embeddings"
+    global emb
+    if emb is None:
+        emb = NewsEmbedding()
+    return emb
+
+
+def morph_vocab() -> MorphVocab:
+    "the pymorphy2 dictionaries, without the word vectors"
+    global vocab
+    if vocab is None:
+        vocab = MorphVocab()
+    return vocab
+
+
+def load() -> Pipeline:
+    global pipeline
+    if pipeline is None:
+        emb = embedding()
+        morph_vocab_ = morph_vocab()
+        pipeline = Pipeline(
+            segmenter=Segmenter(),
+            morph_vocab=morph_vocab_,
+            morph_tagger=NewsMorphTagger(emb),
+            syntax_parser=NewsSyntaxParser(emb),
+            ner_tagger=NewsNERTagger(emb),
+            names_extractor=NamesExtractor(morph_vocab_),
+        )
+    return pipeline
+
+
+def tag_sentences(nlp: Pipeline, sents):
+    "morph tag the sentences, from any number of documents, in one batch"
+    markups = nlp.morph_tagger.map([[_.text for _ in sent.tokens] for sent in sents])
+    for sent, markup in zip(sents, markups):
+        for token, tagged in zip(sent.tokens, markup.tokens):
+            token.pos, token.feats = tagged.pos, tagged.feats
+
+
+def parse_sentences(nlp: Pipeline, sents):
+    "parse the syntax of (sent_id, sentence) pairs, from any number of documents"
+    markups = nlp.syntax_parser.map(
+        [[_.text for _ in sent.tokens] for _, sent in sents]
+    )
+    for (sent_id, sent), markup in zip(sents, markups):
+        # numbered like Doc.parse_syntax does, heads are looked up by these ids
+        for token, tagged in zip(sent.tokens, markup.tokens):
+            token.id = f"{sent_id}_{tagged.id}"
+            token.head_id = f"{sent_id}_{tagged.head_id}"
+            token.rel = tagged.rel
+
+
+def tag_spans(nlp: Pipeline, docs):
+    "find the named-entity spans of the documents in one batch"
+    docs = [doc for doc in docs if doc.text.strip()]
+    for doc, markup in zip(docs, nlp.ner_tagger.map([doc.text for doc in docs])):
+        doc.spans = [
+            DocSpan(start, stop, type, doc.text[start:stop])
+            for start, stop, type in markup.spans
+        ]
+        doc.envelop_span_tokens()
+        doc.envelop_sent_spans()
+
+
+def named_entities(texts, level=None):
+    """
+    The named-entity spans of each of the texts, the level sets how much
+    work goes into their normal form, see models.NER_LEVELS
+    """
+    level = level or models.DEFAULT_NER_LEVEL
+    if level not in models.NER_LEVELS:
+        raise ValueError(f"Unknown named-entity level {level!r}")
+    nlp = load()
+    docs = [Doc(text) for text in texts]
+    for doc in docs:
+        doc.segment(nlp.segmenter)
+        doc.spans = []
+    tag_spans(nlp, docs)
+    numbered = [
+        (sent_id, sent)
+        for doc in docs
+        for sent_id, sent in enumerate(doc.sents, 1)
+        if level == "full" or sent.spans
     ]
+    if level == "full":
+        tag_sentences(nlp, [sent for _, sent in numbered])
+        for doc in docs:
+            for token in doc.tokens:
+                token.lemmatize(nlp.morph_vocab)
+        parse_sentences(nlp, numbered)
+    elif level == "normal":
+        # organisations are the only spans normalized by their syntax
+        tag_sentences(nlp, [sent for _, sent in numbered])
+        parse_sentences(
+            nlp,
+            [
+                (sent_id, sent)
+                for sent_id, sent in numbered
+                if any(span.type == ORG for span in sent.spans)
+            ],
+        )
+
+    # start=6, stop=13, type='LOC', text='Израиля', tokens=[...], normal='Израиль'
+    results = []
+    for doc in docs:
+        for span in doc.spans:
+            if level == "spans":
+                span.normal = span.text
+            else:
+                span.normalize(nlp.morph_vocab)
+        results.append(
+            [
+                {
+                    "text": _.text,
+                    "normal": _.normal,
+                    "type": _.type,
+                    "start": _.start,
+                    "stop": _.stop,
+                }
+                for _ in doc.spans
+            ]
+        )
+    return results
+
+
+def named_entity_normalization(text, level=None):
+    return named_entities([text], level)[0]
+
+
+@functools.lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemma(word):
+    "the most likely dictionary form of a lowercase word, out of context"
+    forms = morph_vocab().parse(word)
+    return (forms[0].normal if forms else word).replace("ё", "е")
+
+
+def lemmatize(text):
+    "the lemma of every word of text, separated by spaces"
+    return " ".join(lemma(word) for word in _RE_TOKEN.findall(text.lower()))
+
+
+def embed(texts):
+    """
+    The mean of the word vectors of each of the texts, as a float32 array of
+    len(texts) rows; rows of texts without any known word are zero
+    """
+    emb = embedding()
+    pq = emb.pq
+    ids, lengths = [], []
+    for text in texts:
+        words = [emb.vocab.get(word) for word in _RE_WORD.findall(text.lower())]
+        words = [id for id in words if id is not None]
+        ids.extend(words)
+        lengths.append(len(words))
+    # unpack the quantized vectors of all words of the batch at once
+    vectors = pq.codes[pq.qdims, pq.indexes[ids]].reshape(len(ids), pq.dim)
+    lengths = np.array(lengths)
+    result = np.zeros((len(texts), pq.dim), dtype=np.float32)
+    found = lengths > 0
+    if found.any():
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[found]
+        result[found] = np.add.reduceat(vectors, starts) / lengths[found, None]
+    return result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+import hashlib
+import re
+import zlib
+
+import numpy as np
+import sqlite_utils
+
+import spevktator.keys as keys
+
+
+NUM_PERM = 64
+BANDS = 16  # of NUM_PERM // BANDS rows, candidates from Jaccard similarity ~0.5
+SHINGLE_SIZE = 5  # characters
+THRESHOLD = 0.6  # estimated Jaccard similarity to count as near-duplicate
+MIN_LENGTH = 20  # characters of normalized text, shorter posts are not indexed
+MAX_CANDIDATES = 20  # per band, so indexing cost doesn't grow with the archive
+
+_PRIME = 4294967311  # smallest prime above 2**32
+_rng = np.random.RandomState(42)
+# a < 2**31, so a * hash fits in 64 bits
+_A = _rng.randint(1, 2**31, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.randint(0, 2**32, size=NUM_PERM, dtype=np.uint64)
+
+_RE_URL = re.compile(r"https?://\S+")
+_RE_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(text):
+    "lowercase text without links and punctuation"
+    text = _RE_URL.sub(" ", text.lower())
+    return _RE_NON_WORD.sub(" ", text).strip()
+
+
+def shingles(text):
+    return {text[i : i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def signature(text):
+    "MinHash signature of the normalized text, or None when it is too short"
+    text = normalize(text)
+    if len(text) < MIN_LENGTH:
+        return None
+    hashes = np.fromiter(
+        (zlib.crc32(s.encode("utf-8")) for s in shingles(text)), dtype=np.uint64
+    )
+    return ((np.outer(_A, hashes) + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def band_hashes(sig):
+    rows = NUM_PERM // BANDS
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                sig[i * rows : (i + 1) * rows].tobytes(), digest_size=8
+            ).digest(),
+            "little",
+            signed=True,
+        )
+        for i in range(BANDS)
+    ]
+
+
+def similarity(sig, other):
+    "estimated Jaccard similarity of two signatures"
+    return float(np.count_nonzero(sig == other)) / NUM_PERM
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    # these refer to posts by their string id, which is a generated column of
+    # posts that sqlite-utils can not declare foreign keys on
+    if "minhash_signatures" not in db.table_names():
+        db["minhash_signatures"].create({"id": str, "signature": bytes}, pk="id")
+    if "minhash_buckets" not in db.table_names():
+        db["minhash_buckets"].create(
+            {"band": int, "bucket": int, "id": str}, pk=("band", "bucket", "id")
+        )
+    if "near_duplicate_clusters" not in db.table_names():
+        db["near_duplicate_clusters"].create(
+            {
+                "id": int,
+                "first_id": str,
+                "first_domain": str,
+                "first_date_utc": str,
+                "last_date_utc": str,
+                "size": int,
+                "domains": int,
+            },
+            pk="id",
+        )
+    if "near_duplicates" not in db.table_names():
+        db["near_duplicates"].create(
+            {"id": str, "cluster": int, "similarity": float},
+            pk="id",
+            foreign_keys=[("cluster", "near_duplicate_clusters", "id")],
+        )
+        db["near_duplicates"].create_index(["cluster"])
+
+
+def candidates(db: sqlite_utils.Database, post_id, bands):
+    found = set()
+    for band, bucket in enumerate(bands):
+        for row in db.execute(
+            "select id from minhash_buckets where band = ? and bucket = ?"
+            " and id != ? limit ?",
+            [band, bucket, post_id, MAX_CANDIDATES],
+        ):
+            found.add(row[0])
+    return found
+
+
+def best_match(db: sqlite_utils.Database, sig, ids):
+    best_id, best = None, 0.0
+    for post_id, blob in db.execute(
+        "select id, signature from minhash_signatures where id in ({})".format(
+            ", ".join("?" for _ in ids)
+        ),
+        list(ids),
+    ):
+        score = similarity(sig, np.frombuffer(blob, dtype=np.uint64))
+        if score > best:
+            best_id, best = post_id, score
+    return best_id, best
+
+
+def add_to_cluster(db: sqlite_utils.Database, post, match_id, score):
+    """
+    Add post to the cluster of its match, which is started if need be.
+    Returns the cluster id, None when the match was archived into a
+    partition before it was in a cluster.
+    """
+    row = db.execute(
+        "select cluster from near_duplicates where id = ?", [match_id]
+    ).fetchone()
+    if row is None:
+        match = db.execute(
+            "select id, domain, date_utc from posts where key = ?",
+            [keys.post_key(match_id)],
+        ).fetchone()
+        if match is None:
+            return None
+        cluster = (
+            db["near_duplicate_clusters"]
+            .insert(
+                {
+                    "first_id": match[0],
+                    "first_domain": match[1],
+                    "first_date_utc": match[2],
+                    "last_date_utc": match[2],
+                    "size": 1,
+                    "domains": 1,
+                }
+            )
+            .last_pk
+        )
+        db["near_duplicates"].insert(
+            {"id": match_id, "cluster": cluster, "similarity": 1.0}
+        )
+    else:
+        cluster = row[0]
+    # counted once, also when the post is indexed again; the owner in the id
+    # of a post is its wall, so archived members count too
+    added, new_domain = db.execute(
+        """
+        select
+            not exists (select 1 from near_duplicates where id = :id and cluster = :cluster),
+            not exists (
+                select 1 from near_duplicates where cluster = :cluster
+                and substr(id, 1, length(:wall)) = :wall
+            )
+        """,
+        {"id": post["id"], "cluster": cluster, "wall": post["id"].split("_")[0] + "_"},
+    ).fetchone()
+    db["near_duplicates"].insert(
+        {"id": post["id"], "cluster": cluster, "similarity": score}, replace=True
+    )
+    # posts can arrive out of order during a backfill, keep the earliest as first seen
+    db.execute(
+        """
+        update near_duplicate_clusters set
+            first_id = case when :date_utc < first_date_utc then :id else first_id end,
+            first_domain = case when :date_utc < first_date_utc
+                then :domain else first_domain end,
+            first_date_utc = min(first_date_utc, :date_utc),
+            last_date_utc = max(last_date_utc, :date_utc),
+            size = size + :added,
+            domains = domains + :new_domain
+        where id = :cluster
+        """,
+        dict(post, cluster=cluster, added=added, new_domain=added and new_domain),
+    )
+    return cluster
+
+
+def index_post(db: sqlite_utils.Database, post):
+    """
+    Add post (with id, domain, date_utc and text) to the LSH index and to the
+    cluster of its most similar earlier post. Returns the cluster id, if any.
+    """
+    sig = signature(post["text"])
+    if sig is None:
+        return None
+    return add_signature(db, post, sig)
+
+
+def add_signature(db: sqlite_utils.Database, post, sig):
+    "index_post, with the signature computed beforehand, outside a write batch"
+    bands = band_hashes(sig)
+    cluster = None
+    ids = candidates(db, post["id"], bands)
+    if ids:
+        match_id, score = best_match(db, sig, ids)
+        if score >= THRESHOLD:
+            cluster = add_to_cluster(db, post, match_id, score)
+    db["minhash_signatures"].insert(
+        {"id": post["id"], "signature": sig.tobytes()}, replace=True
+    )
+    db["minhash_buckets"].insert_all(
+        [
+            {"band": band, "bucket": bucket, "id": post["id"]}
+            for band, bucket in enumerate(bands)
+        ],
+        replace=True,
+    )
+    return cluster
@@ -0,0 +1,414 @@
+import datetime
+import os
+import pathlib
+import re
+import sqlite3
+import stat
+import time
+
+import sqlite_utils
+
+import spevktator.fts as fts
+import spevktator.storage as storage
+
+
+# tables with one row (or rows) per post, moved into the monthly partitions
+PARTITIONED_TABLES = (
+    "posts",
+    "posts_metrics",
+    "posts_sentiment",
+    "posts_translation",
+    "posts_entities",
+    "posts_entities_done",
+    "posts_lemmas",
+)
+# full-text indexes searched by matching their column, {index: (table, column)}
+SEARCHED_INDEXES = {
+    "posts_trigram": ("posts", "text"),
+    "posts_translation_trigram": ("posts_translation", "text_en"),
+    "posts_lemmas_fts": ("posts_lemmas", "lemmas"),
+}
+CATALOG_TABLE = "partitions"
+CATALOG_TTL = 300  # seconds, so long running commands see newly sealed months
+
+_RE_CREATE_VIEW = re.compile(r"^\s*create\s+view", re.IGNORECASE)
+
+
+def partition_dir(db_path):
+    "partitions live next to the database, in <name>.partitions/"
+    path = pathlib.Path(db_path)
+    return path.parent / f"{path.stem}.partitions"
+
+
+def schema_name(month):
+    return "p_" + month.replace("-", "_")
+
+
+def month_start(month):
+    return f"{month}-01T00:00:00"
+
+
+def next_month(month):
+    year, mon = map(int, month.split("-"))
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{year:04d}-{mon:02d}"
+
+
+def cutoff_month(keep_months, now=None):
+    "the oldest month that stays in the main database"
+    now = now or datetime.datetime.utcnow()
+    month = now.year * 12 + now.month - 1 - keep_months
+    return f"{month // 12:04d}-{month % 12 + 1:02d}"
+
+
+def ensure_catalog(db: sqlite_utils.Database):
+    if CATALOG_TABLE not in db.table_names():
+        db[CATALOG_TABLE].create(
+            {
+                "month": str,
+                "path": str,
+                "posts": int,
+                "size": int,
+                "sealed_at": str,
+            },
+            pk="month",
+        )
+
+
+def catalog(db: sqlite_utils.Database):
+    "{month: path} of all sealed partitions, cached on the database object"
+    loaded_at, cached = getattr(db, "partitions", None) or (0, None)
+    if cached is None or time.monotonic() - loaded_at > CATALOG_TTL:
+        cached = {}
+        if CATALOG_TABLE in db.table_names():
+            cached = {
+                row["month"]: row["path"]
+                for row in db.query(f"select month, path from {CATALOG_TABLE}")
+            }
+        db.partitions = (time.monotonic(), cached)
+    return cached
+
+
+def resolve(main_path, path):
+    "partition paths are stored relative to the main database"
+    return os.path.join(os.path.dirname(os.path.abspath(main_path)), path)
+
+
+def read_only_connection(db: sqlite_utils.Database, month):
+    connections = db.__dict__.setdefault("partition_connections", {})
+    if month not in connections:
+        path = resolve(storage.database_path(db), catalog(db)[month])
+        connections[month] = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    return connections[month]
+
+
+def archived(db: sqlite_utils.Database, key, date_utc):
+    "does the post already exist in the sealed partition for its month?"
+    month = date_utc[:7]
+    if month not in catalog(db):
+        return False
+    conn = read_only_connection(db, month)
+    return (
+        conn.execute("select 1 from posts where key = ?", [key]).fetchone() is not None
+    )
+
+
+def copy_schema(db: sqlite_utils.Database, partition: sqlite_utils.Database):
+    "create missing partitioned tables, columns and indexes in the partition"
+    for table in PARTITIONED_TABLES:
+        if not db[table].exists():
+            continue
+        if not partition[table].exists():
+            partition.execute(db[table].schema)
+        existing = set(partition[table].columns_dict)
+        for column, column_type in db[table].columns_dict.items():
+            if column not in existing:
+                partition[table].add_column(column, column_type)
+        for index in db[table].indexes:
+            if index.name.startswith("sqlite_autoindex"):
+                continue
+            partition[table].create_index(
+                index.columns, index_name=index.name, if_not_exists=True
+            )
+
+
+def set_writable(path, writable):
+    mode = os.stat(path).st_mode
+    if writable:
+        os.chmod(path, mode | stat.S_IWUSR)
+    else:
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def month_keys(month, schema):
+    "SQL and params selecting the keys of the posts of month, in main and in schema"
+    params = {"start": month_start(month), "end": month_start(next_month(month))}
+    keys = (
+        "select key from main.posts where date_utc >= :start and date_utc < :end"
+        f" union select key from [{schema}].posts"
+    )
+    return keys, params
+
+
+def delete_month(db: sqlite_utils.Database, month, schema):
+    "delete the rows of month from main, now that they are in the attached partition"
+    keys, params = month_keys(month, schema)
+    for table in PARTITIONED_TABLES[1:]:
+        if db[table].exists():
+            db.execute(f"delete from main.[{table}] where key in ({keys})", params)
+    db.execute(
+        "delete from main.posts where date_utc >= :start and date_utc < :end",
+        params,
+    )
+
+
+def move_month(db: sqlite_utils.Database, month, schema):
+    "move the rows of month from main into the attached partition schema"
+    keys, params = month_keys(month, schema)
+    moved = db.execute(
+        "select count(*) from main.posts where date_utc >= :start and date_utc < :end",
+        params,
+    ).fetchone()[0]
+    with storage.writer(db):
+        columns = ", ".join(f"[{c}]" for c in db["posts"].columns_dict)
+        db.execute(
+            f"insert or replace into [{schema}].posts ({columns}) select {columns}"
+            " from main.posts where date_utc >= :start and date_utc < :end",
+            params,
+        )
+        for table in PARTITIONED_TABLES[1:]:
+            if not db[table].exists():
+                continue
+            columns = ", ".join(f"[{c}]" for c in db[table].columns_dict)
+            if not db[table].pks or db[table].pks == ["rowid"]:
+                # no primary key to replace on, move all rows of these posts
+                db.execute(
+                    f"delete from [{schema}].[{table}] where key in"
+                    f" (select key from main.[{table}] where key in ({keys}))",
+                    params,
+                )
+            db.execute(
+                f"insert or replace into [{schema}].[{table}] ({columns})"
+                f" select {columns} from main.[{table}] where key in ({keys})",
+                params,
+            )
+        delete_month(db, month, schema)
+    return moved
+
+
+def seal(path):
+    "index, compact and write-protect a partition"
+    partition = sqlite_utils.Database(path)
+    # sealed partitions never change, so their indexes don't need triggers
+    for table, column, tokenize in (
+        ("posts", "text", None),
+        ("posts_translation", "text_en", "porter"),
+        ("posts_lemmas", "lemmas", None),
+    ):
+        if partition[f"{table}_fts"].exists():
+            partition[table].rebuild_fts()
+        elif partition[table].exists():
+            partition[table].enable_fts([column], tokenize=tokenize)
+        if (
+            table in fts.TRIGRAM_COLUMNS
+            and partition[table].exists()
+            and fts.trigram_available()
+        ):
+            fts.enable_trigram(partition, table, triggers=False)
+    partition.execute("analyze")
+    partition.conn.commit()
+    partition.vacuum()
+    posts = partition["posts"].count
+    partition.close()
+    set_writable(path, False)
+    return posts
+
+
+def pending_rows(db: sqlite_utils.Database, month, schema):
+    "rows in main waiting to be moved into the attached partition of month"
+    params = {"start": month_start(month), "end": month_start(next_month(month))}
+    count = db.execute(
+        "select count(*) from main.posts where date_utc >= :start and date_utc < :end",
+        params,
+    ).fetchone()[0]
+    if schema in {row[1] for row in db.execute("pragma database_list")}:
+        for table in PARTITIONED_TABLES[1:]:
+            if db[table].exists():
+                count += db.execute(
+                    f"select count(*) from main.[{table}]"
+                    f" where key in (select key from [{schema}].posts)"
+                ).fetchone()[0]
+    return count
+
+
+def archive(db: sqlite_utils.Database, db_path, keep_months=2, now=None):
+    """
+    Move posts older than keep_months, with their enrichments, into sealed
+    per-month partitions. Rows staged in main for already sealed months are
+    folded into their partition as well. Returns a list of (month, posts moved).
+    """
+    ensure_catalog(db)
+    cutoff = month_start(cutoff_month(keep_months, now))
+    months = sorted(
+        {
+            row["month"]
+            for row in db.query(
+                "select distinct substr(date_utc, 1, 7) as month from posts"
+                " where date_utc < :cutoff",
+                {"cutoff": cutoff},
+            )
+        }
+        | set(catalog(db))
+    )
+    directory = partition_dir(db_path)
+    directory.mkdir(exist_ok=True)
+    results = []
+    for month in months:
+        path = directory / f"{month}.db"
+        schema = schema_name(month)
+        if path.exists():
+            db.execute(f"attach database ? as [{schema}]", [str(path)])
+            try:
+                if not pending_rows(db, month, schema):
+                    continue
+            finally:
+                db.execute(f"detach database [{schema}]")
+            set_writable(path, True)
+        partition = sqlite_utils.Database(path)
+        copy_schema(db, partition)
+        partition.close()
+
+        db.execute(f"attach database ? as [{schema}]", [str(path)])
+        try:
+            moved = move_month(db, month, schema)
+        finally:
+            db.execute(f"detach database [{schema}]")
+
+        posts = seal(path)
+        with storage.writer(db):
+            db[CATALOG_TABLE].insert(
+                {
+                    "month": month,
+                    "path": os.path.relpath(path, os.path.dirname(db_path) or "."),
+                    "posts": posts,
+                    "size": path.stat().st_size,
+                    "sealed_at": datetime.datetime.utcnow()
+                    .replace(microsecond=0)
+                    .isoformat(),
+                },
+                replace=True,
+            )
+        results.append((month, moved))
+    db.partitions = None
+    for table in fts.FTS_TABLES:
+        fts.merge(db, table)
+    return results
+
+
+def union_sql(conn, table, schemas):
+    "select all rows of table from main and the attached partitions"
+    # table_xinfo includes the generated columns, like the string post id
+    columns = [row[1] for row in conn.execute(f"pragma main.table_xinfo([{table}])")]
+    pks = [
+        row[1] for row in conn.execute(f"pragma main.table_info([{table}])") if row[5]
+    ]
+    selects = [f"select {', '.join(f'[{c}]' for c in columns)} from main.[{table}]"]
+    for schema in schemas:
+        available = {
+            row[1] for row in conn.execute(f"pragma [{schema}].table_xinfo([{table}])")
+        }
+        if not available:
+            continue
+        select = ", ".join(
+            f"[{c}]" if c in available else f"null as [{c}]" for c in columns
+        )
+        sql = f"select {select} from [{schema}].[{table}]"
+        if table != "posts" and pks == ["key"]:
+            # metrics of archived posts are refreshed in main until the next archive run
+            sql += f" where key not in (select key from main.[{table}])"
+        selects.append(sql)
+    return "\nunion all\n".join(selects)
+
+
+def index_union_sql(conn, index, schemas):
+    """
+    The full-text index in main and the attached partitions. Matching its
+    column, rather than the table, reaches into every part.
+    """
+    table, column = SEARCHED_INDEXES[index]
+    selects = [f"select rowid as rowid, rank, [{column}] from main.[{index}]"]
+    for schema in schemas:
+        if not conn.execute(
+            f"select 1 from [{schema}].sqlite_master where name = ?", [index]
+        ).fetchone():
+            continue
+        sql = f"select rowid, rank, [{column}] from [{schema}].[{index}]"
+        if table != "posts":
+            sql += f" where rowid not in (select key from main.[{table}])"
+        selects.append(sql)
+    return "\nunion all\n".join(selects)
+
+
+def shadow_indexes(conn, tables, schemas):
+    for index in SEARCHED_INDEXES:
+        if index not in tables:
+            continue
+        conn.execute(f"drop view if exists temp.[{index}]")
+        conn.execute(
+            f"create temp view [{index}] as {index_union_sql(conn, index, schemas)}"
+        )
+
+
+def attach(conn):
+    """
+    Attach all sealed partitions read-only to a (reading) connection and
+    shadow the partitioned tables and all views with TEMP views over
+    main and the partitions, so existing queries see the whole archive.
+    """
+    main_path = [
+        row[2] for row in conn.execute("pragma database_list") if row[1] == "main"
+    ][0]
+    tables = {
+        row[0]
+        for row in conn.execute(
+            "select name from main.sqlite_master where type = 'table'"
+        )
+    }
+    if CATALOG_TABLE not in tables:
+        return []
+    months = [
+        row
+        for row in conn.execute(
+            f"select month, path from main.{CATALOG_TABLE} order by month"
+        )
+    ]
+    attached = {row[1] for row in conn.execute("pragma database_list")}
+    schemas = []
+    for month, path in months:
+        schema = schema_name(month)
+        if schema not in attached:
+            try:
+                conn.execute(
+                    f"attach database ? as [{schema}]",
+                    [f"file:{resolve(main_path, path)}?mode=ro"],
+                )
+            except sqlite3.OperationalError as e:
+                raise sqlite3.OperationalError(
+                    f"Cannot attach partition {month}: {e}, too many partitions?"
+                )
+        schemas.append(schema)
+
+    for table in PARTITIONED_TABLES:
+        if table in tables:
+            conn.execute(f"drop view if exists temp.[{table}]")
+            conn.execute(
+                f"create temp view [{table}] as {union_sql(conn, table, schemas)}"
+            )
+    shadow_indexes(conn, tables, schemas)
+    # views in main always resolve to main tables, so recreate them in temp
+    for name, sql in conn.execute(
+        "select name, sql from main.sqlite_master where type = 'view'"
+    ).fetchall():
+        conn.execute(f"drop view if exists temp.[{name}]")
+        conn.execute(_RE_CREATE_VIEW.sub("create temp view", sql, count=1))
+    return schemas
@@ -0,0 +1,94 @@
+import collections
+import json
+import sqlite3
+import threading
+
+
+CACHE_SIZE = 1024  # posts
+
+# everything the post page shows, in one statement so SQLite prepares it once
+POST_SQL = """
+select
+    p.id, p.domain, p.date_utc, p.text, pt.text_en,
+    pm.likes, pm.shares, pm.views, pm.timestamp as metrics_timestamp,
+    ps.positive, ps.negative, ps.neutral, ps.skip, ps.speech,
+    (ps.positive - ps.negative) as sentiment,
+    (
+        select json_group_array(
+            json_object('id', e.id, 'name', e.name, 'name_en', e.name_en, 'type', et.value)
+        )
+        from (select distinct entity from posts_entities where key = p.key) pe
+        join entities e on e.id = pe.entity
+        join entity_types et on et.id = e.type
+    ) as entities
+from
+    posts p
+    left join posts_translation pt on p.key = pt.key
+    left join posts_metrics pm on p.key = pm.key
+    left join posts_sentiment ps on p.key = ps.key
+where p.key = ?
+"""
+
+VERSION_SQL = "select version from data_version"
+
+
+def row_to_post(columns, row):
+    if row is None:
+        return None
+    post = dict(zip(columns, row))
+    post["entities"] = json.loads(post["entities"] or "[]")
+    return post
+
+
+def fetch(conn, key):
+    "the post with its translation, metrics, sentiment and entities, or None"
+    cursor = conn.execute(POST_SQL, [key])
+    columns = [d[0] for d in cursor.description]
+    return row_to_post(columns, cursor.fetchone())
+
+
+def data_version(conn):
+    "the write counter bumped by storage.writer(), None for older databases"
+    try:
+        return conn.execute(VERSION_SQL).fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+class VersionedLRU:
+    """
+    Least recently used cache that forgets everything once the data
+    version changes, so no entry outlives a write to the database.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, version, key):
+        with self.lock:
+            if version is None or version != self.version:
+                self.misses += 1
+                return None
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, version, key, value):
+        if version is None:
+            return
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
@@ -0,0 +1,459 @@
+import contextlib
+from dataclasses import dataclass, field
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+import sqlite_utils
+
+import spevktator.export as export_
+import spevktator.fts as fts
+import spevktator.keys as keys
+import spevktator.partitions as partitions
+import spevktator.rollups as rollups
+import spevktator.storage as storage
+
+
+TARGETS_TABLE = "publish_targets"
+APPLIED_TABLE = "publish_applied"
+ENTITY_CHANGES_TABLE = "entity_changes"
+MANIFEST = "manifest.json"
+SCHEMA = "changeset"
+COMPRESS_LEVEL = 6
+
+# {table: primary key} of the tables replicated row by row, a replica row
+# that differs from the published one is replaced. scrape_log, the minhash
+# index and the full-text indexes stay on the ingest host.
+SYNCED_TABLES = {
+    "entity_types": "id",
+    "entities": "id",
+    "posts": "key",
+    "posts_metrics": "key",
+    "posts_sentiment": "key",
+    "posts_translation": "key",
+    "posts_entities_done": "key",
+    "posts_lemmas": "key",
+    "near_duplicate_clusters": "id",
+    "near_duplicates": "id",
+    rollups.TERMS_TABLE: "term",
+}
+
+# the rollup buckets of the days of the changed posts, weeks included
+ROLLUP_BUCKETS_SQL = f"""
+select period, domain, bucket from main.rollups
+where
+    (period = 'hour' and (domain, substr(bucket, 1, 10)) in
+        (select domain, day from temp.publish_days))
+    or (period = 'day' and (domain, bucket) in
+        (select domain, day from temp.publish_days))
+    or (period = 'week' and (domain, bucket) in
+        (select domain, {rollups.WEEK.replace('bucket', 'day')} from temp.publish_days))
+"""
+
+
+@dataclass
+class PublishResult:
+    number: int = 0
+    posts: int = 0
+    metrics: int = 0
+    entities: int = 0
+    partitions: list = field(default_factory=list)
+    rows: int = 0
+    size: int = 0
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    if TARGETS_TABLE not in db.table_names():
+        db[TARGETS_TABLE].create(
+            {
+                "target": str,
+                "number": int,
+                "seq": int,
+                "metrics_seq": int,
+                "entity_seq": int,
+                "near_duplicates_rowid": int,
+                "sealed_at": str,
+                "terms": str,
+                "published_at": str,
+            },
+            pk="target",
+        )
+    elif "metrics_seq" not in db[TARGETS_TABLE].columns_dict:
+        db[TARGETS_TABLE].add_column("metrics_seq", int)
+    if APPLIED_TABLE not in db.table_names():
+        db[APPLIED_TABLE].create(
+            {"source": str, "number": int, "applied_at": str}, pk="source"
+        )
+    if ENTITY_CHANGES_TABLE not in db.table_names():
+        # entities get their English name long after they were first seen
+        db[ENTITY_CHANGES_TABLE].create({"id": int, "seq": int}, pk="id")
+        db[ENTITY_CHANGES_TABLE].create_index(["seq"])
+    for event, suffix in (("insert", "ai"), ("update", "au")):
+        db.execute(
+            f"""
+            create trigger if not exists entities_publish_{suffix}
+            after {event} on entities begin
+                insert or replace into {ENTITY_CHANGES_TABLE} (id, seq) values (
+                    new.id,
+                    (select coalesce(max(seq), 0) + 1 from {ENTITY_CHANGES_TABLE})
+                );
+            end
+            """
+        )
+
+
+def utcnow():
+    return datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+
+
+def compress(source, path):
+    with open(source, "rb") as fp, gzip.open(path, "wb", COMPRESS_LEVEL) as out:
+        shutil.copyfileobj(fp, out)
+
+
+def decompress(source, path):
+    with gzip.open(source, "rb") as fp, open(path, "wb") as out:
+        shutil.copyfileobj(fp, out)
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {"changesets": []}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def write_manifest(directory, manifest):
+    "replaced in one go, so a replica never reads half a manifest"
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def watermarks(db: sqlite_utils.Database):
+    "how far the database is now, for the next publish to the same target"
+    seq, metrics_seq = export_.current_watermark(db)
+    return {
+        "seq": seq,
+        "metrics_seq": metrics_seq,
+        "entity_seq": db.execute(
+            f"select coalesce(max(seq), 0) from {ENTITY_CHANGES_TABLE}"
+        ).fetchone()[0],
+        "near_duplicates_rowid": db.execute(
+            "select coalesce(max(rowid), 0) from near_duplicates"
+        ).fetchone()[0],
+        "sealed_at": db.execute(
+            f"select coalesce(max(sealed_at), '') from {partitions.CATALOG_TABLE}"
+        ).fetchone()[0],
+        "terms": json.dumps(
+            [row[0] for row in db.execute(f"select term from {rollups.TERMS_TABLE}")]
+        ),
+    }
+
+
+def columns(db: sqlite_utils.Database, table):
+    "stored columns, without the generated id"
+    return ", ".join(f"[{column}]" for column in db[table].columns_dict)
+
+
+def copy_rows(db: sqlite_utils.Database, table, where="1", params=None):
+    "copy the selected rows of table into the changeset, returns their number"
+    db.execute(
+        f"create table {SCHEMA}.[{table}] as select {columns(db, table)}"
+        f" from main.[{table}] where {where}",
+        params or {},
+    )
+    return db.execute(f"select count(*) from {SCHEMA}.[{table}]").fetchone()[0]
+
+
+def fill_changeset(db: sqlite_utils.Database, mark, now, result):
+    """
+    Copy the rows changed since mark (everything without one) into the
+    attached changeset. Returns the months of the partitions to ship.
+    """
+    mark = mark or {
+        "seq": -1,
+        "metrics_seq": -1,
+        "entity_seq": -1,
+        "near_duplicates_rowid": -1,
+        "sealed_at": "",
+        "terms": None,
+    }
+    # posts with new rows, and posts with new metrics
+    db.execute("create temp table publish_changed (key integer primary key)")
+    db.execute("create temp table publish_measured (key integer primary key)")
+    if mark["seq"] < 0:
+        db.execute("insert into temp.publish_changed select key from posts")
+    else:
+        db.execute(
+            "insert into temp.publish_changed select key"
+            f" from {export_.CHANGES_TABLE} where seq > :seq",
+            mark,
+        )
+    db.execute(
+        "insert into temp.publish_measured select key from temp.publish_changed"
+        f" union select key from {export_.METRICS_CHANGES_TABLE} where seq > ?",
+        [export_.mark_metrics_seq(db, mark)],
+    )
+
+    for table in keys.POST_TABLES:
+        selected = "publish_measured" if table == "posts_metrics" else "publish_changed"
+        count = copy_rows(db, table, f"key in (select key from temp.{selected})")
+        result.rows += count
+        if table == "posts":
+            result.posts = count
+        elif table == "posts_metrics":
+            result.metrics = count
+    copy_rows(db, "entity_types")
+    result.entities = copy_rows(
+        db,
+        "entities",
+        f"id in (select id from {ENTITY_CHANGES_TABLE} where seq > :entity_seq)"
+        if mark["entity_seq"] >= 0
+        else "1",
+        mark,
+    )
+    result.rows += result.entities
+    copy_rows(db, rollups.TERMS_TABLE)
+    result.rows += copy_rows(
+        db, "near_duplicates", "rowid > :near_duplicates_rowid", mark
+    )
+    copy_rows(
+        db,
+        "near_duplicate_clusters",
+        f"id in (select cluster from {SCHEMA}.near_duplicates)",
+    )
+    result.rows += copy_rows(
+        db, partitions.CATALOG_TABLE, "sealed_at > :sealed_at", mark
+    )
+    months = [
+        row[0]
+        for row in db.execute(f"select month from {SCHEMA}.{partitions.CATALOG_TABLE}")
+    ]
+
+    # the rollups of the days that changed and of the months that were sealed,
+    # all of them the first time and after the tracked terms changed
+    db.execute(
+        "create temp table publish_days as"
+        " select distinct domain, date(date_utc) as day from posts"
+        " where key in (select key from temp.publish_measured)"
+    )
+    db.execute(
+        f"create table {SCHEMA}.rollup_buckets as {ROLLUP_BUCKETS_SQL}"
+        " union select period, domain, bucket from main.rollups"
+        " where :everything or substr(bucket, 1, 7) in"
+        f" (select month from {SCHEMA}.{partitions.CATALOG_TABLE})",
+        {"everything": mark["seq"] < 0 or mark["terms"] != now["terms"]},
+    )
+    for table in rollups.ROLLUPS:
+        result.rows += copy_rows(
+            db,
+            table,
+            "(period, domain, bucket) in"
+            f" (select period, domain, bucket from {SCHEMA}.rollup_buckets)",
+        )
+    return months
+
+
+def publish(db: sqlite_utils.Database, db_path, directory):
+    """
+    Write the rows changed since the previous publish to directory as a
+    compressed changeset, with the partitions sealed since. The first
+    publish to a directory holds everything. Returns a PublishResult,
+    numbered 0 when there was nothing to publish.
+    """
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.abspath(directory)
+    partitions.ensure_catalog(db)
+    mark = next(
+        db.query(f"select * from {TARGETS_TABLE} where target = ?", [target]), None
+    )
+    manifest = read_manifest(directory)
+    # numbered after the manifest, which is written before the watermark: if
+    # the watermark was lost the rows are published again, under a new number
+    numbers = [entry["number"] for entry in manifest["changesets"]]
+    result = PublishResult(number=max(numbers + [mark["number"] if mark else 0]) + 1)
+    name = f"{result.number:06d}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "changeset.db")
+        db.execute(f"attach database ? as {SCHEMA}", [path])
+        try:
+            # one snapshot for the rows and the watermarks of the next publish
+            db.execute("begin")
+            try:
+                now = watermarks(db)
+                months = fill_changeset(db, mark, now, result)
+                db.conn.commit()
+            except BaseException:
+                db.conn.rollback()
+                raise
+        finally:
+            for table in ("publish_changed", "publish_measured", "publish_days"):
+                db.execute(f"drop table if exists temp.{table}")
+            db.execute(f"detach database {SCHEMA}")
+        if not result.rows:
+            result.number = 0
+            return result
+        compress(path, os.path.join(directory, f"{name}.db.gz"))
+
+    files = {}
+    for month in months:
+        files[month] = f"{name}-{month}.db.gz"
+        compress(
+            partitions.resolve(db_path, partitions.catalog(db)[month]),
+            os.path.join(directory, files[month]),
+        )
+    result.partitions = months
+    result.size = sum(
+        os.path.getsize(os.path.join(directory, file))
+        for file in [f"{name}.db.gz"] + list(files.values())
+    )
+
+    manifest["changesets"].append(
+        {
+            "number": result.number,
+            "file": f"{name}.db.gz",
+            "partitions": files,
+            "posts": result.posts,
+            "metrics": result.metrics,
+            "published_at": utcnow(),
+        }
+    )
+    write_manifest(directory, manifest)
+    with storage.writer(db):
+        db[TARGETS_TABLE].insert(
+            dict(now, target=target, number=result.number, published_at=utcnow()),
+            replace=True,
+        )
+    return result
+
+
+def applied(db: sqlite_utils.Database, source):
+    row = db.execute(
+        f"select number from {APPLIED_TABLE} where source = ?", [source]
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def sync_table(db: sqlite_utils.Database, table, pk):
+    "replace the rows of table that differ from the changeset, add the missing ones"
+    if not db.execute(
+        f"select 1 from {SCHEMA}.sqlite_master where type = 'table' and name = ?",
+        [table],
+    ).fetchone():
+        return 0
+    names = columns(db, table)
+    same = " and ".join(f"m.[{c}] is c.[{c}]" for c in db[table].columns_dict)
+    db.execute(
+        f"delete from main.[{table}] where [{pk}] in ("
+        f" select c.[{pk}] from {SCHEMA}.[{table}] c"
+        f" join main.[{table}] m on m.[{pk}] = c.[{pk}] where not ({same}))"
+    )
+    return db.execute(
+        f"insert into main.[{table}] ({names}) select {names} from {SCHEMA}.[{table}]"
+        f" where [{pk}] not in (select [{pk}] from main.[{table}]) order by [{pk}]"
+    ).rowcount
+
+
+def install_partition(db: sqlite_utils.Database, db_path, source, month, file):
+    "replace the partition of month, and drop its rows from main"
+    directory = partitions.partition_dir(db_path)
+    directory.mkdir(exist_ok=True)
+    path = directory / f"{month}.db"
+    decompress(os.path.join(source, file), f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    partitions.set_writable(path, False)
+    schema = partitions.schema_name(month)
+    db.execute(f"attach database ? as [{schema}]", [str(path)])
+    try:
+        with storage.writer(db):
+            partitions.delete_month(db, month, schema)
+            posts, sealed_at = db.execute(
+                f"select posts, sealed_at from {SCHEMA}.{partitions.CATALOG_TABLE}"
+                " where month = ?",
+                [month],
+            ).fetchone()
+            db[partitions.CATALOG_TABLE].insert(
+                {
+                    "month": month,
+                    "path": os.path.relpath(path, os.path.dirname(db_path) or "."),
+                    "posts": posts,
+                    "size": path.stat().st_size,
+                    "sealed_at": sealed_at,
+                },
+                replace=True,
+            )
+    finally:
+        db.execute(f"detach database [{schema}]")
+    db.partitions = None
+
+
+def apply_changeset(db: sqlite_utils.Database, db_path, source, entry):
+    "apply one changeset of the manifest, in a single transaction"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "changeset.db")
+        decompress(os.path.join(source, entry["file"]), path)
+        db.execute(f"attach database ? as {SCHEMA}", [path])
+        try:
+            for month, file in sorted(entry["partitions"].items()):
+                install_partition(db, db_path, source, month, file)
+            empty = not db.execute("select exists (select 1 from posts)").fetchone()[0]
+            # a new replica builds its full-text indexes once, at the end
+            with fts.bulk_load(db) if empty else contextlib.nullcontext():
+                with storage.writer(db):
+                    for table, pk in SYNCED_TABLES.items():
+                        sync_table(db, table, pk)
+                    db.execute(
+                        "delete from main.posts_entities where key in"
+                        f" (select key from {SCHEMA}.posts_entities_done)"
+                    )
+                    names = columns(db, "posts_entities")
+                    db.execute(
+                        f"insert into main.posts_entities ({names})"
+                        f" select {names} from {SCHEMA}.posts_entities"
+                    )
+                    for table in rollups.ROLLUPS:
+                        names = columns(db, table)
+                        db.execute(
+                            f"delete from main.[{table}] where (period, domain, bucket)"
+                            " in (select period, domain, bucket"
+                            f" from {SCHEMA}.rollup_buckets)"
+                        )
+                        db.execute(
+                            f"insert into main.[{table}] ({names})"
+                            f" select {names} from {SCHEMA}.[{table}]"
+                        )
+                    # the rollups come ready-made from the ingest host
+                    db.execute(f"delete from {rollups.DIRTY_TABLE}")
+                    db[APPLIED_TABLE].insert(
+                        {
+                            "source": os.path.abspath(source),
+                            "number": entry["number"],
+                            "applied_at": utcnow(),
+                        },
+                        replace=True,
+                    )
+        finally:
+            db.execute(f"detach database {SCHEMA}")
+
+
+def apply(db: sqlite_utils.Database, db_path, source, progress=None):
+    """
+    Bring the replica db up-to-date with the changesets published to source
+    that it has not applied yet, in order. Returns their manifest entries.
+    """
+    done = applied(db, os.path.abspath(source))
+    entries = [
+        entry for entry in read_manifest(source)["changesets"] if entry["number"] > done
+    ]
+    for entry in entries:
+        apply_changeset(db, db_path, source, entry)
+        if progress is not None:
+            progress(entry)
+    return entries
@@ -0,0 +1,230 @@
+from dataclasses import dataclass, field
+import datetime
+import json
+import time
+
+import click
+import httpx
+import sqlite_utils
+
+import spevktator.keys as keys
+import spevktator.scraper as scraper
+import spevktator.storage as storage
+
+
+QUEUE_TABLE = "refresh_queue"
+PAGE_SIZE = 5  # posts on a wall page
+DECAY = 0.25  # revisit a post after a quarter of its age
+MIN_INTERVAL = 15 * 60  # seconds
+MAX_INTERVAL = 7 * 24 * 3600  # seconds
+MAX_AGE = 30 * 24 * 3600  # seconds, older posts are no longer refreshed
+MAX_MISSES = 3  # pages without the post, before it is given up
+DEFAULT_REQUESTS = 20  # pages per run
+
+# (re)schedule the posts of `source`, whose metrics were taken at `timestamp`
+SCHEDULE_SQL = f"""
+insert or replace into {QUEUE_TABLE} (key, domain, due_utc, interval, misses)
+select
+    key, domain,
+    strftime('%Y-%m-%dT%H:%M:%S', julianday(measured) + interval / 86400.0),
+    interval, 0
+from
+    (
+        select
+            key, domain, measured, age,
+            cast(min(max(age * {DECAY}, {MIN_INTERVAL}), {MAX_INTERVAL}) as integer)
+                as interval
+        from
+            (
+                select
+                    p.key, p.domain, {{timestamp}} as measured,
+                    (julianday({{timestamp}}) - julianday(p.date_utc)) * 86400 as age
+                from {{source}}
+            )
+    )
+where age < {MAX_AGE}
+"""
+
+# most overdue relative to their interval first, young posts change the fastest
+DUE_SQL = f"""
+select q.key, q.domain, p.date_utc,
+    (julianday(:now) - julianday(q.due_utc)) * 86400 / q.interval as priority
+from {QUEUE_TABLE} q join posts p on p.key = q.key
+where q.due_utc <= :now
+    and (:domains is null or q.domain in (select value from json_each(:domains)))
+order by priority desc
+limit :limit
+"""
+
+
+@dataclass
+class Page:
+    domain: str
+    offset: int
+    keys: list = field(default_factory=list)
+    priority: float = 0.0
+
+
+@dataclass
+class RefreshResult:
+    pages: int = 0
+    refreshed: int = 0
+    missed: int = 0
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    if QUEUE_TABLE not in db.table_names():
+        db[QUEUE_TABLE].create(
+            {
+                "key": int,
+                "domain": str,
+                "due_utc": str,
+                "interval": int,
+                "misses": int,
+            },
+            pk="key",
+        )
+        db[QUEUE_TABLE].create_index(["due_utc"])
+        # schedule the posts scraped before the queue existed
+        with storage.writer(db):
+            db.execute(
+                SCHEDULE_SQL.format(
+                    timestamp="pm.timestamp",
+                    source="posts p join posts_metrics pm on p.key = pm.key",
+                )
+            )
+
+    # every new measurement of a post's metrics, from listen or refresh, reschedules it
+    for event, suffix in (("insert", "ai"), ("update of timestamp", "au")):
+        db.execute(
+            f"""
+            create trigger if not exists posts_metrics_refresh_{suffix}
+            after {event} on posts_metrics begin
+                delete from {QUEUE_TABLE} where key = new.key;
+                {SCHEDULE_SQL.format(
+                    timestamp="new.timestamp", source="posts p where p.key = new.key"
+                )};
+            end
+            """
+        )
+    db.execute(
+        f"""
+        create trigger if not exists posts_refresh_ad after delete on posts begin
+            delete from {QUEUE_TABLE} where key = old.key;
+        end
+        """
+    )
+
+
+def utcnow():
+    return datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+
+
+def due(db: sqlite_utils.Database, now=None):
+    "number of posts due for a refresh"
+    return db.execute(
+        f"select count(*) from {QUEUE_TABLE} where due_utc <= ?", [now or utcnow()]
+    ).fetchone()[0]
+
+
+def positions(db: sqlite_utils.Database, domain, dates):
+    """
+    Estimated offsets on the wall of posts of domain, by their date: the
+    number of newer posts. Counted newest first, in one pass over the index.
+    """
+    result = {}
+    count = 0
+    previous = None
+    for date_utc in sorted(set(dates), reverse=True):
+        if previous is None:
+            sql, params = "date_utc > ?", [date_utc]
+        else:
+            sql, params = "date_utc > ? and date_utc <= ?", [date_utc, previous]
+        count += db.execute(
+            f"select count(*) from posts where domain = ? and {sql}", [domain] + params
+        ).fetchone()[0]
+        result[date_utc] = count
+        previous = date_utc
+    return result
+
+
+def plan(db: sqlite_utils.Database, requests, domains=None, now=None):
+    """
+    The wall pages to request, at most `requests`, covering the most
+    (and most overdue) due posts. Due posts of a domain are sorted by their
+    position and covered greedily with the fewest pages.
+    """
+    params = {
+        "now": now or utcnow(),
+        "domains": json.dumps(list(domains)) if domains else None,
+        "limit": requests * PAGE_SIZE * 10,
+    }
+    by_domain = {}
+    for key, domain, date_utc, priority in db.execute(DUE_SQL, params):
+        by_domain.setdefault(domain, []).append((date_utc, key, priority))
+    pages = []
+    for domain, posts in by_domain.items():
+        offsets = positions(db, domain, [date_utc for date_utc, _, _ in posts])
+        page = None
+        for offset, key, priority in sorted(
+            (offsets[date_utc], key, priority) for date_utc, key, priority in posts
+        ):
+            if page is None or offset >= page.offset + PAGE_SIZE:
+                page = Page(domain, offset)
+                pages.append(page)
+            page.keys.append(key)
+            page.priority += priority
+    pages.sort(key=lambda page: page.priority, reverse=True)
+    return pages[:requests]
+
+
+def mark_missed(db: sqlite_utils.Database, missed, timestamp):
+    "push back posts that were not on their page, give up after MAX_MISSES"
+    for key in missed:
+        db.execute(
+            f"""
+            update {QUEUE_TABLE} set
+                misses = misses + 1,
+                due_utc = strftime('%Y-%m-%dT%H:%M:%S', julianday(?) + interval / 86400.0)
+            where key = ?
+            """,
+            [timestamp, key],
+        )
+        db.execute(
+            f"delete from {QUEUE_TABLE} where key = ? and misses >= {MAX_MISSES}",
+            [key],
+        )
+
+
+def run(
+    db: sqlite_utils.Database,
+    requests=DEFAULT_REQUESTS,
+    domains=None,
+    scrape_delay=False,
+    proxies=None,
+    verbose=False,
+):
+    "refresh the metrics of the due posts, returns a RefreshResult"
+    result = RefreshResult()
+    for page in plan(db, requests, domains):
+        url = scraper.wall_url(page.domain, page.offset)
+        click.echo(f"Refreshing {len(page.keys)} posts of '{page.domain}'... {url}")
+        try:
+            timestamp, r = scraper.fetch_page(db, page.domain, url, proxies)
+        except httpx.HTTPError as exc:
+            click.secho(f"HTTP Exception for {exc.request.url} - {exc}", fg="red")
+            continue
+        # metrics of every post on the page are updated, which reschedules them
+        processed = scraper.process_page(
+            db, page.domain, r.text, verbose=verbose, relative_timestamp=timestamp
+        )
+        found = {keys.post_key(post_id) for post_id in processed.post_ids}
+        missed = [key for key in page.keys if key not in found]
+        with storage.writer(db):
+            mark_missed(db, missed, timestamp.replace(microsecond=0).isoformat())
+        result.pages += 1
+        result.refreshed += len(page.keys) - len(missed)
+        result.missed += len(missed)
+        if scrape_delay:
+            time.sleep(scraper.DEFAULT_DELAY)
+    return result
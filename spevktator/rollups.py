@@ -0,0 +1,301 @@
+import contextlib
+import json
+
+import sqlite_utils
+
+import spevktator.partitions as partitions
+import spevktator.storage as storage
+
+
+DIRTY_TABLE = "rollups_dirty"
+TERMS_TABLE = "rollup_terms"
+BATCH_SIZE = 100  # dirty days refreshed per write batch
+
+# bucket expressions on date_utc, weeks are summed from the days
+PERIODS = {
+    "hour": "strftime('%Y-%m-%dT%H:00:00', p.date_utc)",
+    "day": "date(p.date_utc)",
+}
+WEEK = "strftime('%Y-%W', bucket)"
+
+# the terms of the example charts on the homepage
+DEFAULT_TERMS = (
+    "Ukraine",
+    "HIMARS",
+    "MLRS",
+    "S-300",
+    "MiG-29",
+    "MiG-31",
+    "Su-25",
+    "Su-35",
+)
+
+# the tables the rollups are computed from, in main and in the partitions
+SOURCE_TABLES = (
+    "posts",
+    "posts_metrics",
+    "posts_sentiment",
+    "posts_translation",
+    "posts_entities",
+)
+
+# tables whose changes alter the rollups of the day of their post
+TRIGGER_TABLES = (
+    "posts_metrics",
+    "posts_sentiment",
+    "posts_translation",
+    "posts_entities",
+)
+
+METRICS = """
+    coalesce(sum(ps.positive - ps.negative), 0) as sentiment_sum,
+    count(ps.key) as sentiment_count,
+    coalesce(sum(pm.views), 0) as views
+"""
+JOINS = """
+    left join posts_metrics pm on p.key = pm.key
+    left join posts_sentiment ps on p.key = ps.key
+"""
+WHERE = "p.domain = :domain and p.date_utc >= :start and p.date_utc < :end"
+
+# {table: (key columns, sql computing the rows of one domain and day)}
+ROLLUPS = {
+    "rollups": (
+        (),
+        f"""
+        select {{bucket}} as bucket, p.domain, count(*) as posts, {METRICS},
+            coalesce(sum(pm.likes), 0) as likes, coalesce(sum(pm.shares), 0) as shares
+        from posts p {JOINS}
+        where {WHERE}
+        group by 1
+        """,
+    ),
+    "entity_rollups": (
+        ("entity",),
+        f"""
+        select {{bucket}} as bucket, p.domain, pe.entity,
+            sum(pe.mentions) as mentions, count(*) as posts, {METRICS}
+        from
+            posts p
+            join (
+                select key, entity, count(*) as mentions from posts_entities
+                where key in (select key from posts p where {WHERE})
+                group by key, entity
+            ) pe on p.key = pe.key
+            {JOINS}
+        where {WHERE}
+        group by 1, pe.entity
+        """,
+    ),
+    "term_rollups": (
+        ("term",),
+        f"""
+        select {{bucket}} as bucket, p.domain, t.term, count(*) as posts, {METRICS}
+        from
+            posts p
+            join posts_translation pt on p.key = pt.key
+            join {TERMS_TABLE} t on pt.text_en like '%' || t.term || '%'
+            {JOINS}
+        where {WHERE}
+        group by 1, t.term
+        """,
+    ),
+}
+
+COLUMNS = {
+    "rollups": {"posts": int, "likes": int, "shares": int},
+    "entity_rollups": {"entity": int, "mentions": int, "posts": int},
+    "term_rollups": {"term": str, "posts": int},
+}
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    table_names = set(db.table_names())
+    for table, (keys, _) in ROLLUPS.items():
+        if table not in table_names:
+            columns = {"period": str, "bucket": str, "domain": str}
+            columns.update(COLUMNS[table])
+            columns.update(
+                {"sentiment_sum": float, "sentiment_count": int, "views": int}
+            )
+            db[table].create(
+                columns,
+                pk=("period", "domain", "bucket") + keys,
+                foreign_keys=[("entity", "entities", "id")] if "entity" in keys else [],
+            )
+            if keys:
+                # dashboards select by entity or term
+                db[table].create_index(("period",) + keys + ("bucket",))
+    if TERMS_TABLE not in table_names:
+        db[TERMS_TABLE].create({"term": str}, pk="term")
+        db[TERMS_TABLE].insert_all({"term": term} for term in DEFAULT_TERMS)
+    if DIRTY_TABLE not in table_names:
+        db[DIRTY_TABLE].create({"domain": str, "day": str}, pk=("domain", "day"))
+    # for recomputing the posts of one domain and day
+    db["posts"].create_index(["domain", "date_utc"], if_not_exists=True)
+
+    # ingest and enrichment mark the days they touch, wherever they run
+    db.execute(
+        f"""
+        create trigger if not exists posts_rollups_ai after insert on posts begin
+            insert or ignore into {DIRTY_TABLE} values (new.domain, date(new.date_utc));
+        end
+        """
+    )
+    for table in TRIGGER_TABLES:
+        for event, suffix in (("insert", "ai"), ("update", "au")):
+            db.execute(
+                f"""
+                create trigger if not exists {table}_rollups_{suffix}
+                after {event} on {table} begin
+                    insert or ignore into {DIRTY_TABLE}
+                    select domain, date(date_utc) from posts where key = new.key;
+                end
+                """
+            )
+
+
+def refresh_day(db: sqlite_utils.Database, domain, day):
+    "recompute the hourly, daily and weekly rollups of one domain and day"
+    params = {
+        "domain": domain,
+        "start": day,
+        "end": db.execute("select date(?, '+1 day')", [day]).fetchone()[0],
+    }
+    params["week"], params["monday"], params["sunday"] = db.execute(
+        "select strftime('%Y-%W', ?1), date(?1, '-6 days', 'weekday 1'),"
+        " date(?1, 'weekday 0')",
+        [day],
+    ).fetchone()
+    for table, (keys, sql) in ROLLUPS.items():
+        columns = ", ".join(("bucket", "domain") + tuple(COLUMNS[table]))
+        metrics = "sentiment_sum, sentiment_count, views"
+        for period, bucket in PERIODS.items():
+            db.execute(
+                f"delete from {table} where period = '{period}' and domain = :domain"
+                " and bucket >= :start and bucket < :end",
+                params,
+            )
+            db.execute(
+                f"insert into {table} (period, {columns}, {metrics})"
+                f" select '{period}', {columns}, {metrics}"
+                f" from ({sql.format(bucket=bucket)})",
+                params,
+            )
+        db.execute(
+            f"delete from {table} where period = 'week' and domain = :domain"
+            " and bucket = :week",
+            params,
+        )
+        totals = ", ".join(f"sum({c})" for c in COLUMNS[table] if c not in keys)
+        key_columns = "".join(f"{k}, " for k in keys)
+        db.execute(
+            f"insert into {table} (period, {columns}, {metrics})"
+            f" select 'week', :week, domain, {key_columns}{totals},"
+            " sum(sentiment_sum), sum(sentiment_count), sum(views)"
+            f" from {table} where period = 'day' and domain = :domain"
+            " and bucket between :monday and :sunday"
+            f" and {WEEK} = :week group by domain{''.join(f', {k}' for k in keys)}",
+            params,
+        )
+
+
+@contextlib.contextmanager
+def sealed_month(db: sqlite_utils.Database, month):
+    """
+    Attach the partition of a sealed month and shadow the source tables
+    with views over main and the partition, for this connection only.
+    """
+    schema = partitions.schema_name(month)
+    path = partitions.resolve(storage.database_path(db), partitions.catalog(db)[month])
+    db.execute(f"attach database ? as [{schema}]", [path])
+    try:
+        for table in SOURCE_TABLES:
+            db.execute(
+                f"create temp view [{table}] as"
+                f" {partitions.union_sql(db.conn, table, [schema])}"
+            )
+        yield db
+    finally:
+        for table in SOURCE_TABLES:
+            db.execute(f"drop view if exists temp.[{table}]")
+        db.execute(f"detach database [{schema}]")
+
+
+def refresh_days(db: sqlite_utils.Database, where, params, limit, progress):
+    "refresh the dirty days selected by where, returns their number"
+    count = 0
+    while limit is None or count < limit:
+        size = BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - count)
+        with storage.writer(db):
+            dirty = db.execute(
+                f"select domain, day from {DIRTY_TABLE} where {where} limit :size",
+                dict(params, size=size),
+            ).fetchall()
+            for domain, day in dirty:
+                db.execute(
+                    f"delete from {DIRTY_TABLE} where domain is ? and day is ?",
+                    [domain, day],
+                )
+                if day is not None:
+                    refresh_day(db, domain, day)
+        count += len(dirty)
+        if progress is not None:
+            progress(len(dirty))
+        if len(dirty) < size:
+            break
+    return count
+
+
+def refresh(db: sqlite_utils.Database, limit=None, progress=None):
+    """
+    Bring the rollups of all dirty days up-to-date, in short write batches.
+    Days in sealed months are computed with their partition attached.
+    Returns the number of days refreshed.
+    """
+    sealed = sorted(partitions.catalog(db))
+    count = refresh_days(
+        db,
+        "day is null or substr(day, 1, 7) not in (select value from json_each(:sealed))",
+        {"sealed": json.dumps(sealed)},
+        limit,
+        progress,
+    )
+    for month in sealed:
+        if limit is not None and count >= limit:
+            break
+        where = "substr(day, 1, 7) = :month"
+        if not db.execute(
+            f"select 1 from {DIRTY_TABLE} where {where}", {"month": month}
+        ).fetchone():
+            continue
+        with sealed_month(db, month):
+            count += refresh_days(
+                db,
+                where,
+                {"month": month},
+                None if limit is None else limit - count,
+                progress,
+            )
+    return count
+
+
+def mark_all(db: sqlite_utils.Database):
+    "mark every day with posts as dirty, archived ones too, to (re)build all rollups"
+    days = "select distinct domain, date(date_utc) from {schema}.posts"
+    with storage.writer(db):
+        db.execute(f"insert or ignore into {DIRTY_TABLE} {days.format(schema='main')}")
+    for month in sorted(partitions.catalog(db)):
+        with sealed_month(db, month):
+            with storage.writer(db):
+                db.execute(
+                    f"insert or ignore into {DIRTY_TABLE}"
+                    f" {days.format(schema=partitions.schema_name(month))}"
+                )
+    return db[DIRTY_TABLE].count
+
+
+def add_terms(db: sqlite_utils.Database, terms):
+    "track more terms, the caller rebuilds the rollups afterwards"
+    with storage.writer(db):
+        db[TERMS_TABLE].insert_all(({"term": term} for term in terms), ignore=True)
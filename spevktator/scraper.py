@@ -1,18 +1,26 @@
 import click
 from bs4 import BeautifulSoup
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import dateparser
+import dateparser.conf
 import datetime
 import deepl
 import httpx
+import json
+import os
 import re
 import sqlite_utils
 from sqlite_utils.utils import chunks
 from sqlite_utils.utils import sqlite3
 import time
 
-import spevktator.dostoevsky_sentiment as dostoevsky_sentiment
-import spevktator.natasha_entities as natasha_entities
+import spevktator.keys as keys
+import spevktator.lemmas as lemmas
+import spevktator.models as models
+import spevktator.near_duplicates as near_duplicates
+import spevktator.partitions as partitions
+import spevktator.storage as storage
+import spevktator.text_cache as text_cache
 import spevktator.utils as utils
 
 
@@ -21,11 +29,19 @@ DEFAULT_HEADERS = {
     "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:103.0) Gecko/20100101 Firefox/103.0",
 }
 
-VK_BASE_URL = "https://m.vk.com"
+# point at a local stand-in, like `spevktator mock-vk`, for load tests
+VK_BASE_URL = os.environ.get("SPEVKTATOR_VK_URL", "https://m.vk.com")
 DEFAULT_PAGE_LIMIT = 5
 DEFAULT_DELAY = 5
 DEFAULT_LOOP_DELAY = 300
 ERROR_DELAY = 120
+NER_BATCH_SIZE = 16  # posts per named-entity request
+# dateparser keeps the settings and word caches of every relative base it saw,
+# that is of every page, only keep those of the last pages
+DATEPARSER_CACHE_SIZE = 64
+
+# one DeepL client and its connection pool, rather than one per batch of posts
+_translator = None
 
 
 @dataclass
@@ -33,6 +49,22 @@ class ProcessResult:
     posts_added: int = 0
     last_post_added: bool = False
     earliest_post_date: str = None
+    post_ids: list = field(default_factory=list)
+    next_href: str = None
+
+
+@dataclass
+class PagePost:
+    "a post of a wall page, with what is worked out before it is written"
+
+    id: str
+    post: dict
+    metrics: dict
+    sentiment: dict = None
+    signature: object = None
+
+
+_RE_COMBINE_WHITESPACE = re.compile(r"\s+")
 
 
 def process_page(
@@ -43,124 +75,218 @@ def process_page(
     verbose=True,
     relative_timestamp=None,
 ) -> ProcessResult:
+    """
+    Save the posts of a wall page and their metrics. The page is parsed, and
+    the sentiment and minhash signatures of new posts are computed, before
+    the writer is taken, which is only held for the inserts.
+    """
     soup = BeautifulSoup(html, "html.parser")
-    result = ProcessResult()
+    try:
+        result = ProcessResult()
+        show_more_div = soup.find("div", class_="show_more_wrap")
+        if show_more_div and show_more_div.a:
+            result.next_href = show_more_div.a["href"]
+        posts = parse_posts(domain, soup, relative_timestamp)
+    finally:
+        # the tree is full of reference cycles, free it now rather than at the next gc
+        soup.decompose()
+        trim_dateparser()
+    result.post_ids = [page_post.id for page_post in posts]
+    prepare_posts(db, posts, force)
+    with storage.writer(db):
+        for page_post in posts:
+            save_post(db, domain, page_post, result, force, verbose)
+    return result
 
+
+def parse_posts(domain, soup, relative_timestamp):
+    "the posts of the page, with their metrics as of relative_timestamp"
     # Convert from moscow timezone
-    dateparser_settings = {"TIMEZONE": "Europe/Moscow", "TO_TIMEZONE": "UTC"}
+    dateparser_settings = {
+        "TIMEZONE": "Europe/Moscow",
+        "TO_TIMEZONE": "UTC",
+        "CACHE_SIZE_LIMIT": DATEPARSER_CACHE_SIZE,
+    }
     if relative_timestamp is not None:
         dateparser_settings["RELATIVE_BASE"] = relative_timestamp
+    return [
+        parse_post(domain, post_div, dateparser_settings, relative_timestamp)
+        for post_div in soup.find_all("div", class_="wall_item")
+    ]
 
-    for post_div in soup.find_all("div", class_="wall_item"):
-        post_id = post_div.find("a", class_="post__anchor")["name"].replace("post", "")
-        post_date_raw = post_div.find("a", class_="wi_date").text
 
-        post_date_utc = (
-            dateparser.parse(
-                post_date_raw,
-                settings=dateparser_settings,
-            )
-            .replace(microsecond=0)
-            .isoformat()
-        )
+def parse_post(domain, post_div, dateparser_settings, relative_timestamp):
+    post_id = post_div.find("a", class_="post__anchor")["name"].replace("post", "")
+    post_date_raw = post_div.find("a", class_="wi_date").text
 
-        post_text_div = post_div.find(class_="pi_text")
-        if post_text_div:
-            pi_text_more = post_text_div.find(class_="pi_text_more")
-            if pi_text_more:
-                # strip "See more" in post
-                pi_text_more.decompose()
+    post_date_utc = (
+        dateparser.parse(
+            post_date_raw,
+            settings=dateparser_settings,
+        )
+        .replace(microsecond=0)
+        .isoformat()
+    )
 
-        post_text = post_text_div.get_text(separator=" ") if post_text_div else ""
+    post_text_div = post_div.find(class_="pi_text")
+    if post_text_div:
+        pi_text_more = post_text_div.find(class_="pi_text_more")
+        if pi_text_more:
+            # strip "See more" in post
+            pi_text_more.decompose()
+
+    post_text = post_text_div.get_text(separator=" ") if post_text_div else ""
+    post_text = _RE_COMBINE_WHITESPACE.sub(" ", post_text).strip()
+
+    post = {
+        "key": keys.post_key(post_id),
+        "domain": domain,
+        "date_utc": post_date_utc,
+        "text": post_text,
+        "text_hash": text_cache.text_hash(post_text),
+    }
+
+    post_buttons_div = post_div.find(class_="_wi_buttons")
+
+    # <div aria-hidden="true" class="svgIcon svgIcon-like_outline_24">
+    # <span class="PostBottomButtonReaction__label" aria-hidden="true">11</span>
+    # <span class="visually-hidden">1738 people reacted</span>
+    post_buttons_a = post_buttons_div.find_all("a", class_="PostBottomButton")
+    likes_text = (
+        post_buttons_a[0].parent.find_all("span", class_="visually-hidden")[-1].text
+    )
+    likes = int(re.sub(r" (person|people) reacted", "", likes_text))
 
-        _RE_COMBINE_WHITESPACE = re.compile(r"\s+")
-        post_text = _RE_COMBINE_WHITESPACE.sub(" ", post_text).strip()
+    # <div aria-hidden="true" class="svgIcon svgIcon-share_outline_24">
+    # <span class="PostBottomButton__label" aria-hidden="true">2</span>
+    shares = int(post_buttons_a[1]["aria-label"].replace(" Share", ""))
 
-        post = {
-            "id": post_id,
-            "domain": domain,
-            "date_utc": post_date_utc,
-            "text": post_text,
+    # <div class="PostRowBottomButtons__views">
+    # <span class=" wall_item_views" aria-label="262671 views">
+    views_div = post_buttons_div.find(class_="wall_item_views")
+    if views_div and "aria-label" in views_div.attrs:
+        views = int(re.sub(r" views?", "", views_div["aria-label"]))
+    else:
+        views = 0
+    metrics = {
+        "key": post["key"],
+        "likes": likes,
+        "shares": shares,
+        "views": views,
+        "timestamp": relative_timestamp.replace(microsecond=0).isoformat(),
+    }
+    # post_explain_div = post_div.find(class_="wi_explain")
+    # if post_explain_div and "pinned post" in post_explain_div.text:
+    #     # only set when pinned, to prevent unsetting it when it gets unpinned
+    #     metrics["was_pinned"] = True
+    return PagePost(post_id, post, metrics)
+
+
+def prepare_posts(db: sqlite_utils.Database, posts, force):
+    """
+    Compute the minhash signatures of the posts that are new, and the
+    sentiment of those with a text that is not in the cache, without
+    holding the writer
+    """
+    keys_json = json.dumps([page_post.post["key"] for page_post in posts])
+    existing = set()
+    if not force:
+        existing = {
+            key
+            for key, in db.execute(
+                "select key from posts where key in (select value from json_each(?))",
+                [keys_json],
+            )
         }
+    new = [
+        page_post
+        for page_post in posts
+        if page_post.post["text"] and page_post.post["key"] not in existing
+    ]
+    for page_post in new:
+        page_post.signature = near_duplicates.signature(page_post.post["text"])
+    cached = {
+        text_hash
+        for text_hash, in db.execute(
+            f"select hash from {text_cache.SENTIMENT_TABLE}"
+            " where hash in (select value from json_each(?))",
+            [json.dumps([page_post.post["text_hash"] for page_post in new])],
+        )
+    }
+    pending = [
+        page_post for page_post in new if page_post.post["text_hash"] not in cached
+    ]
+    if not pending or not models.sentiment_available():
+        return
+    # equal texts on the page go through the model once
+    texts = list(dict.fromkeys(page_post.post["text"] for page_post in pending))
+    scores = dict(zip(texts, models.predict_sentiment(texts)))
+    for page_post in pending:
+        page_post.sentiment = scores[page_post.post["text"]]
 
-        post_buttons_div = post_div.find(class_="_wi_buttons")
 
-        # <div aria-hidden="true" class="svgIcon svgIcon-like_outline_24">
-        # <span class="PostBottomButtonReaction__label" aria-hidden="true">11</span>
-        # <span class="visually-hidden">1738 people reacted</span>
-        post_buttons_a = post_buttons_div.find_all("a", class_="PostBottomButton")
-        likes_text = (
-            post_buttons_a[0].parent.find_all("span", class_="visually-hidden")[-1].text
-        )
-        likes = int(re.sub(r" (person|people) reacted", "", likes_text))
+def save_post(db: sqlite_utils.Database, domain, page_post, result, force, verbose):
+    "write a post prepared by prepare_posts, and its metrics"
+    post, post_id = page_post.post, page_post.id
+    try:
+        if partitions.archived(db, post["key"], post["date_utc"]):
+            # its metrics are staged here until the next archive run
+            raise sqlite3.IntegrityError(f"{post_id} is archived")
+        db["posts"].insert(post, pk="key", replace=force)
+        if page_post.signature is not None:
+            near_duplicates.add_signature(
+                db, dict(post, id=post_id), page_post.signature
+            )
+        if verbose:
+            click.echo(f"POST {domain}/{post_id} {post['date_utc']} added")
+        result.posts_added += 1
+        result.last_post_added = True
+        if (
+            result.earliest_post_date is None
+            or post["date_utc"] < result.earliest_post_date
+        ):
+            result.earliest_post_date = post["date_utc"]
+        save_sentiment(db, post, page_post.sentiment, force)
+    except sqlite3.IntegrityError:
+        if verbose:
+            click.echo(f"POST {domain}/{post_id} already exists, skipping")
+        result.last_post_added = False
+
+    db["posts_metrics"].upsert(
+        page_post.metrics,
+        pk="key",
+        column_order=("key", "shares", "likes", "views", "timestamp"),
+    )
 
-        # <div aria-hidden="true" class="svgIcon svgIcon-share_outline_24">
-        # <span class="PostBottomButton__label" aria-hidden="true">2</span>
-        shares = int(post_buttons_a[1]["aria-label"].replace(" Share", ""))
 
-        # <div class="PostRowBottomButtons__views">
-        # <span class=" wall_item_views" aria-label="262671 views">
-        views_div = post_buttons_div.find(class_="wall_item_views")
-        if views_div and "aria-label" in views_div.attrs:
-            views = int(re.sub(r" views?", "", views_div["aria-label"]))
-        else:
-            views = 0
-        metrics = {
-            "id": post_id,
-            "likes": likes,
-            "shares": shares,
-            "views": views,
-            "timestamp": relative_timestamp.replace(microsecond=0).isoformat(),
-        }
-        # post_explain_div = post_div.find(class_="wi_explain")
-        # if post_explain_div and "pinned post" in post_explain_div.text:
-        #     # only set when pinned, to prevent unsetting it when it gets unpinned
-        #     metrics["was_pinned"] = True
+def save_sentiment(db: sqlite_utils.Database, post, sentiment, force):
+    "the cached sentiment of the text of a new post, or the one predicted for it"
+    if (
+        not post["text"]
+        # a copy of a text seen before, from another domain or a repost
+        or text_cache.copy_sentiment(db, ":key", {"key": post["key"]})
+        or sentiment is None
+    ):
+        return
+    db["posts_sentiment"].insert(
+        dict(sentiment, key=post["key"]),
+        pk="key",
+        column_order=("key", "positive", "negative", "neutral", "skip", "speech"),
+        replace=force,
+    )
+    text_cache.store_sentiment(db, [post["key"]])
+    text_cache.record(db, "sentiment", misses=1)
 
-        # XXX convert into upsert_all in outside loop
-        with db.conn:
-            try:
-                db["posts"].insert(post, pk="id", replace=force)
-                if verbose:
-                    click.echo(f"POST {domain}/{post_id} {post_date_utc} added")
-                result.posts_added += 1
-                result.last_post_added = True
-                if (
-                    result.earliest_post_date is None
-                    or post_date_utc < result.earliest_post_date
-                ):
-                    result.earliest_post_date = post_date_utc
-
-                if post_text and dostoevsky_sentiment.model is not None:
-                    sentiment_item = {"id": post_id}
-                    sentiment_item.update(dostoevsky_sentiment.predict([post_text])[0])
-                    db["posts_sentiment"].insert(
-                        sentiment_item,
-                        pk="id",
-                        column_order=(
-                            "id",
-                            "positive",
-                            "negative",
-                            "neutral",
-                            "skip",
-                            "speech",
-                        ),
-                        replace=force,
-                    )
-            except sqlite3.IntegrityError:
-                if verbose:
-                    click.echo(f"POST {domain}/{post_id} already exists, skipping")
-                result.last_post_added = False
 
-            db["posts_metrics"].upsert(
-                metrics,
-                pk="id",
-                column_order=("id", "shares", "likes", "views", "timestamp"),
-            )
-    return result
+def trim_dateparser():
+    "drop all but the most recent settings dateparser keeps, one per relative base"
+    registry = getattr(dateparser.conf.Settings, "__registry_dict", {})
+    for key in list(registry)[:-DATEPARSER_CACHE_SIZE]:
+        if key != "default":
+            registry.pop(key, None)
 
 
-def next_url(domain, html, result, pages_requested, force, limit, until) -> str:
+def next_url(domain, result, pages_requested, force, limit, until) -> str:
     if not force:
         if result.posts_added == 0:
             click.echo(f"Nothing added, done with {domain}")
@@ -172,11 +298,8 @@ def next_url(domain, html, result, pages_requested, force, limit, until) -> str:
         click.echo(f"Until date {until} reached, done with {domain}")
         return None
     if pages_requested < limit:
-        soup = BeautifulSoup(html, "html.parser")
-        show_more_div = soup.find("div", class_="show_more_wrap")
-        if show_more_div:
-            show_more_href = show_more_div.a["href"]
-            url = f"{VK_BASE_URL}{show_more_href}"
+        if result.next_href:
+            url = f"{VK_BASE_URL}{result.next_href}"
             click.echo(f"next url will be {url}")
             return url
         else:
@@ -187,6 +310,45 @@ def next_url(domain, html, result, pages_requested, force, limit, until) -> str:
         return None
 
 
+def wall_url(domain, offset=0):
+    if not offset:
+        return f"{VK_BASE_URL}/{domain}"
+    return f"{VK_BASE_URL}/{domain}?offset={offset}&own=1"
+
+
+def retryable(exc: httpx.HTTPError):
+    "connection problems, rate limits and server errors, others won't go away by waiting"
+    if not isinstance(exc, httpx.HTTPStatusError):
+        return True
+    return exc.response.status_code == 429 or exc.response.status_code >= 500
+
+
+def fetch_page(db: sqlite_utils.Database, domain, url, proxies=None):
+    "request a wall page, returns (timestamp, response), failures go to the scrape_log"
+    timestamp = datetime.datetime.utcnow()
+    r = httpx.get(url, headers=DEFAULT_HEADERS, proxies=proxies)
+    if r.status_code != 200:
+        with storage.writer(db):
+            db["scrape_log"].insert(
+                {
+                    "domain": domain,
+                    "timestamp": timestamp.isoformat(),
+                    "url": url,
+                    "status_code": r.status_code,
+                    "html": r.text.strip(),
+                },
+            )
+
+        # rate limits and server errors are retried by the caller
+        raise httpx.HTTPStatusError(
+            f"{r.status_code} for {url}", request=r.request, response=r
+        )
+    assert r.headers["content-type"] == "text/html; charset=utf-8", r.headers[
+        "content-type"
+    ]
+    return timestamp, r
+
+
 def fetch_domains(
     db: sqlite_utils.Database,
     domains: list,
@@ -197,40 +359,25 @@ def fetch_domains(
     until=None,
     deepl_auth_key=None,
     proxies=None,
+    error_delay=ERROR_DELAY,
 ):
+    "scrape the new posts of the domains, returns the number of posts added"
+    added = 0
     for domain in domains:
         pages_requested = 0
 
-        if not offset:
-            url = f"{VK_BASE_URL}/{domain}"
-        else:
-            url = f"{VK_BASE_URL}/{domain}?offset={offset}&own=1"
+        url = wall_url(domain, offset)
 
         while True:
-            timestamp = datetime.datetime.utcnow()
             click.echo(f"Scraping VK domain '{domain}'... {url}")
             try:
-                r = httpx.get(url, headers=DEFAULT_HEADERS, proxies=proxies)
+                timestamp, r = fetch_page(db, domain, url, proxies)
             except httpx.HTTPError as exc:
                 click.secho(f"HTTP Exception for {exc.request.url} - {exc}", fg="red")
-                time.sleep(ERROR_DELAY)
+                if not retryable(exc):
+                    break
+                time.sleep(error_delay)
                 continue
-            if r.status_code != 200:
-                with db.conn:
-                    db["scrape_log"].insert(
-                        {
-                            "domain": domain,
-                            "timestamp": timestamp.isoformat(),
-                            "url": url,
-                            "status_code": r.status_code,
-                            "html": r.text.strip(),
-                        },
-                    )
-
-            assert r.status_code == 200, r.status_code
-            assert r.headers["content-type"] == "text/html; charset=utf-8", r.headers[
-                "content-type"
-            ]
             pages_requested += 1
             result = process_page(
                 db, domain, r.text, force, relative_timestamp=timestamp
@@ -247,32 +394,46 @@ def fetch_domains(
                 fg="green",
             )
 
-            # translate
-            if result.posts_added > 0 and deepl_auth_key is not None:
-                translate_posts(db, deepl_auth_key, limit=result.posts_added)
-
-            # named entities recognition
+            added += result.posts_added
             if result.posts_added > 0:
-                ner_count = extract_named_entities(db, limit=result.posts_added)
-                if ner_count > 0 and deepl_auth_key is not None:
-                    translate_entities(db, deepl_auth_key, limit=ner_count)
+                enrich_new_posts(db, result.posts_added, deepl_auth_key)
 
             if scrape_delay:
                 time.sleep(DEFAULT_DELAY)
-            url = next_url(domain, r.text, result, pages_requested, force, limit, until)
+            url = next_url(domain, result, pages_requested, force, limit, until)
             if url is None:
                 break
+    return added
+
+
+def enrich_new_posts(db: sqlite_utils.Database, count, deepl_auth_key=None):
+    "translate and extract the named entities of the count posts just added"
+    if deepl_auth_key is not None:
+        translate_posts(db, deepl_auth_key, limit=count)
+
+    # named entities recognition
+    ner_count = extract_named_entities(db, limit=count)
+    if ner_count > 0 and deepl_auth_key is not None:
+        translate_entities(db, deepl_auth_key, limit=ner_count)
+
+
+def deepl_translator(deepl_auth_key):
+    "the DeepL client for the key, reused for as long as the key stays the same"
+    global _translator
+    if _translator is None or _translator[0] != deepl_auth_key:
+        _translator = (deepl_auth_key, deepl.Translator(deepl_auth_key))
+    return _translator[1]
 
 
 def translate_posts(
     db: sqlite_utils.Database, deepl_auth_key: str, limit: int, verbose=False
 ):
-    translator = deepl.Translator(deepl_auth_key)
+    translator = deepl_translator(deepl_auth_key)
 
     output_table = "posts_translation"
     sql = (
-        "select id, text from posts where text != '' and length(text) <= 2500"
-        f" and id not in (select id from {output_table}) order by date_utc desc"
+        "select key, text from posts where text != '' and length(text) <= 2500"
+        f" and key not in (select key from {output_table}) order by date_utc desc"
     )
     if limit:
         sql += f" limit {limit}"
@@ -303,16 +464,18 @@ def translate_posts(
                 to_insert = []
                 for i, translation in enumerate(result):
                     to_insert.append(
-                        {"id": chunk[i]["id"], "text_en": translation.text}
+                        {"key": chunk[i]["key"], "text_en": translation.text}
                     )
                     translation_count += 1
 
-                db[output_table].insert_all(
-                    to_insert,
-                    pk="id",
-                    column_order=("id", "text_en"),
-                    foreign_keys=[("id", "posts")],
-                )
+                with storage.writer(db):
+                    db[output_table].insert_all(
+                        to_insert,
+                        pk="key",
+                        column_order=("key", "text_en"),
+                        foreign_keys=[("key", "posts")],
+                        ignore=True,
+                    )
 
         click.echo(f"{translation_count} posts translated")
 
@@ -327,7 +490,7 @@ def translate_posts(
 def translate_entities(
     db: sqlite_utils.Database, deepl_auth_key: str, limit: int, verbose=False
 ):
-    translator = deepl.Translator(deepl_auth_key)
+    translator = deepl_translator(deepl_auth_key)
 
     sql = (
         "select id, name from entities where name != '' and (name_en = '' or name_en is null)"
@@ -360,9 +523,12 @@ def translate_entities(
                 if verbose:
                     click.echo([item.text for item in result])
 
-                for i, translation in enumerate(result):
-                    db["entities"].update(chunk[i]["id"], {"name_en": translation.text})
-                    translation_count += 1
+                with storage.writer(db):
+                    for i, translation in enumerate(result):
+                        db["entities"].update(
+                            chunk[i]["id"], {"name_en": translation.text}
+                        )
+                        translation_count += 1
 
         click.echo(f"{translation_count} entities translated")
 
@@ -373,18 +539,26 @@ def translate_entities(
         )
 
 
-def extract_named_entities(db: sqlite_utils.Database, limit: int, verbose=False):
+def extract_named_entities(
+    db: sqlite_utils.Database, limit: int, verbose=False, level=None
+):
 
     output_table = "posts_entities"
     done_table = f"{output_table}_done"
     sql = (
-        "select id, text from posts where text != ''"
-        f" and id not in (select id from {done_table})"
+        "select key, text from posts where text != ''"
+        f" and key not in (select key from {done_table})"
         " order by date_utc desc"
     )
     if limit:
         sql += f" limit {limit}"
     params = dict()
+    # lemmas for search, of the copied posts too
+    lemmas.fill(db, f"select key from ({sql})", params)
+    # texts seen before get the entities of their earlier copy
+    copied = text_cache.copy_entities(db, f"select key from ({sql})", params)
+    if copied:
+        click.echo(f"Named-entities of {copied} posts copied from the cache")
     rows = db.query(sql, params)
 
     # Run a count, for the progress bar
@@ -393,39 +567,64 @@ def extract_named_entities(db: sqlite_utils.Database, limit: int, verbose=False)
     ner_count = 0
     click.echo(f"Extracting named-entities up to {limit} posts...")
     with click.progressbar(rows, length=count) as bar:
-        for row in bar:
-            if verbose:
-                click.echo(row)
-            entities = natasha_entities.named_entity_normalization(row["text"])
-
-            to_insert = []
-            for entity in entities:
-                if verbose:
-                    click.echo(f"-> {entity}")
-                to_insert.append(
-                    {
-                        "id": row["id"],
-                        "entity": db["entities"].lookup(
+        for chunk in chunks(bar, NER_BATCH_SIZE):
+            chunk = list(chunk)
+            # equal texts within the chunk go through the model once
+            texts = list(dict.fromkeys(row["text"] for row in chunk))
+            results = dict(zip(texts, models.named_entities(texts, level=level)))
+
+            with storage.writer(db):
+                # another listen worker may have done some meanwhile
+                done = {
+                    key
+                    for key, in db.execute(
+                        f"select key from {done_table} where key in"
+                        " (select value from json_each(?))",
+                        [json.dumps([row["key"] for row in chunk])],
+                    )
+                }
+                chunk = [row for row in chunk if row["key"] not in done]
+                for row in chunk:
+                    entities = results[row["text"]]
+                    if verbose:
+                        click.echo(row)
+                    to_insert = []
+                    for entity in entities:
+                        if verbose:
+                            click.echo(f"-> {entity}")
+                        to_insert.append(
                             {
-                                "type": db["entity_types"].lookup(
-                                    {"value": entity["type"]}
+                                "key": row["key"],
+                                "entity": db["entities"].lookup(
+                                    {
+                                        "type": db["entity_types"].lookup(
+                                            {"value": entity["type"]}
+                                        ),
+                                        "name": entity["normal"],
+                                    }
                                 ),
-                                "name": entity["normal"],
+                                "begin_offset": entity["start"],
+                                "end_offset": entity["stop"],
                             }
-                        ),
-                        "begin_offset": entity["start"],
-                        "end_offset": entity["stop"],
-                    }
-                )
-                ner_count += 1
+                        )
+                        ner_count += 1
 
-            db[output_table].insert_all(to_insert)
+                    db[output_table].insert_all(to_insert)
 
-            db[done_table].insert_all(
-                [{"id": row["id"]}], pk="id", foreign_keys=[("id", "posts", "id")]
-            )
+                    db[done_table].insert_all(
+                        [{"key": row["key"]}],
+                        pk="key",
+                        foreign_keys=[("key", "posts", "key")],
+                    )
+
+                    post_count += 1
 
-            post_count += 1
+                text_cache.store_entities(db, [row["key"] for row in chunk])
+                # of the posts written, those with a text seen before in the chunk
+                misses = len({row["text"] for row in chunk})
+                text_cache.record(
+                    db, "entities", hits=len(chunk) - misses, misses=misses
+                )
 
     click.echo(f"{ner_count} extracted out of {post_count} posts")
     return ner_count
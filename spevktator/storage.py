@@ -0,0 +1,146 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+import sqlite_utils
+
+try:
+    import fcntl
+except ImportError:  # Windows, fall back to SQLite's own locking
+    fcntl = None
+
+
+BUSY_TIMEOUT = 30_000  # ms
+WAL_AUTOCHECKPOINT = 1000  # pages
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024  # bytes kept after a checkpoint
+VERSION_TABLE = "data_version"
+
+
+class WriterConnection(sqlite3.Connection):
+    """
+    Connection whose commits are deferred while a write batch is open,
+    so the `with db.conn:` blocks inside sqlite-utils join the batch.
+    """
+
+    batch_depth = 0
+
+    def commit(self):
+        if not self.batch_depth:
+            super().commit()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.batch_depth:
+            # a failing statement is already undone by SQLite, keep the batch
+            return False
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class WriteLock:
+    "exclusive advisory lock on <db_path>.lock, shared by all spevktator processes"
+
+    def __init__(self, db_path):
+        self.path = f"{db_path}.lock"
+        self.fp = None
+        self.local = threading.RLock()
+
+    def acquire(self):
+        self.local.acquire()
+        if fcntl is not None:
+            self.fp = open(self.path, "a")
+            fcntl.flock(self.fp, fcntl.LOCK_EX)
+
+    def release(self):
+        if self.fp is not None:
+            fcntl.flock(self.fp, fcntl.LOCK_UN)
+            self.fp.close()
+            self.fp = None
+        self.local.release()
+
+
+def database_path(db: sqlite_utils.Database):
+    for row in db.execute("pragma database_list").fetchall():
+        if row[1] == "main":
+            return row[2]
+
+
+def open_database(db_path, wal=True) -> sqlite_utils.Database:
+    "open db_path for concurrent use: WAL, busy timeout and a dedicated writer"
+    conn = sqlite3.connect(str(db_path), factory=WriterConnection)
+    db = sqlite_utils.Database(conn)
+    db.execute(f"pragma busy_timeout = {BUSY_TIMEOUT}")
+    if not db.table_names():
+        # only takes effect before the first table, see maintenance.vacuum
+        db.execute("pragma auto_vacuum = incremental")
+    if wal:
+        db.enable_wal()
+        # durable at checkpoints, no fsync on every commit
+        db.execute("pragma synchronous = normal")
+        db.execute(f"pragma wal_autocheckpoint = {WAL_AUTOCHECKPOINT}")
+        db.execute(f"pragma journal_size_limit = {JOURNAL_SIZE_LIMIT}")
+    db.write_lock = WriteLock(os.path.abspath(db_path))
+    ensure_version_table(db)
+    return db
+
+
+def ensure_version_table(db: sqlite_utils.Database):
+    "a single counter, bumped by every write batch that changed something"
+    if VERSION_TABLE not in db.table_names():
+        db[VERSION_TABLE].create({"id": int, "version": int}, pk="id")
+        db[VERSION_TABLE].insert({"id": 1, "version": 0})
+
+
+def data_version(db: sqlite_utils.Database):
+    return db.execute(f"select version from {VERSION_TABLE}").fetchone()[0]
+
+
+@contextlib.contextmanager
+def writer(db: sqlite_utils.Database):
+    """
+    Run the enclosed writes as one batch: a single IMMEDIATE transaction,
+    holding the write lock so concurrent commands never interleave.
+    Nested blocks join the outer batch.
+    """
+    conn = db.conn
+    if not isinstance(conn, WriterConnection):
+        with conn:
+            yield db
+        return
+    if conn.batch_depth:
+        conn.batch_depth += 1
+        try:
+            yield db
+        finally:
+            conn.batch_depth -= 1
+        return
+
+    lock = getattr(db, "write_lock", None)
+    if lock is not None:
+        lock.acquire()
+    try:
+        if conn.in_transaction:
+            sqlite3.Connection.commit(conn)
+        conn.execute("begin immediate")
+        conn.batch_depth = 1
+        changes = conn.total_changes
+        try:
+            yield db
+            if conn.total_changes != changes:
+                # lets readers, like the Datasette plugins, drop their caches
+                conn.execute(f"update {VERSION_TABLE} set version = version + 1")
+        except BaseException:
+            conn.batch_depth = 0
+            conn.rollback()
+            raise
+        conn.batch_depth = 0
+        sqlite3.Connection.commit(conn)
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def checkpoint(db: sqlite_utils.Database, mode="passive"):
+    "checkpoint the WAL, returns (busy, wal pages, checkpointed pages)"
+    if db.journal_mode != "wal":
+        return None
+    return tuple(db.execute(f"pragma wal_checkpoint({mode})").fetchone())
@@ -0,0 +1,526 @@
+import contextlib
+import datetime
+import json
+import random
+from dataclasses import dataclass
+
+import sqlite_utils
+from sqlite_utils.utils import chunks
+
+import spevktator.events as events
+import spevktator.export as export_
+import spevktator.fts as fts
+import spevktator.keys as keys
+import spevktator.refresh as refresh
+import spevktator.rollups as rollups
+import spevktator.storage as storage
+import spevktator.text_cache as text_cache
+
+
+# relative volume per domain, roughly matching the public demo archive
+DEFAULT_DOMAINS = {
+    "life": 26125,
+    "tassagency": 23890,
+    "ria": 10198,
+    "nws_ru": 3528,
+    "mash": 3309,
+}
+
+MAX_POSTS = 10_000_000
+DEFAULT_START = "2022-02-01"
+DEFAULT_END = "2022-09-04"
+BATCH_SIZE = 10_000
+SENTENCE_POOL_SIZE = 20_000
+# the tables synthesize fills per post
+LOADED_TABLES = (
+    "posts",
+    "posts_metrics",
+    "posts_sentiment",
+    "posts_translation",
+    "posts_entities",
+    "posts_entities_done",
+)
+
+# posts per hour of the day (Moscow time), news desks are quiet at night
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 4, 6, 8, 9, 9, 9, 9, 9, 9, 9, 8, 8, 7, 6, 5, 4, 3, 2]
+
+WORDS = [
+    ("в", "in"),
+    ("на", "on"),
+    ("и", "and"),
+    ("с", "with"),
+    ("по", "by"),
+    ("что", "that"),
+    ("не", "not"),
+    ("для", "for"),
+    ("заявил", "stated"),
+    ("сообщил", "reported"),
+    ("сообщают", "report"),
+    ("рассказал", "told"),
+    ("президент", "president"),
+    ("правительство", "government"),
+    ("министр", "minister"),
+    ("глава", "head"),
+    ("город", "city"),
+    ("область", "region"),
+    ("район", "district"),
+    ("страна", "country"),
+    ("войска", "troops"),
+    ("армия", "army"),
+    ("удар", "strike"),
+    ("обстрел", "shelling"),
+    ("атака", "attack"),
+    ("попытка", "attempt"),
+    ("десант", "landing"),
+    ("станция", "plant"),
+    ("электростанция", "power plant"),
+    ("энергоблок", "power unit"),
+    ("санкции", "sanctions"),
+    ("переговоры", "negotiations"),
+    ("встреча", "meeting"),
+    ("решение", "decision"),
+    ("суд", "court"),
+    ("закон", "law"),
+    ("цены", "prices"),
+    ("рубль", "ruble"),
+    ("доллар", "dollar"),
+    ("газ", "gas"),
+    ("нефть", "oil"),
+    ("зерно", "grain"),
+    ("граница", "border"),
+    ("жители", "residents"),
+    ("эвакуация", "evacuation"),
+    ("помощь", "aid"),
+    ("новый", "new"),
+    ("крупный", "major"),
+    ("важный", "important"),
+    ("сегодня", "today"),
+    ("вчера", "yesterday"),
+    ("утром", "in the morning"),
+    ("вечером", "in the evening"),
+    ("после", "after"),
+    ("против", "against"),
+    ("около", "about"),
+    ("более", "more than"),
+    ("тысяч", "thousand"),
+    ("миллионов", "million"),
+    ("человек", "people"),
+    ("военные", "military"),
+    ("специальной", "special"),
+    ("операции", "operation"),
+    ("безопасность", "security"),
+    ("ситуация", "situation"),
+    ("контроль", "control"),
+    ("территория", "territory"),
+    ("освобождение", "liberation"),
+    ("сорвана", "thwarted"),
+    ("уничтожены", "destroyed"),
+    ("задержан", "detained"),
+    ("опубликовано", "published"),
+    ("видео", "video"),
+    ("фото", "photo"),
+    ("источник", "source"),
+    ("эксперты", "experts"),
+    ("журналисты", "journalists"),
+    ("погода", "weather"),
+    ("футбол", "football"),
+    ("звезда", "star"),
+]
+
+# name, English name, natasha entity type
+ENTITIES = [
+    ("Москва", "Moscow", "LOC"),
+    ("Россия", "Russia", "LOC"),
+    ("Украина", "Ukraine", "LOC"),
+    ("Запорожье", "Zaporozhye", "LOC"),
+    ("Запорожская область", "Zaporizhzhia region", "LOC"),
+    ("Энергодар", "Energodar", "LOC"),
+    ("Херсон", "Kherson", "LOC"),
+    ("Харьков", "Kharkov", "LOC"),
+    ("Донбасс", "Donbass", "LOC"),
+    ("ДНР", "DNR", "LOC"),
+    ("ЛНР", "LNR", "LOC"),
+    ("Мариуполь", "Mariupol", "LOC"),
+    ("Крым", "Crimea", "LOC"),
+    ("Киев", "Kiev", "LOC"),
+    ("США", "USA", "LOC"),
+    ("Европа", "Europe", "LOC"),
+    ("ЗАЭС", "ZNPP", "ORG"),
+    ("МАГАТЭ", "IAEA", "ORG"),
+    ("ВСУ", "AFU", "ORG"),
+    ("Минобороны", "Ministry of Defense", "ORG"),
+    ("НАТО", "NATO", "ORG"),
+    ("ООН", "UN", "ORG"),
+    ("Росатом", "Rosatom", "ORG"),
+    ("Газпром", "Gazprom", "ORG"),
+    ("Кремль", "Kremlin", "ORG"),
+    ("Владимир Путин", "Vladimir Putin", "PER"),
+    ("Владимир Зеленский", "Vladimir Zelensky", "PER"),
+    ("Сергей Шойгу", "Sergei Shoigu", "PER"),
+    ("Сергей Лавров", "Sergei Lavrov", "PER"),
+    ("Дмитрий Песков", "Dmitry Peskov", "PER"),
+    ("Рафаэль Гросси", "Rafael Grossi", "PER"),
+    ("Джо Байден", "Joe Biden", "PER"),
+]
+
+# weapon systems and aircraft used by the homepage example queries
+KEYWORDS = [
+    ("HIMARS", "HIMARS"),
+    ("РСЗО", "MLRS"),
+    ("С-300", "S-300"),
+    ("МиГ-29", "MiG-29"),
+    ("МиГ-31", "MiG-31"),
+    ("Су-25", "Su-25"),
+    ("Су-35", "Su-35"),
+    ("крейсер Москва", "Moskva cruiser"),
+]
+
+SYLLABLES = [
+    "ба", "ва", "го", "да", "ев", "жи", "за", "ин", "ка", "ло", "ми", "но", "ор",
+    "па", "ри", "со", "ту", "ус", "фе", "хо", "це", "чи", "ша", "ще", "ют", "як",
+]  # fmt: skip
+
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z",
+    "и": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r",
+    "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch",
+    "ш": "sh", "щ": "shch", "ю": "yu", "я": "ya",
+}  # fmt: skip
+
+
+def zipf_weights(n, s=1.1):
+    "cumulative Zipf weights, for use with random.choices(cum_weights=...)"
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, n + 1):
+        total += 1.0 / rank**s
+        cum_weights.append(total)
+    return cum_weights
+
+
+def synthetic_name(rng):
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    name_en = "".join(TRANSLIT[c] for c in name)
+    return name.capitalize(), name_en.capitalize()
+
+
+def entity_pool(rng, size):
+    pool = list(ENTITIES)
+    types = ["LOC", "ORG", "PER"]
+    seen = {name for name, _, _ in pool}
+    while len(pool) < size:
+        name, name_en = synthetic_name(rng)
+        entity_type = rng.choice(types)
+        if entity_type == "PER":
+            last, last_en = synthetic_name(rng)
+            name, name_en = f"{name} {last}", f"{name_en} {last_en}"
+        if name in seen:
+            continue
+        seen.add(name)
+        pool.append((name, name_en, entity_type))
+    return pool
+
+
+def sentence_pool(rng, size):
+    "pairs of (russian, english) sentences, drawn from a Zipf distributed vocabulary"
+    cum_weights = zipf_weights(len(WORDS))
+    pool = []
+    for _ in range(size):
+        words = rng.choices(WORDS, cum_weights=cum_weights, k=rng.randint(5, 18))
+        ru = " ".join(w[0] for w in words)
+        en = " ".join(w[1] for w in words)
+        pool.append((ru.capitalize() + ".", en.capitalize() + "."))
+    return pool
+
+
+def post_dates(rng, start, end, count):
+    "yield `count` sorted UTC post dates between start and end"
+    days = max((end - start).days, 1)
+    for i in range(count):
+        day = start + datetime.timedelta(days=i * days // count)
+        hour = rng.choices(range(24), weights=HOUR_WEIGHTS)[0]
+        # Moscow is UTC+3
+        moment = day + datetime.timedelta(
+            hours=hour - 3, minutes=rng.randrange(60), seconds=rng.randrange(60)
+        )
+        yield moment.isoformat()
+
+
+@dataclass
+class TextPool:
+    "the entities and sentences posts are made of, with their cumulative weights"
+
+    entities: list
+    entity_cum_weights: list
+    sentences: list
+    sentence_cum_weights: list
+
+
+def post_text(rng, pool: TextPool, key, link):
+    "the Russian and English text of a post, and its entity mentions"
+    ru_parts, en_parts, mentions = [], [], []
+    offset = 0
+    for _ in range(rng.randint(0, 3)):
+        entity_id = rng.choices(
+            range(1, len(pool.entities) + 1), cum_weights=pool.entity_cum_weights
+        )[0]
+        name, name_en, _ = pool.entities[entity_id - 1]
+        mentions.append((key, entity_id, offset, offset + len(name)))
+        ru_parts.append(name)
+        en_parts.append(name_en)
+        offset += len(name) + 1
+    if rng.random() < 0.05:
+        keyword, keyword_en = rng.choice(KEYWORDS)
+        ru_parts.append(keyword)
+        en_parts.append(keyword_en)
+    for ru, en in rng.choices(
+        pool.sentences,
+        cum_weights=pool.sentence_cum_weights,
+        k=rng.choice((1, 1, 2, 4)),
+    ):
+        ru_parts.append(ru)
+        en_parts.append(en)
+    if rng.random() < 0.7:
+        ru_parts.append(link)
+        en_parts.append(link)
+    return " ".join(ru_parts), " ".join(en_parts), mentions
+
+
+def post_rows(rng, pool: TextPool, key, domain, date_utc, link, translated):
+    """
+    The row of a post in each post table, None for the enrichments it does
+    not have. posts_entities is a list of mentions.
+    """
+    text, text_en, mentions = post_text(rng, pool, key, link)
+    # some posts only contain media
+    has_text = rng.random() > 0.03
+    text = text if has_text else ""
+    views = int(rng.lognormvariate(10, 1.2))
+    rows = {
+        "posts": (key, domain, date_utc, text, text_cache.text_hash(text)),
+        "posts_metrics": (
+            key,
+            int(views * rng.uniform(0.001, 0.03)),
+            int(views * rng.uniform(0.0, 0.005)),
+            views,
+            date_utc,
+        ),
+        "posts_sentiment": None,
+        "posts_translation": None,
+        "posts_entities": [],
+    }
+    if not has_text:
+        return rows
+    scores = [rng.random() ** 2 for _ in range(5)]
+    total = sum(scores)
+    rows["posts_sentiment"] = (key, *[score / total for score in scores])
+    if rng.random() < translated:
+        rows["posts_translation"] = (key, text_en)
+    rows["posts_entities"] = mentions
+    return rows
+
+
+def catch_up(db: sqlite_utils.Database):
+    """
+    Record the posts in temp.synth_loaded the way the triggers of the
+    loaded tables would have, one statement per log
+    """
+    loaded = "key in (select key from temp.synth_loaded)"
+    db.execute(
+        f"insert or ignore into {rollups.DIRTY_TABLE}"
+        f" select distinct domain, date(date_utc) from posts where {loaded}"
+    )
+    for table, log in (
+        ("posts", export_.CHANGES_TABLE),
+        ("posts_metrics", export_.METRICS_CHANGES_TABLE),
+    ):
+        db.execute(f"delete from {log} where {loaded}")
+        db.execute(
+            f"insert into {log} (key, seq) select key,"
+            f" (select coalesce(max(seq), 0) from {log}) + row_number() over (order by key)"
+            f" from {table} where {loaded}"
+        )
+    db.execute(
+        refresh.SCHEDULE_SQL.format(
+            timestamp="pm.timestamp",
+            source=f"posts p join posts_metrics pm on p.key = pm.key where p.{loaded}",
+        )
+    )
+    # the events of a post next to each other, so they are read as one
+    kinds = " union all ".join(
+        f"select key, '{kind}' as kind, {i} as n from {table} where {loaded}"
+        for i, (table, kind) in enumerate(events.KINDS.items())
+    )
+    db.execute(
+        f"insert into {events.EVENTS_TABLE} (key, kind)"
+        f" select key, kind from ({kinds}) order by key, n"
+    )
+
+
+@contextlib.contextmanager
+def triggers_suspended(db: sqlite_utils.Database):
+    """
+    Load without the rollup, export, refresh and event triggers of the
+    loaded tables, then catch up on what they record once. Loaded post keys
+    go into temp.synth_loaded. If the process dies halfway, ensure_tables
+    creates the triggers again.
+    """
+    skipped = {name for table in LOADED_TABLES for name in fts.trigger_names(table)}
+    with storage.writer(db):
+        triggers = [
+            (name, sql)
+            for name, sql in db.execute(
+                "select name, sql from sqlite_master where type = 'trigger'"
+                " and tbl_name in (select value from json_each(?))",
+                [json.dumps(LOADED_TABLES)],
+            ).fetchall()
+            if name not in skipped
+        ]
+        for name, _ in triggers:
+            db.execute(f"drop trigger [{name}]")
+        db.execute("create temp table synth_loaded (key integer primary key)")
+    try:
+        yield db
+    finally:
+        with storage.writer(db):
+            catch_up(db)
+            for _, sql in triggers:
+                db.execute(sql)
+            db.execute("drop table temp.synth_loaded")
+
+
+def synthesize(
+    db: sqlite_utils.Database,
+    count: int,
+    domains=None,
+    start=DEFAULT_START,
+    end=DEFAULT_END,
+    translated=0.8,
+    seed=0,
+    progress=None,
+):
+    "Fill db with `count` realistic looking posts and their enrichments"
+    rng = random.Random(seed)
+    domains = domains or DEFAULT_DOMAINS
+    domain_names = list(domains)
+    domain_weights = [domains[d] for d in domain_names]
+    owner_ids = {d: rng.randint(10_000_000, 200_000_000) for d in domain_names}
+    post_numbers = {d: rng.randint(100_000, 20_000_000) for d in domain_names}
+
+    entity_types = ["LOC", "ORG", "PER"]
+    entities = entity_pool(rng, max(len(ENTITIES), count // 50))
+    entity_cum_weights = zipf_weights(len(entities))
+    sentences = sentence_pool(rng, SENTENCE_POOL_SIZE)
+    sentence_cum_weights = zipf_weights(len(sentences), s=0.6)
+
+    with storage.writer(db):
+        db["entity_types"].insert_all(
+            [{"id": i + 1, "value": t} for i, t in enumerate(entity_types)],
+            pk="id",
+            replace=True,
+        )
+        db["entities"].insert_all(
+            [
+                {
+                    "id": i + 1,
+                    "name": name,
+                    "name_en": name_en,
+                    "type": entity_types.index(entity_type) + 1,
+                }
+                for i, (name, name_en, entity_type) in enumerate(entities)
+            ],
+            pk="id",
+            replace=True,
+        )
+
+    def generate():
+        dates = post_dates(
+            rng,
+            datetime.datetime.fromisoformat(start),
+            datetime.datetime.fromisoformat(end),
+            count,
+        )
+        for date_utc in dates:
+            domain = rng.choices(domain_names, weights=domain_weights)[0]
+            post_numbers[domain] += rng.randint(1, 3)
+            key = keys.post_key(f"-{owner_ids[domain]}_{post_numbers[domain]}")
+            yield key, domain, date_utc
+
+    pool = TextPool(entities, entity_cum_weights, sentences, sentence_cum_weights)
+    inserted = 0
+    with fts.bulk_load(db), triggers_suspended(db):
+        for batch in chunks(generate(), BATCH_SIZE):
+            posts, metrics, sentiment, translations, mentions, done = (
+                [] for _ in range(6)
+            )
+            for key, domain, date_utc in batch:
+                link = f"https://{domain}.ru/p/{post_numbers[domain]}"
+                rows = post_rows(rng, pool, key, domain, date_utc, link, translated)
+                posts.append(rows["posts"])
+                metrics.append(rows["posts_metrics"])
+                if rows["posts_sentiment"] is None:
+                    continue
+                sentiment.append(rows["posts_sentiment"])
+                if rows["posts_translation"] is not None:
+                    translations.append(rows["posts_translation"])
+                mentions.extend(rows["posts_entities"])
+                done.append((key,))
+
+            with storage.writer(db):
+                db.conn.executemany(
+                    "insert or ignore into temp.synth_loaded (key) values (?)",
+                    [post[:1] for post in posts],
+                )
+                db.conn.executemany(
+                    "insert or replace into posts (key, domain, date_utc, text, text_hash)"
+                    " values (?, ?, ?, ?, ?)",
+                    posts,
+                )
+                db.conn.executemany(
+                    "insert or replace into posts_metrics (key, likes, shares, views, timestamp)"
+                    " values (?, ?, ?, ?, ?)",
+                    metrics,
+                )
+                db.conn.executemany(
+                    "insert or replace into posts_sentiment"
+                    " (key, positive, negative, neutral, skip, speech) values (?, ?, ?, ?, ?, ?)",
+                    sentiment,
+                )
+                db.conn.executemany(
+                    "insert or replace into posts_translation (key, text_en) values (?, ?)",
+                    translations,
+                )
+                db.conn.executemany(
+                    "insert into posts_entities (key, entity, begin_offset, end_offset)"
+                    " values (?, ?, ?, ?)",
+                    mentions,
+                )
+                db.conn.executemany(
+                    "insert or replace into posts_entities_done (key) values (?)", done
+                )
+            inserted += len(posts)
+            if progress is not None:
+                progress(len(posts))
+    return inserted
+
+
+BULK_PRAGMAS = {
+    "journal_mode": "off",
+    "synchronous": "off",
+    "temp_store": "memory",
+    "cache_size": "-262144",
+    "locking_mode": "exclusive",
+}
+
+
+def bulk_pragmas(db: sqlite_utils.Database):
+    "trade durability for speed, only safe while building a throwaway database"
+    for pragma, value in BULK_PRAGMAS.items():
+        db.execute(f"pragma {pragma} = {value}")
+
+
+def restore_pragmas(db: sqlite_utils.Database):
+    "back to the settings of storage.open_database"
+    db.execute("pragma locking_mode = normal")
+    db.execute("pragma journal_mode = wal")
+    db.execute("pragma synchronous = normal")
@@ -0,0 +1,179 @@
+import hashlib
+import json
+
+import sqlite_utils
+
+import spevktator.storage as storage
+
+
+SENTIMENT_TABLE = "text_sentiment"
+ENTITIES_TABLE = "text_entities"
+ENTITIES_DONE_TABLE = "text_entities_done"
+STATS_TABLE = "text_cache_stats"
+SENTIMENT_COLUMNS = ("positive", "negative", "neutral", "skip", "speech")
+
+# sentiment of the texts in the cache, for posts without one
+COPY_SENTIMENT_SQL = """
+insert into posts_sentiment (key, {columns})
+select p.key, {cached} from posts p join {table} c on c.hash = p.text_hash
+where p.key in ({keys}) and p.text != ''
+    and p.key not in (select key from posts_sentiment)
+order by p.key
+"""
+
+# the entity spans of the texts in the cache, offsets are the same for equal texts
+COPY_ENTITIES_SQL = """
+insert into posts_entities (key, entity, begin_offset, end_offset)
+select p.key, c.entity, c.begin_offset, c.end_offset
+from posts p join {table} c on c.hash = p.text_hash
+where p.key in (select key from temp.text_cache_keys)
+"""
+
+
+def normalize(text):
+    "text with its whitespace collapsed, as the scraper stores it"
+    return " ".join(text.split())
+
+
+def text_hash(text):
+    "64-bit hash of the normalized text, posts with equal hashes share enrichments"
+    return int.from_bytes(
+        hashlib.blake2b(normalize(text or "").encode("utf-8"), digest_size=8).digest(),
+        "little",
+        signed=True,
+    )
+
+
+def ensure_tables(db: sqlite_utils.Database):
+    if "text_hash" not in db["posts"].columns_dict:
+        db["posts"].add_column("text_hash", int)
+    db["posts"].create_index(["text_hash"], if_not_exists=True)
+    if SENTIMENT_TABLE not in db.table_names():
+        db[SENTIMENT_TABLE].create(
+            dict({"hash": int}, **{column: float for column in SENTIMENT_COLUMNS}),
+            pk="hash",
+        )
+    if ENTITIES_TABLE not in db.table_names():
+        db[ENTITIES_TABLE].create(
+            {"hash": int, "entity": int, "begin_offset": int, "end_offset": int},
+            foreign_keys=[("entity", "entities", "id")],
+        )
+        db[ENTITIES_TABLE].create_index(["hash"])
+    if ENTITIES_DONE_TABLE not in db.table_names():
+        db[ENTITIES_DONE_TABLE].create({"hash": int}, pk="hash")
+    if STATS_TABLE not in db.table_names():
+        db[STATS_TABLE].create({"kind": str, "hits": int, "misses": int}, pk="kind")
+    fill_hashes(db)
+
+
+def fill_hashes(db: sqlite_utils.Database):
+    "hash the texts of posts written without one, by older versions or merged shards"
+    db.register_function(text_hash, deterministic=True, replace=True)
+    with storage.writer(db):
+        return db.execute(
+            "update posts set text_hash = text_hash(text) where text_hash is null"
+        ).rowcount
+
+
+def record(db: sqlite_utils.Database, kind, hits=0, misses=0):
+    "add to the hit and miss counters of kind"
+    if not hits and not misses:
+        return
+    with storage.writer(db):
+        db.execute(
+            f"insert into {STATS_TABLE} (kind, hits, misses) values (?, ?, ?)"
+            " on conflict (kind) do update set"
+            " hits = hits + excluded.hits, misses = misses + excluded.misses",
+            [kind, hits, misses],
+        )
+
+
+def copy_sentiment(db: sqlite_utils.Database, keys_sql, params=None):
+    """
+    Copy the cached sentiment to the posts selected by keys_sql that have
+    none yet, returns the number of posts copied to.
+    """
+    sql = COPY_SENTIMENT_SQL.format(
+        columns=", ".join(SENTIMENT_COLUMNS),
+        cached=", ".join(f"c.{column}" for column in SENTIMENT_COLUMNS),
+        table=SENTIMENT_TABLE,
+        keys=keys_sql,
+    )
+    with storage.writer(db):
+        hits = db.execute(sql, params or {}).rowcount
+        record(db, "sentiment", hits=hits)
+    return hits
+
+
+def store_sentiment(db: sqlite_utils.Database, keys):
+    "cache the sentiment just predicted for the posts with keys"
+    columns = ", ".join(SENTIMENT_COLUMNS)
+    with storage.writer(db):
+        db.execute(
+            f"insert or ignore into {SENTIMENT_TABLE} (hash, {columns})"
+            f" select p.text_hash, {', '.join(f's.{c}' for c in SENTIMENT_COLUMNS)}"
+            " from posts_sentiment s join posts p on p.key = s.key"
+            " where s.key in (select value from json_each(?))"
+            " and p.text_hash is not null",
+            [json.dumps(list(keys))],
+        )
+
+
+def copy_entities(db: sqlite_utils.Database, keys_sql, params=None):
+    """
+    Copy the cached entity spans to the posts selected by keys_sql that have
+    not been through named-entity recognition, returns the number of posts.
+    """
+    with storage.writer(db):
+        db.execute("drop table if exists temp.text_cache_keys")
+        db.execute(
+            "create temp table text_cache_keys as select p.key from posts p"
+            f" join {ENTITIES_DONE_TABLE} d on d.hash = p.text_hash"
+            f" where p.key in ({keys_sql}) and p.text != ''"
+            " and p.key not in (select key from posts_entities_done)",
+            params or {},
+        )
+        db.execute(COPY_ENTITIES_SQL.format(table=ENTITIES_TABLE))
+        hits = db.execute(
+            "insert into posts_entities_done (key)"
+            " select key from temp.text_cache_keys order by key"
+        ).rowcount
+        db.execute("drop table temp.text_cache_keys")
+        record(db, "entities", hits=hits)
+    return hits
+
+
+def store_entities(db: sqlite_utils.Database, keys):
+    "cache the entity spans just extracted from the posts with keys"
+    keys = json.dumps(list(keys))
+    with storage.writer(db):
+        # one post per text, and only texts that are not cached yet
+        db.execute(
+            "create temp table text_cache_new as"
+            " select text_hash as hash, min(key) as key from posts"
+            " where key in (select value from json_each(?)) and text_hash is not null"
+            f" and text_hash not in (select hash from {ENTITIES_DONE_TABLE})"
+            " group by text_hash",
+            [keys],
+        )
+        db.execute(
+            f"insert into {ENTITIES_TABLE} (hash, entity, begin_offset, end_offset)"
+            " select n.hash, pe.entity, pe.begin_offset, pe.end_offset"
+            " from temp.text_cache_new n join posts_entities pe on pe.key = n.key"
+        )
+        db.execute(
+            f"insert into {ENTITIES_DONE_TABLE} (hash) select hash from temp.text_cache_new"
+        )
+        db.execute("drop table temp.text_cache_new")
+
+
+def stats(db: sqlite_utils.Database):
+    "hits, misses and hit rate per kind of enrichment, as rows for tabulate"
+    rows = []
+    for kind, hits, misses in db.execute(
+        f"select kind, hits, misses from {STATS_TABLE} order by kind"
+    ).fetchall():
+        total = hits + misses
+        rate = round(100 * hits / total, 1) if total else None
+        rows.append({"cache": kind, "hits": hits, "misses": misses, "hit %": rate})
+    return rows
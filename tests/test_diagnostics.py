@@ -0,0 +1,80 @@
+import json
+import tracemalloc
+
+import dateparser
+from click.testing import CliRunner
+from spevktator import cli, diagnostics, mock_vk, scraper, storage
+
+
+class Restarted(Exception):
+    pass
+
+
+def test_listen_records_memory_and_restarts(tmpdir, monkeypatch):
+    server = mock_vk.MockVK(domains=["first"], posts=12)
+    server.run_in_thread()
+    monkeypatch.setattr(scraper, "VK_BASE_URL", server.url)
+
+    def restart(db):
+        raise Restarted()
+
+    monkeypatch.setattr(diagnostics, "restart", restart)
+    db_path = str(tmpdir / "vk.db")
+    try:
+        result = CliRunner().invoke(
+            cli.cli, ["listen", db_path, "first", "--memory-limit=1"]
+        )
+    finally:
+        server.shutdown()
+    assert isinstance(result.exception, Restarted), result.output
+    assert "Round 1: 12 posts added" in result.output
+
+    db = storage.open_database(db_path)
+    [row] = db[diagnostics.DIAGNOSTICS_TABLE].rows
+    assert row["posts"] == 12
+    assert row["rss_mb"] > 1
+    assert row["restart"] == 1
+    assert row["allocations"] is None
+    # one set of dateparser settings per page, but only the last ones are kept
+    registry = getattr(dateparser.conf.Settings, "__registry_dict")
+    assert len(registry) <= scraper.DATEPARSER_CACHE_SIZE + 1
+
+
+def test_allocation_snapshots(tmpdir):
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    diagnostics.ensure_tables(db)
+    monitor = diagnostics.Monitor(db)
+    try:
+        monitor.request_snapshot()
+        assert tracemalloc.is_tracing()
+        first = monitor.record()
+        garbage = [str(i) * 10 for i in range(10000)]  # noqa: F841
+        monitor.request_snapshot()
+        second = monitor.record()
+        assert not tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    third = monitor.record()
+
+    assert first["traced_mb"] is not None and first["restart"] == 0
+    sites = json.loads(second["allocations"])
+    assert len(sites) == diagnostics.TOP_ALLOCATIONS
+    # the growth since the previous snapshot comes first
+    assert "test_diagnostics.py:" in sites[0]["where"]
+    assert sites[0]["size_diff_kb"] > 100
+    assert third["allocations"] is None and third["traced_mb"] is None
+    assert db[diagnostics.DIAGNOSTICS_TABLE].count == 3
+
+
+def test_without_resource_and_sigusr1(tmpdir, monkeypatch):
+    # as on Windows
+    monkeypatch.setattr(diagnostics, "resource", None)
+    monkeypatch.setattr(diagnostics, "SNAPSHOT_SIGNAL", None)
+    monkeypatch.setattr(diagnostics, "rss_mb", diagnostics.peak_rss_mb)
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    diagnostics.ensure_tables(db)
+    monitor = diagnostics.Monitor(db, ceiling_mb=1)
+    monitor.install()
+    row = monitor.record()
+    assert row["rss_mb"] is None and row["peak_rss_mb"] is None
+    assert row["restart"] == 0
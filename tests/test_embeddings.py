@@ -0,0 +1,86 @@
+import asyncio
+import pathlib
+
+from click.testing import CliRunner
+from datasette.app import Datasette
+from spevktator import cli, embeddings, keys, storage
+
+PLUGINS_DIR = str(pathlib.Path(__file__).parent.parent / "data" / "plugins")
+
+TEXTS = {
+    "-1_1": "Спартак обыграл ЦСКА в футбольном матче",
+    "-1_2": "Погода в Москве: завтра снег и мороз",
+    "-2_1": "Футбольный клуб Зенит выиграл матч у Спартака",
+    "-2_2": "Синоптики обещают в Москве сильный снегопад и холод",
+    "-3_1": "zzqq",
+}
+
+
+def add_posts(db, texts):
+    with storage.writer(db):
+        db["posts"].insert_all(
+            {"key": keys.post_key(post_id), "domain": "life", "text": text}
+            for post_id, text in texts.items()
+        )
+
+
+def test_similar_posts(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    add_posts(db, TEXTS)
+
+    # a post without any known word gets no row
+    assert embeddings.embed_posts(db) == 4
+    assert embeddings.embed_posts(db) == 0
+    path = embeddings.matrix_path(db_path)
+    assert path.stat().st_size == 4 * embeddings.DIM * 2
+    assert embeddings.similar(db.conn, keys.post_key("-3_1")) is None
+
+    football = keys.post_key("-1_1")
+    results = embeddings.similar(db.conn, football, k=3)
+    assert [key for key, _ in results][0] == keys.post_key("-2_1")
+    assert football not in [key for key, _ in results]
+    assert results[0][1] > results[1][1]
+
+    # rows of an append that was not committed are overwritten
+    with open(path, "ab") as fp:
+        fp.write(b"\0" * 100)
+    add_posts(db, {"-3_2": "Спартак проиграл матч"})
+    assert embeddings.embed_posts(db) == 1
+    assert path.stat().st_size == 5 * embeddings.DIM * 2
+
+    # searching the nearest cell only finds the same in well separated data
+    brute = embeddings.similar(db.conn, football, k=2)
+    assert embeddings.build_index(db, cells=2) == 2
+    assert (
+        db[embeddings.ROWS_TABLE].count_where("cell is null and row is not null") == 0
+    )
+    indexed = embeddings.similar(db.conn, football, k=2, probes=1)
+    assert [key for key, _ in indexed] == [key for key, _ in brute]
+    # new rows are assigned to a cell as they are appended
+    add_posts(db, {"-3_3": "Мороз и снег в Москве"})
+    embeddings.embed_posts(db)
+    assert db[embeddings.ROWS_TABLE].get(keys.post_key("-3_3"))["cell"] is not None
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["similar", db_path, "-n", "2", "--", "-1_2"])
+    assert result.exit_code == 0, result.output
+    assert [line.split()[0] for line in result.output.splitlines()[2:]] == [
+        "-3_3",
+        "-2_2",
+    ]
+    result = runner.invoke(cli.cli, ["similar", db_path, "--", "-3_1"])
+    assert result.exit_code == 1
+    assert "has no vector" in result.output
+
+    datasette = Datasette([db_path], plugins_dir=PLUGINS_DIR)
+    response = asyncio.run(
+        datasette.client.get(f"/vk/posts/{football}/similar.json?k=1")
+    )
+    assert response.status_code == 200
+    assert [post["key"] for post in response.json()["similar"]] == [
+        key for key, _ in embeddings.similar(db.conn, football, k=1)
+    ]
+    response = asyncio.run(datasette.client.get("/vk/posts/-3_1/similar.json"))
+    assert response.status_code == 404
@@ -0,0 +1,81 @@
+import types
+
+from spevktator import cli, enrich, models, storage, synth
+
+
+class FakeTranslator:
+    calls = 0
+
+    def __init__(self, auth_key):
+        pass
+
+    def translate_text(self, texts, source_lang, target_lang):
+        FakeTranslator.calls += 1
+        return [types.SimpleNamespace(text=f"EN {text}") for text in texts]
+
+
+def fake_entities(texts, level=None):
+    return [
+        [{"normal": word, "type": "LOC", "start": 0, "stop": len(word)}]
+        for word in (text.split()[0] for text in texts)
+    ]
+
+
+def test_enrich_pipeline(tmpdir, monkeypatch):
+    monkeypatch.setattr(models, "sentiment_available", lambda: True)
+    monkeypatch.setattr(
+        models,
+        "predict_sentiment",
+        lambda texts: [{"positive": 0.5, "negative": 0.25} for _ in texts],
+    )
+    monkeypatch.setattr(models, "named_entities", fake_entities)
+    monkeypatch.setattr(enrich.deepl, "Translator", FakeTranslator)
+
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    synth.synthesize(db, 300, start="2022-08-01", end="2022-09-01")
+    with storage.writer(db):
+        for table in (
+            "posts_sentiment",
+            "posts_entities",
+            "posts_entities_done",
+            "posts_translation",
+        ):
+            db.execute(f"delete from {table}")
+        db.execute("update entities set name_en = null")
+    with_text = db.execute("select count(*) from posts where text != ''").fetchone()[0]
+
+    stages = enrich.build_stages(
+        db_path, "key", batch_sizes={"entities": 7}, workers={"translate-posts": 3}
+    )
+    assert [stage.name for stage in stages] == list(enrich.STAGES)
+    pipeline = enrich.Pipeline(db, stages, queue_size=10, write_batch_size=25)
+    assert pipeline.count() == with_text
+    assert pipeline.run() == with_text
+
+    for table in (
+        "posts_sentiment",
+        "posts_entities_done",
+        "posts_translation",
+        "posts_lemmas",
+    ):
+        assert db[table].count == with_text
+    assert db.execute(
+        "select count(*) from entities e join posts_entities pe on e.id = pe.entity"
+        " where coalesce(e.name_en, '') != 'EN ' || e.name"
+    ).fetchone() == (0,)
+    report = {row["stage"]: row for row in pipeline.report(1.0)}
+    assert report["entities"]["posts"] == with_text
+    assert report["entities"]["batch size"] == 7
+    assert report["translate-posts"]["workers"] == 3
+
+    # everything was committed, so a second run has nothing left to do
+    stages = enrich.build_stages(db_path, "key")
+    assert enrich.Pipeline(db, stages).run() == 0
+
+    # a batch another run wrote in the meantime is skipped, not inserted twice
+    key, text = db.execute("select key, text from posts where text != ''").fetchone()
+    entities = db["posts_entities"].count
+    enrich.write(db, [{"key": key, "text": text, "entities": fake_entities([text])[0]}])
+    assert db["posts_entities"].count == entities
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import pathlib
+
+from click.testing import CliRunner
+from datasette.app import Datasette
+from spevktator import cli, events, storage, synth
+
+PLUGINS_DIR = str(pathlib.Path(__file__).parent.parent / "data" / "plugins")
+
+
+def test_post_events(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    synth.synthesize(db, 20, start="2022-08-01", end="2022-09-01", translated=0)
+
+    # the events of a post written together come as one
+    cursor, batch = events.read(db.conn, 0)
+    assert len(batch) == 20
+    assert cursor == events.latest(db.conn)
+    assert all("post" in event["kinds"] for event in batch)
+    assert {"sentiment", "entities"} <= {kind for e in batch for kind in e["kinds"]}
+    key = db.execute("select key from posts limit 1").fetchone()[0]
+    with storage.writer(db):
+        db["posts_translation"].insert({"key": key, "text_en": "Hello"})
+    after, batch = events.read(db.conn, cursor)
+    assert after == cursor + 1
+    assert [(e["kinds"], e["post"]["text_en"]) for e in batch] == [
+        (["translation"], "Hello")
+    ]
+    assert events.read(db.conn, after) == (after, [])
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["tail", db_path, "--since", str(cursor)])
+    assert result.exit_code == 0, result.output
+    event = json.loads(result.output)
+    assert event["seq"] == after and event["post"]["text_en"] == "Hello"
+    result = runner.invoke(cli.cli, ["tail", db_path, "-n", "0"])
+    assert result.output == ""
+    domain = event["post"]["domain"]
+    result = runner.invoke(cli.cli, ["tail", db_path, "--since", "0", "-d", domain])
+    posts = [json.loads(line)["post"] for line in result.output.splitlines()]
+    assert {post["domain"] for post in posts} == {domain}
+    assert len(posts) == db["posts"].count_where("domain = ?", [domain])
+
+    # the same events, streamed by the Datasette plugin
+    datasette = Datasette([db_path], plugins_dir=PLUGINS_DIR)
+    response = asyncio.run(
+        datasette.client.get(f"/-/post-events?since={cursor}&timeout=0")
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert f"id: {after}\nevent: post\n" in response.text
+    data = response.text.split("data: ")[1].split("\n")[0]
+    assert json.loads(data)["post"]["text_en"] == "Hello"
+    response = asyncio.run(
+        datasette.client.get(
+            "/-/post-events?timeout=0", headers={"last-event-id": str(after)}
+        )
+    )
+    assert "id:" not in response.text
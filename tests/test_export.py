@@ -0,0 +1,58 @@
+import json
+import pytest
+from click.testing import CliRunner
+from spevktator import cli, keys, storage, synth
+
+
+@pytest.fixture
+def db_path(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    synth.synthesize(db, 250)
+    return db_path
+
+
+def test_export_ndjson_incremental(tmpdir, db_path):
+    output = str(tmpdir / "posts.ndjson")
+    args = ["export", db_path, output, "--chunk-size=100", "--incremental=nightly"]
+    result = CliRunner().invoke(cli.cli, args, catch_exceptions=False)
+    assert "250 posts exported" in result.output
+    rows = [json.loads(line) for line in open(output)]
+    assert len(rows) == 250
+    assert {"id", "text_en", "views", "sentiment", "entities"}.issubset(rows[0])
+    assert any(row["entities"] for row in rows)
+
+    result = CliRunner().invoke(cli.cli, args, catch_exceptions=False)
+    assert "0 posts exported" in result.output
+
+    db = storage.open_database(db_path)
+    post_id = rows[10]["id"]
+    db["posts_metrics"].update(
+        keys.post_key(post_id), {"views": 1, "timestamp": "2030-01-01"}
+    )
+    result = CliRunner().invoke(cli.cli, args, catch_exceptions=False)
+    assert "1 posts exported" in result.output
+    assert json.loads(open(output).readline())["id"] == post_id
+
+    # metrics fetched earlier than the previous ones, by a slower worker
+    post_id = rows[20]["id"]
+    with storage.writer(db):
+        db["posts_metrics"].update(
+            keys.post_key(post_id), {"views": 2, "timestamp": "2000-01-01"}
+        )
+    result = CliRunner().invoke(cli.cli, args, catch_exceptions=False)
+    assert "1 posts exported" in result.output
+    assert json.loads(open(output).readline())["id"] == post_id
+
+
+def test_export_parquet(tmpdir, db_path):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    output = str(tmpdir / "posts.parquet")
+    result = CliRunner().invoke(
+        cli.cli, ["export", db_path, output, "--chunk-size=64"], catch_exceptions=False
+    )
+    assert result.exit_code == 0, result.output
+    table = parquet.read_table(output)
+    assert table.num_rows == 250
+    assert "entities" in table.column_names
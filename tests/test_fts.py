@@ -0,0 +1,204 @@
+import asyncio
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+
+import pytest
+import yaml
+from datasette.app import Datasette
+from spevktator import cli, fts, keys, storage
+
+METADATA = pathlib.Path(__file__).parent.parent / "data" / "metadata.yml"
+PLUGINS_DIR = str(pathlib.Path(__file__).parent.parent / "data" / "plugins")
+
+
+@pytest.fixture
+def db(tmpdir):
+    db = storage.open_database(str(tmpdir / "data.db"))
+    cli.ensure_tables(db)
+    cli.ensure_fts(db)
+    return db
+
+
+def search(db, query):
+    return [
+        row["id"]
+        for row in db.query(
+            "select posts.id from posts join posts_fts on posts.rowid = posts_fts.rowid"
+            " where posts_fts match :query",
+            {"query": query},
+        )
+    ]
+
+
+def insert_posts(db, start, count):
+    db["posts"].insert_all(
+        {
+            "key": keys.post_key(f"-1_{i}"),
+            "domain": "life",
+            "date_utc": "",
+            "text": f"пост номер{i}",
+        }
+        for i in range(start, start + count)
+    )
+
+
+def test_bulk_load_rebuilds_once(db):
+    insert_posts(db, 0, 2)
+    with fts.bulk_load(db):
+        assert not [t for t in db["posts"].triggers if t.name == "posts_ai"]
+        insert_posts(db, 2, 2)
+        assert search(db, "номер3") == []
+    assert search(db, "номер3") == ["-1_3"]
+    assert {t.name for t in db["posts"].triggers} >= set(fts.trigger_names("posts"))
+    assert db["fts_suspended"].count == 0
+
+
+def test_interrupted_bulk_load_is_resumed(db):
+    with pytest.raises(KeyboardInterrupt):
+        with fts.bulk_load(db):
+            insert_posts(db, 0, 2)
+            raise KeyboardInterrupt()
+    # three triggers for each index: posts and posts_translation have two
+    assert db["fts_suspended"].count == 18
+    cli.ensure_fts(db)
+    assert search(db, "номер1") == ["-1_1"]
+    assert db["fts_suspended"].count == 0
+
+
+def test_bulk_load_of_another_process_is_left_alone(db):
+    fts.suspend_triggers(db, "posts")
+    insert_posts(db, 0, 2)
+    # a bulk load by the parent process, still running
+    with storage.writer(db):
+        db.execute(
+            "update fts_suspended set owner = ?",
+            [f"{socket.gethostname()}:{os.getppid()}"],
+        )
+    cli.ensure_fts(db)
+    assert search(db, "номер1") == []
+    assert db["fts_suspended"].count == 6
+
+    # and by one that died
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    with storage.writer(db):
+        db.execute(
+            "update fts_suspended set owner = ?", [f"{socket.gethostname()}:{gone.pid}"]
+        )
+    cli.ensure_fts(db)
+    assert search(db, "номер1") == ["-1_1"]
+    assert db["fts_suspended"].count == 0
+
+
+def test_merge(db):
+    for i in range(20):
+        insert_posts(db, i * 10, 10)
+    assert fts.merge(db, "posts", budget=1, pages=-16) >= 1
+    assert fts.merge(db, "posts", budget=1, pages=-16) == 0
+    assert search(db, "номер199") == ["-1_199"]
+
+
+def test_search_entities(db):
+    db["entity_types"].insert_all(
+        [{"id": 1, "value": "LOC"}, {"id": 2, "value": "ORG"}]
+    )
+    db["entities"].insert_all(
+        [
+            {"id": 1, "name": "Запорожская АЭС", "name_en": None, "type": 2},
+            {"id": 2, "name": "ЗАЭС", "name_en": None, "type": 2},
+            {"id": 3, "name": "Запорожье", "name_en": None, "type": 1},
+            {"id": 4, "name": "Москва", "name_en": "Moscow", "type": 1},
+        ]
+    )
+    # translations reach the index through the triggers
+    db["entities"].update(1, {"name_en": "Zaporozhye NPP"})
+    db["entities"].update(3, {"name_en": "Zaporizhzhia"})
+
+    def ids(query, limit=20):
+        return [row["id"] for row in fts.search_entities(db, query, limit)]
+
+    assert ids("заэс")[0] == 2
+    assert ids("Zaporozh", limit=1) == [1]
+    assert set(ids("Запорож")[:2]) == {1, 3}
+    # misspelled transliteration, found through shared trigrams
+    assert ids("Zaporoshye")[0] == 1
+    assert ids("Мо") == [4]
+    assert ids("mo") == [4]
+    # wildcards of like are searched for as they are
+    assert ids("М%") == ids("_о") == ids("%%%") == []
+
+
+def test_substring_search(db):
+    metadata = yaml.safe_load(METADATA.read_text())
+    queries = metadata["databases"]["vk"]["plugins"]["indexed_queries"]
+    texts = ["Обстрел Запорожской АЭС", "ЗАПОРОЖЬЕ без света", "В Москве снег"]
+    texts += [f"Запорожье, сводка {i}" for i in range(60)]
+    db["posts"].insert_all(
+        {"key": keys.post_key(f"-1_{i}"), "domain": "life", "text": text}
+        for i, text in enumerate(texts)
+    )
+    db["posts_translation"].insert(
+        {"key": keys.post_key("-1_0"), "text_en": "Shelling of the Zaporizhzhia NPP"}
+    )
+
+    def search(name, text, after_rank="", after_key=""):
+        param = "text_ru" if name == "posts_search_ru" else "text_en"
+        return db.execute(
+            queries[name]["sql"],
+            {param: text, "after_rank": after_rank, "after_key": after_key},
+        ).fetchall()
+
+    # any inflection, in any case, the shortest text first
+    first = search("posts_search_ru", "запорож")
+    assert len(first) == 50
+    assert first[0][0] == "-1_1"
+    rest = search("posts_search_ru", "запорож", *first[-1][-2:])
+    assert len(rest) == 12
+    assert {row[0] for row in first + rest} == {f"-1_{i}" for i in range(63)} - {"-1_2"}
+    assert [row[0] for row in search("posts_search_en", "izhzh")] == ["-1_0"]
+    assert search("posts_search_ru", 'a"b') == []
+
+    # kept up-to-date by triggers, and rebuilt after a bulk load
+    db["posts"].update(keys.post_key("-1_2"), {"text": "Запорожье в снегу"})
+    db["posts"].delete(keys.post_key("-1_1"))
+    with fts.bulk_load(db):
+        db["posts"].insert(
+            {"key": keys.post_key("-1_99"), "domain": "life", "text": "запорожец"}
+        )
+    assert [row[0] for row in search("posts_search_ru", "в снегу")] == ["-1_2"]
+    assert search("posts_search_ru", "без света") == []
+    assert [row[0] for row in search("posts_search_ru", "ЗАПОРОЖЕЦ")] == ["-1_99"]
+
+
+def test_search_queries_fall_back_without_indexes(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    cli.ensure_views(db)
+    db["posts"].insert(
+        {"key": keys.post_key("-1_1"), "domain": "life", "text": "Обстрел Запорожья"}
+    )
+
+    def search():
+        datasette = Datasette(
+            [db_path],
+            plugins_dir=PLUGINS_DIR,
+            metadata=yaml.safe_load(METADATA.read_text()),
+        )
+        response = asyncio.run(
+            datasette.client.get(
+                "/vk/posts_search_ru.json?text_ru=Запорож&after_rank=&after_key=&_shape=array"
+            )
+        )
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    # a LIKE scan until the trigram index is built
+    [row] = search()
+    assert row["id"] == "-1_1" and "rank" not in row
+    cli.ensure_fts(db)
+    [row] = search()
+    assert row["id"] == "-1_1" and "rank" in row
@@ -0,0 +1,51 @@
+import click
+import pytest
+from click.testing import CliRunner
+from spevktator import benchmark, cli, keys, storage, synth
+
+
+def test_post_key():
+    assert keys.post_key("-24199209_18932515") == -24199209 * 2**32 + 18932515
+    assert keys.post_id(keys.post_key("-24199209_18932515")) == "-24199209_18932515"
+    assert keys.post_id(keys.post_key("1_4294967295")) == "1_4294967295"
+
+
+def test_migrate_keys(tmpdir):
+    source = storage.open_database(str(tmpdir / "source.db"))
+    cli.ensure_tables(source)
+    synth.synthesize(source, 200, start="2022-08-01", end="2022-09-01")
+    expected = {
+        table: source.execute(f"select count(*), min(id) from {table}").fetchone()
+        for table in keys.POST_TABLES
+    }
+    # a database as it was before the packed keys
+    db_path = str(tmpdir / "vk.db")
+    benchmark.copy_post_tables(str(tmpdir / "source.db"), db_path, True).close()
+    db = storage.open_database(db_path)
+    assert keys.legacy(db)
+    with pytest.raises(click.ClickException):
+        cli.ensure_tables(db)
+    db.close()
+
+    result = CliRunner().invoke(cli.cli, ["migrate-keys", db_path])
+    assert result.exit_code == 0, result.output
+    db = storage.open_database(db_path)
+    assert not keys.legacy(db)
+    for table, (count, min_id) in expected.items():
+        assert db.execute(f"select count(*), min(id) from {table}").fetchone() == (
+            count,
+            min_id,
+        )
+    key, post_id = db.execute("select key, id from posts limit 1").fetchone()
+    assert keys.post_key(post_id) == key
+    assert db.execute("select count(*) from posts_metrics_view").fetchone() == (
+        expected["posts"][0],
+    )
+    word = db.execute("select text from posts where text != '' limit 1").fetchone()[0]
+    assert db.execute(
+        "select count(*) from posts_fts where posts_fts match ?",
+        ['"{}"'.format(word.split()[0].replace('"', ""))],
+    ).fetchone()[0]
+
+    result = CliRunner().invoke(cli.cli, ["migrate-keys", db_path])
+    assert "already uses packed post keys" in result.output
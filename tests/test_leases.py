@@ -0,0 +1,101 @@
+import multiprocessing
+import signal
+import threading
+import time
+
+from spevktator import cli, leases, mock_vk, scraper, storage
+
+DOMAINS = ["first", "second", "third"]
+
+
+def test_lease_semantics(tmpdir):
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    leases.ensure_tables(db)
+
+    assert leases.claim(db, ["first"], "a", interval=300, now=1000) == "first"
+    # leased, not even the oldest due domain goes to another worker
+    assert leases.claim(db, ["first"], "b", interval=300, now=1010) is None
+    assert leases.renew(db, "first", "a", now=1030)
+    # taken over once the lease expired, the former owner can not renew it
+    expired = 1030 + leases.LEASE_SECONDS + 1
+    assert leases.claim(db, ["first"], "b", interval=300, now=expired) == "first"
+    assert not leases.renew(db, "first", "a", now=expired + 1)
+    leases.release(db, "first", "a", now=expired + 2)
+    assert db[leases.LEASES_TABLE].get("first")["owner"] == "b"
+
+    leases.release(db, "first", "b", now=2000)
+    assert leases.claim(db, ["first"], "a", interval=300, now=2100) is None
+    assert leases.next_due(db, ["first"], 300, now=2298) == 2
+    assert leases.claim(db, ["first"], "a", interval=300, now=2300) == "first"
+    # a failed fetch leaves it due
+    leases.release(db, "first", "a", fetched=False, now=2310)
+    assert leases.claim(db, ["first"], "b", interval=300, now=2311) == "first"
+
+
+def test_workers_fetch_each_domain_once(tmpdir, monkeypatch):
+    server = mock_vk.MockVK(domains=DOMAINS, posts=5)
+    server.run_in_thread()
+    monkeypatch.setattr(scraper, "VK_BASE_URL", server.url)
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    fetched = []
+
+    def worker():
+        worker_db = storage.open_database(db_path)
+        owner = leases.worker_id()
+        while True:
+            posts = cli.fetch_leased(worker_db, DOMAINS, owner, 1, scrape_delay=False)
+            if posts is None:
+                break
+            fetched.append(posts)
+
+    try:
+        threads = [threading.Thread(target=worker) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.shutdown()
+
+    assert sorted(fetched) == [5, 5, 5]
+    assert server.stats.pages == len(DOMAINS)
+    assert db["posts"].count == 15
+    rows = list(db[leases.LEASES_TABLE].rows)
+    assert [row["owner"] for row in rows] == [None] * 3
+    assert all(row["fetched_at"] is not None for row in rows)
+
+
+def stoppable(path):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, cli.interrupt)
+    try:
+        while True:
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        # the lease is released here
+        with open(path, "w") as fp:
+            fp.write("released")
+
+
+def stubborn():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while True:
+        time.sleep(0.01)
+
+
+def test_stop_workers(tmpdir):
+    context = multiprocessing.get_context("fork")
+    path = str(tmpdir / "released")
+    workers = [
+        context.Process(target=stoppable, args=(path,)),
+        context.Process(target=stubborn),
+    ]
+    for process in workers:
+        process.start()
+    time.sleep(0.5)
+    cli.stop_workers(workers, timeout=1)
+    assert workers[0].exitcode == 0
+    assert open(path).read() == "released"
+    assert workers[1].exitcode == -signal.SIGKILL
@@ -0,0 +1,78 @@
+import asyncio
+import pathlib
+
+import yaml
+from click.testing import CliRunner
+from datasette.app import Datasette
+from spevktator import cli, keys, lemmas, models, scraper, storage
+
+PLUGINS_DIR = str(pathlib.Path(__file__).parent.parent / "data" / "plugins")
+METADATA = pathlib.Path(__file__).parent.parent / "data" / "metadata.yml"
+
+TEXTS = {
+    "-1_1": "Обстрел Запорожья продолжается",
+    "-1_2": "В Запорожье снова нет света",
+    "-1_3": "Губернатор Запорожской области выступил",
+    "-1_4": "Мосты через Днепр",
+    "-1_5": "Запорожье, Запорожье, Запорожье",
+}
+
+
+def test_lemma_search(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        models, "named_entities", lambda texts, level=None: [[]] * len(texts)
+    )
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    cli.ensure_fts(db)
+    with storage.writer(db):
+        db["posts"].insert_all(
+            {
+                "key": keys.post_key(post_id),
+                "domain": "life",
+                "date_utc": f"2022-08-0{i}",
+                "text": text,
+            }
+            for i, (post_id, text) in enumerate(TEXTS.items(), 1)
+        )
+
+    # the lemmas are stored along with the named entities
+    scraper.extract_named_entities(db, limit=3)
+    assert db[lemmas.LEMMAS_TABLE].count == 3
+    assert (
+        db[lemmas.LEMMAS_TABLE].get(keys.post_key("-1_4"))["lemmas"]
+        == "мост через днепр"
+    )
+    result = CliRunner().invoke(cli.cli, ["lemmatize", db_path])
+    assert result.exit_code == 0, result.output
+    assert "2 posts lemmatized" in result.output
+
+    def ids(query, **kwargs):
+        return [row["id"] for row in lemmas.search(db, query, **kwargs)]
+
+    # any form of the word, the best match first
+    assert ids("запорожью") == ["-1_5", "-1_1", "-1_2"]
+    assert ids("Запорожье свет") == ["-1_2"]
+    assert set(ids("запорож*")) == {"-1_1", "-1_2", "-1_3", "-1_5"}
+    assert ids("мост") == ["-1_4"]
+    assert ids('"') == []
+    first = lemmas.search(db, "запорожье", limit=2)
+    assert ids("запорожье", after=(first[-1]["rank"], first[-1]["key"])) == ["-1_2"]
+
+    result = CliRunner().invoke(cli.cli, ["search-posts", db_path, "Запорожская"])
+    assert result.exit_code == 0, result.output
+    assert [line.split()[0] for line in result.output.splitlines()[2:]] == ["-1_3"]
+
+    datasette = Datasette(
+        [db_path],
+        plugins_dir=PLUGINS_DIR,
+        metadata=yaml.safe_load(METADATA.read_text()),
+    )
+    response = asyncio.run(
+        datasette.client.get(
+            "/vk/posts_search_words.json?words=запорожья&after_rank=&after_key=&_shape=array"
+        )
+    )
+    assert response.status_code == 200, response.text
+    assert [row["id"] for row in response.json()] == ["-1_5", "-1_1", "-1_2"]
@@ -0,0 +1,79 @@
+import datetime
+import gzip
+import json
+
+import sqlite_utils
+from click.testing import CliRunner
+from spevktator import cli, maintenance, storage
+
+
+def test_maintain_expires_and_vacuums(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    assert maintenance.incremental(db)
+    now = datetime.datetime.utcnow()
+    with storage.writer(db):
+        db["scrape_log"].insert_all(
+            {
+                "domain": "life",
+                "timestamp": (now - datetime.timedelta(days=days)).isoformat(),
+                "url": f"https://m.vk.com/life?page={days}",
+                "status_code": 429,
+                "html": "Слишком много запросов " * 1000,
+            }
+            for days in (60, 45, 40, 1)
+        )
+        db.execute(
+            "insert into post_events (key, kind, at) values (1, 'post', ?), (2, 'post', ?)",
+            ["2020-01-01T00:00:00", now.isoformat()],
+        )
+
+    result = CliRunner().invoke(cli.cli, ["maintain", db_path, "-k", "post_events", 7])
+    assert result.exit_code == 0, result.output
+    assert (
+        "scrape_log: 3 rows older than 30 days moved to cold storage" in result.output
+    )
+    assert "post_events: 1 rows older than 7 days moved" in result.output
+    assert db["scrape_log"].count == 1
+    assert [row["key"] for row in db["post_events"].rows] == [2]
+    assert maintenance.free_bytes(db) == 0
+    reclaimed = float(result.output.split("Reclaimed ")[1].split(" MB")[0])
+    assert reclaimed > 0
+
+    # one gzip file per month, appended to by every run
+    archived = []
+    for path in sorted((tmpdir / "vk.cold").listdir()):
+        with gzip.open(path, "rt") as fp:
+            archived.extend(json.loads(line) for line in fp)
+    assert sorted(row["url"][-2:] for row in archived) == ["40", "45", "60"]
+    assert set(archived[0]) == {"domain", "timestamp", "url", "status_code", "html"}
+
+
+def test_vacuum_budget_and_convert(tmpdir):
+    db_path = str(tmpdir / "old.db")
+    # created without incremental vacuum, as by older versions
+    db = sqlite_utils.Database(db_path)
+    db["blobs"].insert_all({"data": "x" * 4000} for _ in range(500))
+    db["blobs"].drop()
+    db.close()
+
+    db = storage.open_database(db_path)
+    assert not maintenance.incremental(db)
+    assert maintenance.vacuum(db) == 0
+    result = CliRunner().invoke(cli.cli, ["maintain", db_path])
+    assert result.exit_code == 1
+    assert "--convert" in result.output
+    result = CliRunner().invoke(cli.cli, ["maintain", db_path, "--convert"])
+    assert result.exit_code == 0, result.output
+    assert maintenance.incremental(db)
+    assert maintenance.free_bytes(db) == 0
+
+    with storage.writer(db):
+        db["blobs"].insert_all({"data": "x" * 4000} for _ in range(500))
+    with storage.writer(db):
+        db["blobs"].drop()
+    free = maintenance.free_bytes(db)
+    assert maintenance.vacuum(db, budget=0) == 0
+    assert maintenance.vacuum(db, pages=100) == free
+    assert maintenance.free_bytes(db) == 0
@@ -0,0 +1,75 @@
+from click.testing import CliRunner
+from spevktator import cli, lemmas, merge, storage, synth
+
+MENTIONS_SQL = """
+select p.id, e.name, et.value from posts p
+join posts_entities pe on pe.key = p.key
+join entities e on e.id = pe.entity
+join entity_types et on et.id = e.type
+"""
+
+
+def make_shard(path, seed, count):
+    db = storage.open_database(path)
+    cli.ensure_tables(db)
+    synth.synthesize(db, count, start="2022-08-01", end="2022-09-01", seed=seed)
+    lemmas.fill(db)
+    return db
+
+
+def test_merge_shards(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    shard_paths = [str(tmpdir / "shard1.db"), str(tmpdir / "shard2.db")]
+    shards = [make_shard(shard_paths[0], 1, 120), make_shard(shard_paths[1], 2, 80)]
+    # a post scraped by both nodes, the second saw it later
+    key, views = shards[0].execute("select key, views from posts_metrics").fetchone()
+    shards[1].execute("attach database ? as other", [shard_paths[0]])
+    with storage.writer(shards[1]):
+        shards[1].execute(
+            "insert into posts (key, domain, date_utc, text)"
+            " select key, domain, date_utc, text from other.posts where key = ?",
+            [key],
+        )
+        shards[1]["posts_metrics"].insert(
+            {"key": key, "views": views + 1000, "timestamp": "2030-01-01T00:00:00"}
+        )
+    shards[1].execute("detach database other")
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["merge", db_path] + shard_paths)
+    assert result.exit_code == 0, result.output
+    assert "120 new posts" in result.output
+    assert "80 new posts" in result.output
+
+    db = storage.open_database(db_path)
+    assert db["posts"].count == 200
+    assert db["posts_metrics"].get(key)["views"] == views + 1000
+    # entity ids differ between the shards, the mentions are the same
+    expected = set()
+    for shard in shards:
+        expected |= set(shard.execute(MENTIONS_SQL).fetchall())
+    assert set(db.execute(MENTIONS_SQL).fetchall()) == expected
+    for table in ("posts_sentiment", "posts_lemmas"):
+        assert db[table].count == sum(shard[table].count for shard in shards)
+    assert db["posts_lemmas"].count == 200
+    # the new rows were indexed in one statement, matching the content tables
+    with storage.writer(db):
+        for table in ("posts_fts", "posts_translation_fts", "posts_lemmas_fts"):
+            db.execute(f"insert into {table} ({table}) values ('integrity-check')")
+    assert not db["fts_suspended"].count
+    text = db.execute("select text from posts where text != '' limit 1").fetchone()[0]
+    word = text.split()[0]
+    assert db.execute(
+        "select count(*) from posts_fts where posts_fts match ?", [f'"{word}"']
+    ).fetchone()[0]
+    assert lemmas.search(db, word)
+
+    # a second merge only moves what changed since
+    result = runner.invoke(cli.cli, ["merge", db_path] + shard_paths)
+    assert result.output.count("0 new posts, 0 metrics updated") == 2
+    with storage.writer(shards[0]):
+        shards[0]["posts_metrics"].update(key, {"timestamp": "2031-01-01T00:00:00"})
+    result = runner.invoke(cli.cli, ["merge", db_path, shard_paths[0]])
+    assert "0 new posts, 1 metrics updated" in result.output
+    assert db["posts_metrics"].get(key)["views"] == views
+    assert db[merge.SHARDS_TABLE].count == 2
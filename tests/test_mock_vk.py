@@ -0,0 +1,48 @@
+from click.testing import CliRunner
+from spevktator import cli, keys, mock_vk, scraper, storage
+
+
+def test_fetch_paginated_walls(tmpdir, monkeypatch):
+    server = mock_vk.MockVK(domains=["first", "second"], posts=12)
+    server.run_in_thread()
+    monkeypatch.setattr(scraper, "VK_BASE_URL", server.url)
+    db_path = str(tmpdir / "vk.db")
+    try:
+        result = CliRunner().invoke(
+            cli.cli, ["fetch", db_path, "first", "second", "--limit=5"]
+        )
+    finally:
+        server.shutdown()
+    assert result.exit_code == 0, result.output
+    assert "next url will be" in result.output
+    # the third page holds the last 2 posts, without a show more link
+    assert result.output.count("Show more link not found") == 2
+    assert server.stats.pages == 6
+
+    db = storage.open_database(db_path)
+    assert db["posts"].count == 24
+    post = db["posts"].get(keys.post_key(f"-{mock_vk.OWNER_BASE}_1"))
+    assert post["domain"] == "first"
+    assert post["text"].startswith("#first1 ")
+    assert db["posts_metrics"].count == 24
+
+
+def test_bench_fetch(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "bench",
+            "fetch",
+            str(tmpdir / "vk.db"),
+            "--domains=2",
+            "--limit=2",
+            "--latency=0",
+            "--error-rate=0.3",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    header, _, row = result.output.splitlines()[-3:]
+    stats = dict(zip(header.split(), row.split()))
+    assert stats["pages"] == "4"
+    assert int(stats["errors"]) > 0
+    assert stats["posts"] == "20"
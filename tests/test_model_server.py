@@ -0,0 +1,64 @@
+import concurrent.futures
+import threading
+
+import pytest
+from spevktator import model_server, models
+
+
+def fake_sentiment(texts):
+    return [{"positive": len(text), "negative": 0} for text in texts]
+
+
+@pytest.fixture
+def server(tmpdir):
+    path = str(tmpdir / "models.sock")
+    server = model_server.ModelServer(
+        path,
+        {
+            "sentiment": fake_sentiment,
+            "entities": lambda texts: [[]] * len(texts),
+            "lemmas": lambda texts: [text.lower() for text in texts],
+        },
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_model_server_batches_requests(server):
+    client = model_server.Client(server.path)
+    assert client.ping() == ["entities", "lemmas", "sentiment"]
+    assert client.request("sentiment", ["a", "bb"])["results"] == fake_sentiment(
+        ["a", "bb"]
+    )
+    with pytest.raises(ValueError):
+        client.request("translate", ["a"])
+
+    def predict(i):
+        return model_server.Client(server.path).request("sentiment", ["x" * i])
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(predict, range(1, 33)))
+    assert [r["results"][0]["positive"] for r in results] == list(range(1, 33))
+    batcher = server.batchers["sentiment"]
+    assert batcher.texts == 34
+    assert batcher.batches < 33
+
+    # a second server on the same socket is refused
+    with pytest.raises(OSError):
+        model_server.ModelServer(server.path, {})
+
+
+def test_models_use_server_when_available(server, tmpdir, monkeypatch):
+    monkeypatch.setenv(model_server.SOCKET_ENV, server.path)
+    monkeypatch.setattr(models, "checked_at", None)
+    assert models.sentiment_available()
+    assert models.predict_sentiment(["abc"]) == fake_sentiment(["abc"])
+    assert models.named_entities(["abc", "d"]) == [[], []]
+    assert models.lemmatize(["Москвы"]) == ["москвы"]
+
+    monkeypatch.setenv(model_server.SOCKET_ENV, str(tmpdir / "missing.sock"))
+    monkeypatch.setattr(models, "checked_at", None)
+    assert not models.hosted("sentiment")
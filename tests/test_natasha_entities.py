@@ -0,0 +1,42 @@
+from click.testing import CliRunner
+from spevktator import cli, keys, natasha_entities, storage
+
+TEXTS = [
+    "Президент России Владимир Путин провёл встречу с главой Министерства"
+    " обороны в Москве. Погода хорошая. Компания Газпром сообщила о поставках"
+    " в Германию.",
+    "В Запорожской АЭС, по данным МАГАТЭ, всё спокойно.",
+    "",
+    "Просто текст без имён.",
+]
+
+
+def test_ner_levels(tmpdir):
+    full = natasha_entities.named_entities(TEXTS, "full")
+    assert [len(entities) for entities in full] == [6, 2, 0, 0]
+    assert {e["normal"] for e in full[0]} >= {"Россия", "Москва", "Германия"}
+    assert full[1][0]["normal"] == "Запорожская АЭС"
+    # the same names, tagging only the sentences with a span
+    assert natasha_entities.named_entities(TEXTS, "normal") == full
+    assert natasha_entities.named_entity_normalization(TEXTS[1], "normal") == full[1]
+    spans = natasha_entities.named_entities(TEXTS, "spans")
+    assert [[e["start"] for e in entities] for entities in spans] == [
+        [e["start"] for e in entities] for entities in full
+    ]
+    assert all(e["normal"] == e["text"] for entities in spans for e in entities)
+
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    with storage.writer(db):
+        db["posts"].insert_all(
+            {"key": keys.post_key(f"-1_{i}"), "domain": "life", "text": text}
+            for i, text in enumerate(TEXTS, 1)
+        )
+    result = CliRunner().invoke(cli.cli, ["bench", "ner", db_path, "-b", "2"])
+    assert result.exit_code == 0, result.output
+    # the full pipeline is the reference, then the faster levels
+    rows = [line.split() for line in result.output.splitlines()[3:]]
+    assert [row[0] for row in rows] == ["full", "normal", "spans"]
+    assert rows[1][-2:] == ["100", "100"]
+    assert rows[2][-2] == "100" and float(rows[2][-1]) < 100
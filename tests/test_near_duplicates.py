@@ -0,0 +1,85 @@
+from spevktator import cli, keys, near_duplicates, storage
+
+TEXT = (
+    "В районе Энергодара сорвана попытка высадки десанта ВСУ,"
+    " сообщили в администрации Запорожской области"
+)
+
+
+def test_near_duplicate_clusters(tmpdir):
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    cli.ensure_tables(db)
+    posts = [
+        ("-1_1", "ria", "2022-09-03T12:05:00", TEXT + ": https://ria.ru/p/1"),
+        ("-2_1", "life", "2022-09-03T12:00:00", TEXT + "! https://life.ru/p/2"),
+        (
+            "-3_1",
+            "mash",
+            "2022-09-03T12:30:00",
+            TEXT.replace("сорвана", "была сорвана"),
+        ),
+        (
+            "-3_2",
+            "mash",
+            "2022-09-03T12:40:00",
+            "Футбольный клуб Спартак обыграл ЦСКА в дерби",
+        ),
+    ]
+    clusters = []
+    for post_id, domain, date_utc, text in posts:
+        post = {
+            "key": keys.post_key(post_id),
+            "domain": domain,
+            "date_utc": date_utc,
+            "text": text,
+        }
+        db["posts"].insert(post)
+        clusters.append(near_duplicates.index_post(db, dict(post, id=post_id)))
+
+    assert clusters[0] is None
+    assert clusters[1] == clusters[2] is not None
+    assert clusters[3] is None
+
+    cluster = db["near_duplicate_clusters"].get(clusters[1])
+    assert cluster["size"] == 3
+    assert cluster["domains"] == 3
+    # first seen is the earliest post, even though it was indexed second
+    assert cluster["first_id"] == "-2_1"
+    assert cluster["first_domain"] == "life"
+    assert cluster["last_date_utc"] == "2022-09-03T12:30:00"
+
+    # indexed again, the post is not counted twice
+    near_duplicates.index_post(db, dict(db["posts"].get(keys.post_key("-3_1"))))
+    assert db["near_duplicate_clusters"].get(clusters[1])["size"] == 3
+    # a fourth post from a wall already in the cluster adds no domain
+    post = {
+        "key": keys.post_key("-3_3"),
+        "domain": "mash",
+        "date_utc": "2022-09-03T13:00:00",
+        "text": TEXT + " https://mash.ru/p/3",
+    }
+    db["posts"].insert(post)
+    assert near_duplicates.index_post(db, dict(post, id="-3_3")) == clusters[1]
+    cluster = db["near_duplicate_clusters"].get(clusters[1])
+    assert (cluster["size"], cluster["domains"]) == (4, 3)
+
+
+def test_archived_match_starts_no_cluster(tmpdir):
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    cli.ensure_tables(db)
+    for post_id, domain in (("-1_1", "ria"), ("-2_1", "life")):
+        post = {
+            "key": keys.post_key(post_id),
+            "domain": domain,
+            "date_utc": "2022-09-03T12:00:00",
+            "text": TEXT + f" {domain}",
+        }
+        db["posts"].insert(post)
+        if post_id == "-1_1":
+            near_duplicates.index_post(db, dict(post, id=post_id))
+            # archived into a partition, only its signature is left in main
+            db["posts"].delete(post["key"])
+        else:
+            assert near_duplicates.index_post(db, dict(post, id=post_id)) is None
+    assert db["near_duplicate_clusters"].count == 0
+    assert db["minhash_signatures"].count == 2
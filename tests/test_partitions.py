@@ -0,0 +1,56 @@
+import datetime
+import os
+import sqlite3
+from spevktator import cli, partitions, storage, synth
+
+
+def test_archive_and_attach(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    cli.ensure_views(db)
+    synth.synthesize(db, 300, start="2022-06-01", end="2022-09-01")
+    cli.ensure_fts(db)
+    before = db.execute("select count(*) from posts_mega_view").fetchone()[0]
+
+    results = partitions.archive(
+        db, db_path, keep_months=1, now=datetime.datetime(2022, 8, 15)
+    )
+    assert [month for month, _ in results] == ["2022-06"]
+    assert db.execute("select min(date_utc) from posts").fetchone()[0] >= "2022-07"
+    assert db.execute(
+        "select count(*) from posts_metrics where key not in (select key from posts)"
+    ).fetchone() == (0,)
+    path = partitions.partition_dir(db_path) / "2022-06.db"
+    assert not os.stat(path).st_mode & 0o200
+
+    reader = sqlite3.connect(db_path)
+    assert partitions.attach(reader) == ["p_2022_06"]
+    assert reader.execute("select count(*) from posts_mega_view").fetchone() == (
+        before,
+    )
+    assert reader.execute("select count(*) from posts").fetchone() == (300,)
+    # the trigram indexes of the partitions are searched as well
+    [word] = reader.execute(
+        "select substr(text, 1, 6) from p_2022_06.posts where text != '' limit 1"
+    ).fetchone()
+    texts = [text.lower() for text, in reader.execute("select text from posts")]
+    assert len(
+        reader.execute(
+            "select rowid from posts_trigram where text match ?", [f'"{word}"']
+        ).fetchall()
+    ) == sum(word.lower() in text for text in texts)
+
+    # ingest does not re-add archived posts, their metrics are staged in main
+    key, post_id, date_utc = reader.execute(
+        "select key, id, date_utc from p_2022_06.posts limit 1"
+    ).fetchone()
+    assert partitions.archived(db, key, date_utc)
+    db["posts_metrics"].upsert({"key": key, "views": 123456789}, pk="key")
+    assert partitions.archive(
+        db, db_path, keep_months=1, now=datetime.datetime(2022, 8, 15)
+    ) == [("2022-06", 0)]
+    partitions.attach(reader)
+    assert reader.execute(
+        "select views from posts_mega_view where id = ?", [post_id]
+    ).fetchone() == (123456789,)
@@ -0,0 +1,62 @@
+import asyncio
+import pathlib
+
+from datasette.app import Datasette
+from spevktator import cli, keys, post_detail, storage, synth
+
+PLUGINS_DIR = str(pathlib.Path(__file__).parent.parent / "data" / "plugins")
+
+
+def test_fetch_post_and_versioned_cache(tmpdir):
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    cli.ensure_tables(db)
+    synth.synthesize(db, 50, start="2022-08-01", end="2022-09-01")
+    key, post_id = db.execute(
+        "select key, id from posts where key in (select key from posts_entities) limit 1"
+    ).fetchone()
+
+    post = post_detail.fetch(db.conn, key)
+    assert post["id"] == post_id
+    assert post["views"] == db["posts_metrics"].get(key)["views"]
+    assert {e["id"] for e in post["entities"]} == {
+        row[0]
+        for row in db.execute("select entity from posts_entities where key = ?", [key])
+    }
+    assert post_detail.fetch(db.conn, keys.post_key("-1_1")) is None
+
+    cache = post_detail.VersionedLRU(maxsize=2)
+    version = post_detail.data_version(db.conn)
+    cache.put(version, key, post)
+    assert cache.get(version, key) is post
+
+    # writes bump the version, which empties the cache
+    with storage.writer(db):
+        db["posts_metrics"].upsert({"key": key, "views": 1}, pk="key")
+    assert post_detail.data_version(db.conn) == version + 1
+    assert cache.get(version + 1, key) is None
+    # batches without changes don't
+    with storage.writer(db):
+        pass
+    assert post_detail.data_version(db.conn) == version + 1
+
+    cache.put(version + 1, "a", 1)
+    cache.put(version + 1, "b", 2)
+    cache.get(version + 1, "a")
+    cache.put(version + 1, "c", 3)
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_links_by_string_id_redirect(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    cli.ensure_tables(storage.open_database(db_path))
+    datasette = Datasette(
+        [db_path], plugins_dir=PLUGINS_DIR, settings={"base_url": "/spevktator/"}
+    )
+    key = keys.post_key("-1_2")
+    for path, location in (
+        ("/vk/posts/-1_2", f"/spevktator/vk/posts/{key}"),
+        ("/vk/posts/-1_2.json", f"/spevktator/vk/posts/{key}.json"),
+    ):
+        response = asyncio.run(datasette.client.get(path))
+        assert response.status_code == 302
+        assert response.headers["location"] == location
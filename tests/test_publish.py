@@ -0,0 +1,131 @@
+import datetime
+import os
+import sqlite3
+
+from click.testing import CliRunner
+from spevktator import cli, keys, lemmas, partitions, publish, rollups, storage, synth
+
+TABLES = list(keys.POST_TABLES) + ["entities"] + list(rollups.ROLLUPS)
+
+
+def snapshot(db):
+    return {
+        table: sorted(db.execute(f"select * from {table}").fetchall(), key=repr)
+        for table in TABLES
+    }
+
+
+def test_publish_and_apply(tmpdir):
+    db_path = str(tmpdir / "ingest" / "vk.db")
+    replica_path = str(tmpdir / "public" / "vk.db")
+    changesets = str(tmpdir / "changesets")
+    tmpdir.mkdir("ingest")
+    tmpdir.mkdir("public")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    cli.ensure_views(db)
+    synth.synthesize(db, 300, start="2022-06-01", end="2022-09-01")
+    # the rest are lemmatized later, by a backfill
+    lemmas.fill(db, "select key from posts order by key limit 200")
+    cli.ensure_fts(db)
+    with storage.writer(db):
+        db["scrape_log"].insert({"domain": "life", "html": "<html>" * 1000})
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["publish", db_path, changesets])
+    assert result.exit_code == 0, result.output
+    assert "Changeset 1: 300 posts" in result.output
+    result = runner.invoke(cli.cli, ["apply", replica_path, changesets])
+    assert result.exit_code == 0, result.output
+    replica = storage.open_database(replica_path)
+    assert snapshot(replica) == snapshot(db)
+    assert replica["scrape_log"].count == 0
+    assert replica["posts_lemmas"].count == 200
+
+    # new posts, newer metrics, a translated entity and an archived month
+    key = keys.post_key("-1_1")
+    with storage.writer(db):
+        db["posts"].insert(
+            {
+                "key": key,
+                "domain": "life",
+                "date_utc": "2022-08-31T12:00:00",
+                "text": "тестпубликации",
+            }
+        )
+        db["posts_metrics"].insert(
+            {"key": key, "views": 5, "timestamp": "2030-01-01T00:00:00"}
+        )
+        db.execute(
+            "update posts_metrics set views = views + 1, timestamp = '2030-01-01'"
+            " where key in (select key from posts where date_utc > '2022-08' limit 3)"
+        )
+        db.execute("update entities set name_en = 'Renamed' where id = 1")
+    partitions.archive(db, db_path, keep_months=1, now=datetime.datetime(2022, 8, 15))
+    result = runner.invoke(cli.cli, ["publish", db_path, changesets])
+    assert result.exit_code == 0, result.output
+    assert (
+        "Changeset 2: 1 posts, 4 metrics, 1 entities and 1 partitions" in result.output
+    )
+
+    result = runner.invoke(cli.cli, ["apply", replica_path, changesets])
+    assert result.exit_code == 0, result.output
+    assert "Changeset 2 applied" in result.output
+    assert "Changeset 1" not in result.output
+    assert snapshot(replica) == snapshot(db)
+    assert list(replica[partitions.CATALOG_TABLE].rows)[0]["month"] == "2022-06"
+    with storage.writer(replica):
+        for table in (
+            "posts_fts",
+            "posts_translation_fts",
+            "entities_fts",
+            "posts_lemmas_fts",
+        ):
+            replica.execute(f"insert into {table} ({table}) values ('integrity-check')")
+    assert replica.execute(
+        "select count(*) from posts_fts where posts_fts match 'тестпубликации'"
+    ).fetchone() == (1,)
+
+    counts = []
+    for path in (db_path, replica_path):
+        conn = sqlite3.connect(path)
+        assert partitions.attach(conn) == ["p_2022_06"]
+        counts.append(conn.execute("select count(*), sum(views) from posts_mega_view"))
+        counts[-1] = counts[-1].fetchone()
+    assert counts[0] == counts[1]
+
+    # lemmas backfilled for posts published before
+    assert lemmas.fill(db) == 81
+    result = runner.invoke(cli.cli, ["publish", db_path, changesets])
+    assert "Changeset 3: 81 posts, 81 metrics" in result.output
+    result = runner.invoke(cli.cli, ["apply", replica_path, changesets])
+    assert result.exit_code == 0, result.output
+    assert snapshot(replica) == snapshot(db)
+    assert [p["key"] for p in lemmas.search(replica, "тестпубликациях")] == [key]
+
+    result = runner.invoke(cli.cli, ["publish", db_path, changesets])
+    assert "Nothing changed" in result.output
+    result = runner.invoke(cli.cli, ["apply", replica_path, changesets])
+    assert "up-to-date" in result.output
+    assert replica[publish.APPLIED_TABLE].get(str(changesets))["number"] == 3
+
+    # the publisher died after writing the manifest, before storing its watermark
+    target = db[publish.TARGETS_TABLE].get(os.path.abspath(changesets))
+    with storage.writer(db):
+        db.execute(
+            "update posts_metrics set views = views + 1, timestamp = '2031-01-01'"
+            " where key = ?",
+            [key],
+        )
+    result = runner.invoke(cli.cli, ["publish", db_path, changesets])
+    assert "Changeset 4: 0 posts, 1 metrics" in result.output
+    with storage.writer(db):
+        db[publish.TARGETS_TABLE].insert(target, replace=True)
+    result = runner.invoke(cli.cli, ["publish", db_path, changesets])
+    assert "Changeset 5: 0 posts, 1 metrics" in result.output
+    numbers = [c["number"] for c in publish.read_manifest(changesets)["changesets"]]
+    assert numbers == [1, 2, 3, 4, 5]
+    result = runner.invoke(cli.cli, ["apply", replica_path, changesets])
+    assert "Changeset 4 applied" in result.output
+    assert "Changeset 5 applied" in result.output
+    assert snapshot(replica) == snapshot(db)
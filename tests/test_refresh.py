@@ -0,0 +1,50 @@
+import pathlib
+
+from click.testing import CliRunner
+from freezegun import freeze_time
+from pytest_httpx import HTTPXMock
+from spevktator import cli, keys, refresh, storage
+
+OLD = keys.post_key("-24199209_1")
+
+
+def test_refresh_due_posts(tmpdir, httpx_mock: HTTPXMock):
+    html = open(pathlib.Path(__file__).parent / "vk_life.html").read()
+    httpx_mock.add_response(url="https://m.vk.com/life", html=html)
+    db_path = str(tmpdir / "data.db")
+
+    with freeze_time("2022-09-03 13:00:00"):
+        result = CliRunner().invoke(
+            cli.cli, ["fetch", db_path, "life", "--limit=1"], catch_exceptions=False
+        )
+        assert not result.exception, result.exception
+    db = storage.open_database(db_path)
+    queue = {keys.post_id(row["key"]): row for row in db[refresh.QUEUE_TABLE].rows}
+    assert len(queue) == 5
+    # posts of less than an hour old are revisited after the minimum interval,
+    # the pinned post of three weeks ago only after days
+    assert queue["-24199209_18981678"]["interval"] == refresh.MIN_INTERVAL
+    assert queue["-24199209_18932515"]["interval"] > 5 * 24 * 3600
+
+    # an older post, that is no longer on the wall
+    with storage.writer(db):
+        db["posts"].insert(
+            {"key": OLD, "domain": "life", "date_utc": "2022-09-02T12:00:00"}
+        )
+        db["posts_metrics"].insert(
+            {"key": OLD, "likes": 1, "timestamp": "2022-09-02T18:00:00"}
+        )
+    assert refresh.due(db, "2022-09-03T13:10:00") == 1
+    assert refresh.due(db, "2022-09-03T13:20:00") == 5
+
+    with freeze_time("2022-09-03 13:20:00"):
+        # the four young posts and the older one below them share the first page
+        pages = refresh.plan(db, 10)
+        assert [(p.domain, p.offset, len(p.keys)) for p in pages] == [("life", 0, 5)]
+        result = refresh.run(db, 10)
+    assert (result.pages, result.refreshed, result.missed) == (1, 4, 1)
+    assert refresh.due(db, "2022-09-03T13:30:00") == 0
+    assert db[refresh.QUEUE_TABLE].get(OLD)["misses"] == 1
+    assert db["posts_metrics"].get(keys.post_key("-24199209_18981678"))[
+        "timestamp"
+    ] == ("2022-09-03T13:20:00")
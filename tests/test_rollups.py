@@ -0,0 +1,97 @@
+import datetime
+import sqlite3
+
+from click.testing import CliRunner
+from spevktator import cli, partitions, rollups, storage, synth
+
+
+def totals(db, table="rollups", column="posts"):
+    return dict(
+        db.execute(
+            f"select period, sum({column}) from {table} group by period"
+        ).fetchall()
+    )
+
+
+def test_rollups_incremental(tmpdir):
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    cli.ensure_tables(db)
+    synth.synthesize(db, 500, start="2022-08-01", end="2022-09-01")
+    assert (
+        rollups.refresh(db)
+        == db.execute(
+            "select count(distinct domain || date(date_utc)) from posts"
+        ).fetchone()[0]
+    )
+    assert db[rollups.DIRTY_TABLE].count == 0
+
+    views = db.execute("select sum(views) from posts_metrics").fetchone()[0]
+    assert totals(db) == {"hour": 500, "day": 500, "week": 500}
+    assert set(totals(db, column="views").values()) == {views}
+    mentions = db["posts_entities"].count
+    assert set(totals(db, "entity_rollups", "mentions").values()) == {mentions}
+    ukraine = db.execute(
+        "select count(*) from posts_translation where text_en like '%Ukraine%'"
+    ).fetchone()[0]
+    assert db.execute(
+        "select sum(posts) from term_rollups where period = 'week' and term = 'Ukraine'"
+    ).fetchone() == (ukraine,)
+
+    # enrichment only marks the day of its post
+    key, domain, day = db.execute(
+        "select key, domain, date(date_utc) from posts limit 1"
+    ).fetchone()
+    db["posts_metrics"].upsert({"key": key, "views": 1_000_000}, pk="key")
+    assert list(db[rollups.DIRTY_TABLE].rows) == [{"domain": domain, "day": day}]
+    assert rollups.refresh(db) == 1
+    views = db.execute("select sum(views) from posts_metrics").fetchone()[0]
+    assert set(totals(db, column="views").values()) == {views}
+
+
+def test_rollups_command(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    synth.synthesize(db, 200, start="2022-08-01", end="2022-09-01")
+    db.close()
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["rollups", db_path, "--term", "Bayraktar"])
+    assert result.exit_code == 0, result.output
+    db = storage.open_database(db_path)
+    assert totals(db)["week"] == 200
+    bayraktar = db.execute(
+        "select count(*) from posts_translation where text_en like '%Bayraktar%'"
+    ).fetchone()[0]
+    assert db.execute(
+        "select coalesce(sum(posts), 0) from term_rollups"
+        " where period = 'day' and term = 'Bayraktar'"
+    ).fetchone() == (bayraktar,)
+
+
+def test_rollups_of_sealed_months(tmpdir):
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    synth.synthesize(db, 300, start="2022-06-01", end="2022-09-01")
+    rollups.refresh(db)
+    partitions.archive(db, db_path, keep_months=1, now=datetime.datetime(2022, 8, 15))
+    assert db.execute("select min(date_utc) from posts").fetchone()[0] >= "2022-07"
+
+    # rebuilt and new terms counted from the partitions as well
+    result = CliRunner().invoke(cli.cli, ["rollups", db_path, "--term", "Moscow"])
+    assert result.exit_code == 0, result.output
+    assert totals(db)["week"] == 300
+    reader = sqlite3.connect(db_path)
+    partitions.attach(reader)
+    moscow = reader.execute(
+        "select count(*) from posts_translation where text_en like '%Moscow%'"
+        " and key in (select key from posts where date_utc < '2022-07')"
+    ).fetchone()[0]
+    assert moscow
+    assert db.execute(
+        "select sum(posts) from term_rollups"
+        " where period = 'day' and term = 'Moscow' and bucket < '2022-07'"
+    ).fetchone() == (moscow,)
+    # the shadowing views are gone again
+    assert not db.execute("select * from sqlite_temp_master").fetchall()
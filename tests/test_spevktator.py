@@ -30,7 +30,7 @@ def test_spevktator_fetch(tmpdir, vk_life_html, httpx_mock: HTTPXMock):
         "posts_fts",
     }.issubset(db.table_names())
 
-    posts = list(db["posts"].rows)
+    posts = list(db.query("select id, domain, date_utc, text from posts order by key"))
     assert len(posts) == 5
     assert posts == [
         {
@@ -40,16 +40,10 @@ def test_spevktator_fetch(tmpdir, vk_life_html, httpx_mock: HTTPXMock):
             "text": 'Самая страшная пыточная современности находилась в Мариуполе, а боевики "Азова"* дали ей необычное название "Библиотека". Людей, которые подвергались там самым изощрённым мучениям и казням, нацисты называли "книгами". После освобождения города мир узнал об одном из самых жутких мест на Украине. Здесь держали пленников под страхом смерти, не зная сострадания и жалости, их истязали, уничтожая способность хоть как-то сопротивляться. О том, как банда неонацистов превратилась в секту "Азов"*, почитающую насилие и культ мёртвых, о том, кто стоит за этими убийцами и о зверствах, которые не должны быть забыты, мы рассказали в новом проекте "Трибунал". В первой серии проекта "Трибунал" "АЗОВ"*: история 4-го рейха" узники самого известного концлагеря современности, члены семей националистов и профессиональные историки рассказывают жёсткую правду о том, что все долгие восемь лет происходило на Юго-Востоке Украины * "Азов" — запрещённая в России террористическая организация.',
         },
         {
-            "id": "-24199209_18981678",
-            "domain": "life",
-            "date_utc": "2022-09-03T12:40:00",
-            "text": "Владимир Путин увеличил численность ВС РФ: https://life.ru/p/1518876",
-        },
-        {
-            "id": "-24199209_18981640",
+            "id": "-24199209_18981564",
             "domain": "life",
-            "date_utc": "2022-09-03T12:30:00",
-            "text": "Cуд Москвы вынес окончательное решение в отношении Юрия Дудя*: https://life.ru/p/1518874 * Включены в реестр СМИ-иноагентов.",
+            "date_utc": "2022-09-03T12:11:00",
+            "text": "Одна из известнейших россиянок уехала из России: https://life.ru/p/1518869",
         },
         {
             "id": "-24199209_18981607",
@@ -58,10 +52,16 @@ def test_spevktator_fetch(tmpdir, vk_life_html, httpx_mock: HTTPXMock):
             "text": 'Опубликовано пророческое сообщение умершей звезды "Дома-2": https://life.ru/p/1518819',
         },
         {
-            "id": "-24199209_18981564",
+            "id": "-24199209_18981640",
             "domain": "life",
-            "date_utc": "2022-09-03T12:11:00",
-            "text": "Одна из известнейших россиянок уехала из России: https://life.ru/p/1518869",
+            "date_utc": "2022-09-03T12:30:00",
+            "text": "Cуд Москвы вынес окончательное решение в отношении Юрия Дудя*: https://life.ru/p/1518874 * Включены в реестр СМИ-иноагентов.",
+        },
+        {
+            "id": "-24199209_18981678",
+            "domain": "life",
+            "date_utc": "2022-09-03T12:40:00",
+            "text": "Владимир Путин увеличил численность ВС РФ: https://life.ru/p/1518876",
         },
     ]
     # print(posts)
@@ -0,0 +1,73 @@
+import datetime
+import pathlib
+
+import pytest
+import sqlite_utils
+from spevktator import cli, models, near_duplicates, scraper, storage
+
+
+def test_open_database_enables_wal(tmpdir):
+    db = storage.open_database(str(tmpdir / "data.db"))
+    assert db.journal_mode == "wal"
+    assert db.execute("pragma busy_timeout").fetchone()[0] == storage.BUSY_TIMEOUT
+
+
+def test_writer_batches_commits(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = storage.open_database(db_path)
+    db["posts"].create({"id": str, "text": str}, pk="id")
+    reader = sqlite_utils.Database(db_path)
+
+    with storage.writer(db):
+        # sqlite-utils commits inside insert(), which must join the batch
+        db["posts"].insert({"id": "1", "text": "a"})
+        with storage.writer(db):
+            db["posts"].insert({"id": "2", "text": "b"})
+        assert reader["posts"].count == 0
+    assert reader["posts"].count == 2
+
+
+def test_writer_rolls_back_batch(tmpdir):
+    db = storage.open_database(str(tmpdir / "data.db"))
+    db["posts"].create({"id": str, "text": str}, pk="id")
+
+    with pytest.raises(ValueError):
+        with storage.writer(db):
+            db["posts"].insert({"id": "1", "text": "a"})
+            raise ValueError("boom")
+    assert db["posts"].count == 0
+
+    # a failing statement does not undo the rest of the batch
+    with storage.writer(db):
+        db["posts"].insert({"id": "1", "text": "a"})
+        with pytest.raises(sqlite_utils.utils.sqlite3.IntegrityError):
+            db["posts"].insert({"id": "1", "text": "b"})
+        db["posts"].insert({"id": "2", "text": "c"})
+    assert db["posts"].count == 2
+
+
+def test_page_is_parsed_outside_the_writer(tmpdir, monkeypatch):
+    db = storage.open_database(str(tmpdir / "data.db"))
+    cli.ensure_tables(db)
+    html = open(pathlib.Path(__file__).parent / "vk_life.html").read()
+    held = []
+    signature = near_duplicates.signature
+
+    def predict_sentiment(texts):
+        held.append(db.conn.in_transaction)
+        return [{"positive": 1.0, "negative": 0.0} for _ in texts]
+
+    def traced_signature(text):
+        held.append(db.conn.in_transaction)
+        return signature(text)
+
+    monkeypatch.setattr(models, "sentiment_available", lambda: True)
+    monkeypatch.setattr(models, "predict_sentiment", predict_sentiment)
+    monkeypatch.setattr(near_duplicates, "signature", traced_signature)
+    result = scraper.process_page(
+        db, "life", html, verbose=False, relative_timestamp=datetime.datetime.utcnow()
+    )
+    assert result.posts_added == 5
+    # a signature per post and one batch of texts through the model
+    assert held == [False] * 6
+    assert db["posts_sentiment"].count == 5
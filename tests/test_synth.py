@@ -0,0 +1,47 @@
+import pathlib
+from click.testing import CliRunner
+import sqlite_utils
+from spevktator import cli
+
+
+def test_spevktator_synth(tmpdir):
+    db_path = str(tmpdir / "synth.db")
+    result = CliRunner().invoke(
+        cli.cli, ["synth", db_path, "--posts=500", "--seed=1"], catch_exceptions=False
+    )
+    assert result.exit_code == 0, result.output
+
+    db = sqlite_utils.Database(db_path)
+    assert db["posts"].count == 500
+    assert db["posts_metrics"].count == 500
+    assert {"posts_fts", "posts_translation_fts"}.issubset(db.table_names())
+    assert db["posts_sentiment"].count == db["posts_entities_done"].count
+    # loaded without the change triggers, which caught up once and are back
+    assert db["export_changes"].count == db["export_metrics_changes"].count == 500
+    assert db["post_events"].count_where("kind = 'post'") == 500
+    assert db["rollups"].count > 0
+    assert "posts_export_ai" in {trigger.name for trigger in db["posts"].triggers}
+    assert db.journal_mode == "wal"
+    # all entity mentions point at the entity name inside the post text
+    for row in db.query(
+        """
+        select p.text, e.name, pe.begin_offset, pe.end_offset
+        from posts_entities pe join posts p on p.id = pe.id join entities e on e.id = pe.entity
+        limit 50
+        """
+    ):
+        assert row["text"][row["begin_offset"] : row["end_offset"]] == row["name"]
+
+
+def test_spevktator_bench_queries(tmpdir):
+    db_path = str(tmpdir / "synth.db")
+    CliRunner().invoke(cli.cli, ["synth", db_path, "--posts=200"])
+    metadata = pathlib.Path(__file__).parent.parent / "data" / "metadata.yml"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["bench", "queries", db_path, "--metadata", str(metadata), "--repeat=1"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "posts_mega_view" in result.output
+    assert "related_entities_en" in result.output
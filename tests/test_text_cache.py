@@ -0,0 +1,108 @@
+from click.testing import CliRunner
+from spevktator import cli, enrich, keys, models, scraper, storage, text_cache
+
+TEXTS = {
+    "-1_1": "Москва сегодня",
+    "-2_1": "Москва сегодня",  # a repost on another wall
+    "-1_2": "Киев вчера",
+}
+
+
+def add_posts(db, texts):
+    with storage.writer(db):
+        db["posts"].insert_all(
+            {"key": keys.post_key(post_id), "domain": "life", "text": text}
+            for post_id, text in texts.items()
+        )
+
+
+def test_text_cache(tmpdir, monkeypatch):
+    calls = []
+
+    def named_entities(texts, level=None):
+        calls.append(texts)
+        return [
+            [{"normal": text.split()[0], "type": "LOC", "start": 0, "stop": 5}]
+            for text in texts
+        ]
+
+    def predict_sentiment(texts):
+        calls.append(texts)
+        return [{"positive": len(text) / 100, "negative": 0.1} for text in texts]
+
+    monkeypatch.setattr(models, "named_entities", named_entities)
+    monkeypatch.setattr(models, "predict_sentiment", predict_sentiment)
+    monkeypatch.setattr(models, "sentiment_available", lambda: True)
+    assert text_cache.text_hash(" Москва\n сегодня") == text_cache.text_hash(
+        TEXTS["-1_1"]
+    )
+
+    db_path = str(tmpdir / "vk.db")
+    db = storage.open_database(db_path)
+    cli.ensure_tables(db)
+    # written without hashes, as by an older version
+    add_posts(db, TEXTS)
+    assert text_cache.fill_hashes(db) == 3
+
+    # the repost is in the same chunk, its text goes through the model once
+    scraper.extract_named_entities(db, limit=0)
+    assert [len(texts) for texts in calls] == [2]
+    assert db["posts_entities_done"].count == 3
+    assert db[text_cache.ENTITIES_DONE_TABLE].count == 2
+
+    calls.clear()
+    add_posts(db, {"-3_1": "Киев вчера", "-3_2": "Одесса"})
+    text_cache.fill_hashes(db)
+    scraper.extract_named_entities(db, limit=0)
+    assert calls == [["Одесса"]]
+    spans = "select entity, begin_offset, end_offset from posts_entities where key = ?"
+    assert (
+        db.execute(spans, [keys.post_key("-3_1")]).fetchall()
+        == db.execute(spans, [keys.post_key("-1_2")]).fetchall()
+    )
+
+    calls.clear()
+    result = CliRunner().invoke(cli.cli, ["sentiment", db_path, "posts", "text"])
+    assert result.exit_code == 0, result.output
+    assert db["posts_sentiment"].count == 5
+    assert sum(len(texts) for texts in calls) == 3
+
+    # enrich copies both results for a new repost, without running a model
+    calls.clear()
+    add_posts(db, {"-4_1": "Одесса"})
+    text_cache.fill_hashes(db)
+    stages = enrich.build_stages(db_path, skip=("translate-posts",))
+    pipeline = enrich.Pipeline(db, stages)
+    assert pipeline.copy_cached() == 2
+    assert pipeline.run() == 0
+    assert calls == []
+    odessa = "select positive from posts_sentiment where key = ?"
+    assert (
+        db.execute(odessa, [keys.post_key("-4_1")]).fetchone()
+        == db.execute(odessa, [keys.post_key("-3_2")]).fetchone()
+    )
+
+    stats = {row["cache"]: row for row in text_cache.stats(db)}
+    assert (stats["entities"]["hits"], stats["entities"]["misses"]) == (3, 3)
+    assert (stats["sentiment"]["hits"], stats["sentiment"]["misses"]) == (3, 3)
+    result = CliRunner().invoke(cli.cli, ["stats", db_path])
+    assert "hit %" in result.output
+
+
+def test_posts_done_meanwhile_are_not_counted(tmpdir, monkeypatch):
+    db = storage.open_database(str(tmpdir / "vk.db"))
+    cli.ensure_tables(db)
+    add_posts(db, {"-1_1": "Москва", "-1_2": "Киев", "-1_3": "Одесса"})
+
+    def named_entities(texts, level=None):
+        # another listen worker finishes two of the posts meanwhile
+        with storage.writer(db):
+            db["posts_entities_done"].insert_all(
+                {"key": keys.post_key(post_id)} for post_id in ("-1_1", "-1_2")
+            )
+        return [[] for _ in texts]
+
+    monkeypatch.setattr(models, "named_entities", named_entities)
+    scraper.extract_named_entities(db, limit=0)
+    stats = {row["cache"]: row for row in text_cache.stats(db)}
+    assert (stats["entities"]["hits"], stats["entities"]["misses"]) == (0, 1)